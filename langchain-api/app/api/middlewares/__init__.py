@@ -0,0 +1,2 @@
+from .profiling import ProfilingMiddleware  # noqa: F401
+from .capture import CaptureMiddleware  # noqa: F401
@@ -0,0 +1,36 @@
+from __future__ import annotations
+from app.core.config import settings
+from app.services.capture import CAPTURE_PATHS, capture_writer
+
+class CaptureMiddleware:
+    """
+    CAPTURE_PATH が設定されている間だけ、チャット系 POST のボディを読み取りついでに記録する。
+    ボディはアプリ側へそのまま渡すので処理内容には影響しない。
+    """
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if (
+            scope["type"] != "http"
+            or not capture_writer.enabled
+            or scope.get("method") != "POST"
+            or scope.get("path") not in CAPTURE_PATHS
+        ):
+            await self.app(scope, receive, send)
+            return
+
+        headers = dict(scope.get("headers") or [])
+        client_header = settings.ADMISSION_CLIENT_HEADER.lower().encode() if settings.ADMISSION_CLIENT_HEADER else b""
+        client = headers.get(client_header, b"").decode() or None
+        chunks: list[bytes] = []
+
+        async def receive_and_capture():
+            message = await receive()
+            if message["type"] == "http.request":
+                chunks.append(message.get("body", b""))
+                if not message.get("more_body"):
+                    capture_writer.record(scope["path"], b"".join(chunks), client)
+            return message
+
+        await self.app(scope, receive_and_capture, send)
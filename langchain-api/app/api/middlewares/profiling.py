@@ -0,0 +1,50 @@
+from __future__ import annotations
+import hmac
+import os
+import threading
+from app.core.config import settings
+from app.services.profiler import SamplingProfiler, profile_store, profiling_lock
+
+def is_admin_token(token: str | None) -> bool:
+    if not settings.ADMIN_TOKEN or not token:
+        return False
+    return hmac.compare_digest(token.encode(), settings.ADMIN_TOKEN.encode())
+
+class ProfilingMiddleware:
+    """
+    "X-Profile: 1" と正しい "X-Admin-Token" が付いたリクエストの間だけイベントループのスレッドをサンプリングする。
+    結果は X-Profile-Id ヘッダで返し、/v1/admin/profiles/{id} から collapsed 形式で取得する。
+    同じループで並行して動く他のリクエストのスタックも混ざる点に注意。
+    ヘッダが無いリクエストはヘッダを 1 回見るだけで素通しする。
+    """
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not settings.ADMIN_TOKEN:
+            await self.app(scope, receive, send)
+            return
+        headers = dict(scope.get("headers") or [])
+        if headers.get(b"x-profile") != b"1" or not is_admin_token(headers.get(b"x-admin-token", b"").decode()):
+            await self.app(scope, receive, send)
+            return
+        if not profiling_lock.acquire(blocking=False):
+            # 既に別のプロファイルが走っている
+            await self.app(scope, receive, send)
+            return
+
+        profile_id = "prof-" + os.urandom(6).hex()
+        profiler = SamplingProfiler(thread_id=threading.get_ident(), interval=settings.PROFILE_INTERVAL_MS / 1000)
+
+        async def send_with_id(message):
+            if message["type"] == "http.response.start":
+                message["headers"] = list(message.get("headers") or []) + [(b"x-profile-id", profile_id.encode())]
+            await send(message)
+
+        profiler.start()
+        try:
+            await self.app(scope, receive, send_with_id)
+        finally:
+            profiler.stop()
+            profiling_lock.release()
+            profile_store.put(profile_id, profiler, label=f"{scope.get('method')} {scope.get('path')}")
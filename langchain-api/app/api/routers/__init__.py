@@ -1,4 +1,9 @@
 from .chat import router as chat_router  # noqa: F401
+from .chat_ws import router as chat_ws_router  # noqa: F401
 from .relay import router as relay_router  # noqa: F401
 from .health import router as health_router  # noqa: F401
-from .models import router as models_router  # noqa: F401
\ No newline at end of file
+from .models import router as models_router  # noqa: F401
+from .admin import router as admin_router  # noqa: F401
+from .files import router as files_router  # noqa: F401
+from .batches import router as batches_router  # noqa: F401
+from .embeddings import router as embeddings_router  # noqa: F401
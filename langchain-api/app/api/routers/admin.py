@@ -0,0 +1,77 @@
+from __future__ import annotations
+import asyncio
+import os
+from fastapi import APIRouter, Depends, HTTPException, Request
+from fastapi.responses import PlainTextResponse
+from app.core.config import settings
+from app.api.middlewares.profiling import is_admin_token
+from app.jobs.compact_memories import compact_memories, compaction_scheduler
+from app.jobs.consolidate_memories import consolidate_memories, revert_merge
+from app.services.profiler import SamplingProfiler, profile_store, profiling_lock
+
+router = APIRouter(prefix="/v1/admin", tags=["admin"])
+
+def require_admin(request: Request) -> None:
+    # ADMIN_TOKEN 未設定なら管理系は存在しないものとして扱う
+    if not settings.ADMIN_TOKEN:
+        raise HTTPException(status_code=404)
+    if not is_admin_token(request.headers.get("x-admin-token")):
+        raise HTTPException(status_code=401, detail="invalid admin token")
+
+@router.post("/profile", dependencies=[Depends(require_admin)])
+async def profile_window(seconds: float = 10.0, interval_ms: float | None = None, all_threads: bool = False):
+    """
+    プロセス全体を seconds 秒間サンプリングし、collapsed 形式 (flamegraph.pl / speedscope 互換) で返す。
+    """
+    seconds = max(0.1, min(seconds, settings.PROFILE_MAX_SECONDS))
+    interval = (interval_ms or settings.PROFILE_INTERVAL_MS) / 1000
+    if not profiling_lock.acquire(blocking=False):
+        raise HTTPException(status_code=409, detail="another profile is running")
+    profiler = SamplingProfiler(interval=interval, all_threads=all_threads)
+    profiler.start()
+    try:
+        await asyncio.sleep(seconds)
+    finally:
+        profiler.stop()
+        profiling_lock.release()
+    profile_id = "prof-" + os.urandom(6).hex()
+    profile_store.put(profile_id, profiler, label=f"window {seconds}s")
+    return PlainTextResponse(
+        profiler.collapsed(),
+        headers={"X-Profile-Id": profile_id, "X-Profile-Samples": str(profiler.sample_count)},
+    )
+
+@router.get("/profiles", dependencies=[Depends(require_admin)])
+async def list_profiles():
+    return {"object": "list", "data": profile_store.list()}
+
+@router.get("/profiles/{profile_id}", dependencies=[Depends(require_admin)])
+async def get_profile(profile_id: str):
+    entry = profile_store.get(profile_id)
+    if entry is None:
+        raise HTTPException(status_code=404, detail="profile not found")
+    return PlainTextResponse(entry["collapsed"], headers={"X-Profile-Samples": str(entry["samples"])})
+
+@router.post("/compaction", dependencies=[Depends(require_admin)])
+async def run_compaction(dry_run: bool = True, retention_days: float | None = None):
+    """論理削除済みメモリの退避を手動で走らせる (既定は dry-run)"""
+    report = await compact_memories(retention_days=retention_days, dry_run=dry_run)
+    return report.to_dict()
+
+@router.get("/compaction", dependencies=[Depends(require_admin)])
+async def last_compaction():
+    report = compaction_scheduler.last_report
+    return report.to_dict() if report is not None else {}
+
+@router.post("/consolidation", dependencies=[Depends(require_admin)])
+async def run_consolidation(tenant_id: str = settings.DEFAULT_TENANT, apply: bool = False):
+    """テナントのほぼ重複したメモリをまとめる (既定はレポートのみ)"""
+    report = await consolidate_memories(tenant_id, dry_run=not apply)
+    return report.to_dict()
+
+@router.post("/consolidation/{merge_id}/revert", dependencies=[Depends(require_admin)])
+async def revert_consolidation(merge_id: str):
+    restored = await revert_merge(merge_id)
+    if restored == 0:
+        raise HTTPException(status_code=404, detail="merge not found or already reverted")
+    return {"merge_id": merge_id, "restored": restored}
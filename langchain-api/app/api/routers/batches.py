@@ -0,0 +1,103 @@
+from __future__ import annotations
+from typing import Dict, Optional
+from fastapi import APIRouter, Depends, HTTPException, Request
+from pydantic import BaseModel
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.db.session import get_async_session
+from app.db.models.batch import Batch, BatchFile
+from app.services.admission import client_key
+from app.services.batches import (
+    BATCH_ENDPOINTS,
+    COMPLETION_WINDOWS,
+    TERMINAL_STATUSES,
+    now_utc,
+    batch_object,
+    batch_runner,
+    new_batch_id,
+    visible_to,
+)
+from app.services.tenancy import tenant_id_for
+
+router = APIRouter(prefix="/v1/batches", tags=["batches"])
+
+class CreateBatchRequest(BaseModel):
+    input_file_id: str
+    endpoint: str
+    completion_window: str = "24h"
+    metadata: Optional[Dict[str, str]] = None
+
+async def _get_batch(session: AsyncSession, request: Request, batch_id: str) -> Batch:
+    batch = await session.get(Batch, batch_id)
+    if batch is None or not visible_to(batch, tenant_id_for(request), client_key(request)):
+        raise HTTPException(status_code=404, detail="batch not found")
+    return batch
+
+@router.post("")
+async def create_batch(req: CreateBatchRequest, request: Request, session: AsyncSession = Depends(get_async_session)):
+    if req.endpoint not in BATCH_ENDPOINTS:
+        raise HTTPException(status_code=400, detail=f"endpoint must be one of {list(BATCH_ENDPOINTS)}")
+    window = COMPLETION_WINDOWS.get(req.completion_window)
+    if window is None:
+        raise HTTPException(status_code=400, detail=f"completion_window must be one of {list(COMPLETION_WINDOWS)}")
+    tenant_id = tenant_id_for(request)
+    input_file = await session.get(BatchFile, req.input_file_id)
+    if input_file is None or not visible_to(input_file, tenant_id, client_key(request)) or input_file.purpose != "batch":
+        raise HTTPException(status_code=404, detail="input file not found")
+    now = now_utc()
+    batch = Batch(
+        id=new_batch_id(),
+        tenant_id=tenant_id,
+        client_key=client_key(request),
+        endpoint=req.endpoint,
+        input_file_id=req.input_file_id,
+        completion_window=req.completion_window,
+        status="validating",
+        batch_metadata=req.metadata,
+        created_at=now,
+        expires_at=now + window,
+    )
+    session.add(batch)
+    await session.commit()
+    # 検証と処理はワーカー側で行う
+    batch_runner.notify()
+    return batch_object(batch)
+
+@router.get("")
+async def list_batches(request: Request, limit: int = 20, after: str | None = None, session: AsyncSession = Depends(get_async_session)):
+    limit = max(1, min(limit, 100))
+    stmt = (
+        select(Batch)
+        .where(Batch.tenant_id == tenant_id_for(request))
+        .where(Batch.client_key == client_key(request))
+    ).order_by(Batch.created_at.desc(), Batch.id.desc())
+    if after:
+        cursor = await session.get(Batch, after)
+        if cursor is not None and visible_to(cursor, tenant_id_for(request), client_key(request)):
+            stmt = stmt.where(Batch.created_at < cursor.created_at)
+    batches = (await session.execute(stmt.limit(limit + 1))).scalars().all()
+    data = [batch_object(b) for b in batches[:limit]]
+    return {
+        "object": "list",
+        "data": data,
+        "first_id": data[0]["id"] if data else None,
+        "last_id": data[-1]["id"] if data else None,
+        "has_more": len(batches) > limit,
+    }
+
+@router.get("/{batch_id}")
+async def retrieve_batch(batch_id: str, request: Request, session: AsyncSession = Depends(get_async_session)):
+    return batch_object(await _get_batch(session, request, batch_id))
+
+@router.post("/{batch_id}/cancel")
+async def cancel_batch(batch_id: str, request: Request, session: AsyncSession = Depends(get_async_session)):
+    batch = await _get_batch(session, request, batch_id)
+    if batch.status in TERMINAL_STATUSES or batch.status == "finalizing":
+        raise HTTPException(status_code=409, detail=f"batch is already {batch.status}")
+    if batch.status != "cancelling":
+        batch.status = "cancelling"
+        batch.cancelling_at = now_utc()
+        await session.commit()
+    # 処理済みの行は出力に残し、走行中の行は止める
+    batch_runner.cancel(batch_id)
+    return batch_object(batch)
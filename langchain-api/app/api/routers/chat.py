@@ -1,63 +1,109 @@
 from __future__ import annotations
-import asyncio, json, os
+import asyncio, json, os, time
 from typing import List, Literal, Optional, Dict, Any
-from fastapi import APIRouter, Request, HTTPException
+from fastapi import APIRouter, Depends, Request, HTTPException
 from fastapi.responses import JSONResponse, StreamingResponse
+from starlette.background import BackgroundTask
 from pydantic import BaseModel
+from sqlalchemy.ext.asyncio import AsyncSession
+from langchain_core.runnables.config import RunnableConfig
 from app.core.config import settings
+from app.db.session import get_async_session
+from app.services.admission import PRIORITY_INTERACTIVE, PRIORITY_LOW, AdmissionError, admit_request, client_key
+from app.services.aux_tasks import detect_aux_task
+from app.services.cancellation import ClientDisconnectedError, iterate_until_disconnect, run_until_disconnect
+from app.services.deadline import DeadlineExceededError, start_deadline, timeout_for, use_deadline
+from app.services.tenancy import memory_pipeline_for, tenant_id_for
+from app.services.journal import start_journal, use_journal
+from app.services.completions import ChatRequest, run_completion
+from app.services.resumable import stream_registry
 from app.services.providers import resolve_provider  # ルータ外表示用 (model name 統一のため)
-from app.graph.chat_graph import (
-    run_chat_graph,
-    stream_chat_graph,
-)
+from app.graph.chat_graph import stream_chat_graph
 
 router = APIRouter(prefix="/v1/chat", tags=["chat"])
 
-Role = Literal["system", "user", "assistant", "tool", "function"]
-
-class ChatMessage(BaseModel):
-    role: Role
-    content: str
-
-class ChatRequest(BaseModel):
-    model: Optional[str] = None
-    provider: Optional[str] = None   # 明示切替 (任意)
-    messages: List[ChatMessage]
-    temperature: Optional[float] = 0.7
-    top_p: Optional[float] = 1.0
-    max_tokens: Optional[int] = None
-    stream: Optional[bool] = True
-
-def completion_obj(content: str, model: str) -> Dict[str, Any]:
-    return {
-        "id": "chatcmpl-" + os.urandom(8).hex(),
-        "object": "chat.completion",
-        "created": int(asyncio.get_event_loop().time()),
-        "model": model,
-        "choices": [{
-            "index": 0,
-            "message": {"role": "assistant", "content": content},
-            "finish_reason": "stop",
-        }],
-    }
-
 async def sse_chunk(payload: Dict[str, Any]) -> str:
     return f"data: {json.dumps(payload, ensure_ascii=False)}\n\n"
 
 @router.post("/completions")
-async def chat_completions(req: ChatRequest, request: Request):
+async def chat_completions(req: ChatRequest, request: Request, session: AsyncSession = Depends(get_async_session)):
+    if req.stream:
+        # 切断前のストリームの続き (Last-Event-ID / X-Stream-Offset) なら再生成せずにバッファから返す
+        resumed = stream_registry.resume(request)
+        if resumed is not None:
+            return resumed
+    messages = [m.model_dump() for m in req.messages]
+    aux_task = detect_aux_task(messages)
+    config = RunnableConfig(session=session, tenant_id=tenant_id_for(request), aux_task=aux_task, memory_pipeline=memory_pipeline_for(request))
+    journal = start_journal("/v1/chat/completions", client_key(request))
+    deadline = start_deadline(timeout_for(request))
+    try:
+        lease = await admit_request(request, messages, req.max_tokens, PRIORITY_LOW if aux_task else PRIORITY_INTERACTIVE)
+    except AdmissionError as e:
+        journal.finish(e)
+        raise
+    journal.queue_ms = lease.queued_seconds * 1000
     # 非ストリーミング: Graph が実際の OpenAI/Ollama 呼び出しまで担当
     if not req.stream:
-        out = await run_chat_graph(req.model, [m.model_dump() for m in req.messages], req.temperature)
-        model_used = f"{out['provider']}:{out['model']}"
-        return JSONResponse(completion_obj(out.get("answer", ""), model_used))
+        try:
+            # 切断されたらグラフごと止める (main.py で 499 / 期限切れは 504)
+            out, body = await run_until_disconnect(request, run_completion(req, config))
+        except BaseException as e:
+            journal.finish(e)
+            raise
+        finally:
+            lease.release()
+        journal.finish()
+        headers = {
+            "X-Graph-Route": ",".join(out.get("route", [])),
+            "X-Request-Id": journal.request_id,
+            "Server-Timing": journal.server_timing(),
+        }
+        if out.get("degraded"):
+            headers["X-Degraded"] = "memory"
+        return JSONResponse(body, headers=headers)
+
+    include_usage = bool((req.stream_options or {}).get("include_usage"))
 
     # ストリーミング: Graph で準備→ provider 毎の chunk を SSE
     async def gen():
-        async for ev in stream_chat_graph(req.model, [m.model_dump() for m in req.messages], req.temperature):
-            # ev は provider 毎の chunk 形式を簡易統一 (既存 OpenAI 互換を期待)
-            if "choices" in ev:  # OpenAI / Ollama 風
-                yield await sse_chunk(ev)
-        yield "data: [DONE]\n\n"
+        use_journal(journal)
+        use_deadline(deadline)
+        error = None
+        try:
+            last = None
+            events = stream_chat_graph(req.model, messages, req.temperature, req.top_p, req.max_tokens, config=config)
+            if not stream_registry.enabled:
+                # 再開しないなら切断でグラフごと止める (再開可能なら猶予が切れるまで生成を続ける)
+                events = iterate_until_disconnect(request, events)
+            async for ev in events:
+                # ev は provider 毎の chunk 形式を簡易統一 (既存 OpenAI 互換を期待)
+                if "choices" in ev:  # OpenAI / Ollama 風
+                    last = ev
+                    yield await sse_chunk(ev)
+            if include_usage and last is not None:
+                yield await sse_chunk({**last, "choices": [], "usage": journal.usage()})
+            yield "data: [DONE]\n\n"
+        except ClientDisconnectedError as e:
+            # 送り先が無いので何も返さずに終える
+            error = e
+        except DeadlineExceededError as e:
+            error = e
+            yield await sse_chunk({"error": {"message": e.detail, "type": "timeout"}})
+            yield "data: [DONE]\n\n"
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            lease.release()
+            journal.finish(error)
 
-    return StreamingResponse(gen(), media_type="text/event-stream")
\ No newline at end of file
+    if stream_registry.enabled:
+        return stream_registry.open(request, gen(), "text/event-stream", {"X-Request-Id": journal.request_id}, on_done=lease.release)
+    # 生成が一度も回らずに切断された場合も枠を返す
+    return StreamingResponse(
+        gen(),
+        media_type="text/event-stream",
+        headers={"X-Request-Id": journal.request_id},
+        background=BackgroundTask(lease.release),
+    )
@@ -0,0 +1,10 @@
+from __future__ import annotations
+from fastapi import APIRouter, WebSocket
+from app.services.multiplex import MuxConnection
+
+router = APIRouter(prefix="/v1/chat", tags=["chat"])
+
+@router.websocket("/ws")
+async def chat_ws(websocket: WebSocket):
+    """1 接続で複数の chat.completions を多重化する。フレームの形式は app/services/multiplex.py を参照"""
+    await MuxConnection(websocket).serve()
@@ -0,0 +1,118 @@
+from __future__ import annotations
+import asyncio
+import contextlib
+import json
+import time
+from typing import Any, Dict, List, Literal, Optional, Union
+from fastapi import APIRouter, HTTPException, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+from starlette.background import BackgroundTask
+from pydantic import BaseModel
+from app.core.config import settings
+from app.services.admission import PRIORITY_INTERACTIVE, PRIORITY_LOW, AdmissionError, admission, client_key, estimate_tokens
+from app.services.embeddings import embedding_service, encode_base64
+from app.services.journal import start_journal, use_journal
+from app.services.providers import resolve_provider
+
+router = APIRouter(prefix="/v1", tags=["embeddings"])
+
+class EmbeddingRequest(BaseModel):
+    model: Optional[str] = None
+    input: Union[str, List[str]]
+    encoding_format: Literal["float", "base64"] = "float"
+    dimensions: Optional[int] = None  # Ollama では指定できないので無視する
+    user: Optional[str] = None
+
+def _item(index: int, vector: List[float], encoding_format: str) -> Dict[str, Any]:
+    embedding = encode_base64(vector) if encoding_format == "base64" else vector
+    return {"object": "embedding", "index": index, "embedding": embedding}
+
+def _usage(tokens: int) -> Dict[str, int]:
+    return {"prompt_tokens": tokens, "total_tokens": tokens}
+
+@router.post("/embeddings")
+async def create_embeddings(req: EmbeddingRequest, request: Request):
+    texts = [req.input] if isinstance(req.input, str) else req.input
+    if not texts:
+        raise HTTPException(status_code=400, detail="input must not be empty")
+    model_name = req.model or settings.EMBEDDING_DEFAULT_MODEL
+    provider, model = resolve_provider(model_name, None)
+    if provider != "ollama":
+        raise HTTPException(status_code=400, detail="only ollama embedding models are supported")
+
+    journal = start_journal("/v1/embeddings", client_key(request))
+    # 大きな配列は索引作成などの一括処理とみなして対話リクエストの後ろに並べる
+    large = len(texts) > settings.EMBEDDING_STREAM_THRESHOLD
+    try:
+        lease = await admission.admit(
+            client_key(request),
+            estimate_tokens([{"content": t} for t in texts], 1),
+            PRIORITY_LOW if large else PRIORITY_INTERACTIVE,
+        )
+    except AdmissionError as e:
+        journal.finish(e)
+        raise
+    journal.queue_ms = lease.queued_seconds * 1000
+    journal.provider, journal.model = provider, model
+
+    if not large:
+        started = time.perf_counter()
+        try:
+            vectors, tokens = await embedding_service.embed(model, texts)
+        except BaseException as e:
+            journal.finish(e)
+            raise
+        finally:
+            lease.release()
+        journal.record_llm_call(None, provider, model, (time.perf_counter() - started) * 1000, None, {"prompt_tokens": tokens})
+        journal.finish()
+        return JSONResponse(
+            {
+                "object": "list",
+                "data": [_item(i, v, req.encoding_format) for i, v in enumerate(vectors)],
+                "model": model_name,
+                "usage": _usage(tokens),
+            },
+            headers={"X-Request-Id": journal.request_id},
+        )
+
+    # 大きな入力: EMBEDDING_MAX_BATCH 件ずつ計算し、できた順に JSON の data 配列へ書き足していく。
+    # 次の塊は先に投げておくので、送信と上流の計算が重なる
+    chunk = max(1, settings.EMBEDDING_MAX_BATCH)
+
+    async def gen():
+        use_journal(journal)
+        error = None
+        tokens = 0
+        started = time.perf_counter()
+        upcoming: asyncio.Future | None = None
+        try:
+            yield '{"object":"list","data":['
+            upcoming = asyncio.ensure_future(embedding_service.embed(model, texts[:chunk]))
+            for start in range(0, len(texts), chunk):
+                vectors, used = await upcoming
+                upcoming = None
+                tokens += used
+                if start + chunk < len(texts):
+                    upcoming = asyncio.ensure_future(embedding_service.embed(model, texts[start + chunk:start + 2 * chunk]))
+                items = ",".join(json.dumps(_item(start + i, v, req.encoding_format)) for i, v in enumerate(vectors))
+                yield ("," if start else "") + items
+            yield f'],"model":{json.dumps(model_name)},"usage":{json.dumps(_usage(tokens))}}}'
+            journal.record_llm_call(None, provider, model, (time.perf_counter() - started) * 1000, None, {"prompt_tokens": tokens})
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            if upcoming is not None:
+                upcoming.cancel()
+                with contextlib.suppress(BaseException):
+                    await upcoming
+            lease.release()
+            journal.finish(error)
+
+    return StreamingResponse(
+        gen(),
+        media_type="application/json",
+        headers={"X-Request-Id": journal.request_id},
+        background=BackgroundTask(lease.release),
+    )
@@ -0,0 +1,88 @@
+from __future__ import annotations
+from fastapi import APIRouter, Depends, HTTPException, Request
+from fastapi.responses import Response
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import undefer
+from starlette.datastructures import UploadFile
+from app.core.config import settings
+from app.db.session import get_async_session
+from app.db.models.batch import BatchFile
+from app.services.admission import client_key
+from app.services.batches import file_object, new_file_id, visible_to
+from app.services.tenancy import tenant_id_for
+
+router = APIRouter(prefix="/v1/files", tags=["files"])
+
+FILE_PURPOSES = ("batch",)
+
+async def _get_file(session: AsyncSession, request: Request, file_id: str, with_content: bool = False) -> BatchFile:
+    f = await session.get(BatchFile, file_id, options=[undefer(BatchFile.content)] if with_content else None)
+    if f is None or not visible_to(f, tenant_id_for(request), client_key(request)):
+        raise HTTPException(status_code=404, detail="file not found")
+    return f
+
+@router.post("")
+async def upload_file(request: Request, session: AsyncSession = Depends(get_async_session)):
+    """OpenAI 互換の multipart アップロード (file, purpose)。今のところ purpose="batch" の JSONL だけを受け付ける"""
+    form = await request.form()
+    upload = form.get("file")
+    purpose = form.get("purpose")
+    if not isinstance(upload, UploadFile):
+        raise HTTPException(status_code=400, detail="file is required")
+    if purpose not in FILE_PURPOSES:
+        raise HTTPException(status_code=400, detail=f"purpose must be one of {list(FILE_PURPOSES)}")
+    data = await upload.read(settings.BATCH_MAX_FILE_BYTES + 1)
+    if len(data) > settings.BATCH_MAX_FILE_BYTES:
+        raise HTTPException(status_code=413, detail=f"file exceeds {settings.BATCH_MAX_FILE_BYTES} bytes")
+    try:
+        content = data.decode("utf-8")
+    except UnicodeDecodeError:
+        raise HTTPException(status_code=400, detail="file must be UTF-8 JSONL")
+    f = BatchFile(
+        id=new_file_id(),
+        tenant_id=tenant_id_for(request),
+        client_key=client_key(request),
+        purpose=purpose,
+        filename=upload.filename or "upload.jsonl",
+        bytes=len(data),
+        content=content,
+    )
+    session.add(f)
+    await session.commit()
+    await session.refresh(f)
+    return file_object(f)
+
+@router.get("")
+async def list_files(request: Request, purpose: str | None = None, session: AsyncSession = Depends(get_async_session)):
+    # content は deferred なので読まない
+    stmt = (
+        select(BatchFile)
+        .where(BatchFile.tenant_id == tenant_id_for(request))
+        .where(BatchFile.client_key == client_key(request))
+    ).order_by(BatchFile.created_at.desc())
+    if purpose:
+        stmt = stmt.where(BatchFile.purpose == purpose)
+    files = (await session.execute(stmt.execution_options(populate_existing=True))).scalars().all()
+    return {"object": "list", "data": [file_object(f) for f in files]}
+
+@router.get("/{file_id}")
+async def retrieve_file(file_id: str, request: Request, session: AsyncSession = Depends(get_async_session)):
+    return file_object(await _get_file(session, request, file_id))
+
+@router.get("/{file_id}/content")
+async def file_content(file_id: str, request: Request, session: AsyncSession = Depends(get_async_session)):
+    f = await _get_file(session, request, file_id, with_content=True)
+    return Response(f.content, media_type="application/jsonl", headers={"Content-Disposition": f'attachment; filename="{f.filename}"'})
+
+@router.delete("/{file_id}")
+async def delete_file(file_id: str, request: Request, session: AsyncSession = Depends(get_async_session)):
+    f = await _get_file(session, request, file_id)
+    await session.delete(f)
+    try:
+        await session.commit()
+    except IntegrityError:
+        await session.rollback()
+        raise HTTPException(status_code=409, detail="file is used by a batch")
+    return {"id": file_id, "object": "file", "deleted": True}
@@ -2,13 +2,21 @@ from __future__ import annotations
 import httpx, asyncio, json, time, datetime
 from fastapi import APIRouter, Depends, Request, Response
 from fastapi.responses import StreamingResponse, JSONResponse
+from starlette.background import BackgroundTask
 from app.core.config import settings
 from sqlalchemy.ext.asyncio import AsyncSession
 from langchain_core.runnables.config import RunnableConfig
 
 # LangGraph (プロバイダ分岐付き) を利用
 from app.db.session import get_async_session
-from app.graph.chat_graph import get_chat_graph
+from app.graph.chat_graph import get_chat_graph, memory_pipeline_mode
+from app.services.admission import PRIORITY_INTERACTIVE, PRIORITY_LOW, AdmissionError, admit_request, client_key
+from app.services.aux_tasks import detect_aux_task
+from app.services.cancellation import ClientDisconnectedError, iterate_until_disconnect, run_until_disconnect
+from app.services.resumable import stream_registry
+from app.services.deadline import DeadlineExceededError, start_deadline, timeout_for, use_deadline
+from app.services.tenancy import memory_pipeline_for, tenant_id_for
+from app.services.journal import RequestJournal, start_journal, use_journal
 
 router = APIRouter(prefix="/api", tags=["relay"])
 
@@ -25,27 +33,83 @@ async def relay_tags():
         return Response(content=content, status_code=r.status_code,
                         media_type=r.headers.get("content-type", "application/json"))
 
+# ---- 素通しレーン ----
+# ボディを解釈せず、上流とのバイト列をそのまま中継する。
+# StreamingResponse が送信し終えるまで次の aiter_raw() を読まないので、遅いクライアントには自然に背圧がかかる。
+_HOP_BY_HOP_HEADERS = {
+    "connection", "keep-alive", "proxy-authenticate", "proxy-authorization",
+    "te", "trailers", "transfer-encoding", "upgrade", "host", "content-length",
+}
+
+_upstream: httpx.AsyncClient | None = None
+def _upstream_client() -> httpx.AsyncClient:
+    global _upstream
+    if _upstream is None:
+        # pull などは長時間かかるので読み取りのタイムアウトは設けない
+        _upstream = httpx.AsyncClient(
+            base_url=settings.OLLAMA_BASE_URL,
+            timeout=httpx.Timeout(connect=10.0, read=None, write=None, pool=None),
+        )
+    return _upstream
+
+async def _passthrough(request: Request, path: str, content: bytes | None = None) -> Response:
+    client = _upstream_client()
+    headers = [(k, v) for k, v in request.headers.items() if k.lower() not in _HOP_BY_HOP_HEADERS]
+    upstream_request = client.build_request(
+        request.method,
+        "/api/" + path,
+        params=request.query_params,
+        headers=headers,
+        content=content if content is not None else request.stream(),
+    )
+    try:
+        r = await client.send(upstream_request, stream=True)
+    except httpx.TimeoutException:
+        return JSONResponse({"error": f"upstream timed out: /api/{path}"}, status_code=504)
+    except httpx.TransportError as e:
+        # 接続できない / 応答ヘッダ前に切られた
+        return JSONResponse({"error": f"upstream unavailable: {type(e).__name__}"}, status_code=502)
+    response_headers = {k: v for k, v in r.headers.items() if k.lower() not in _HOP_BY_HOP_HEADERS}
+    return StreamingResponse(
+        r.aiter_raw(),
+        status_code=r.status_code,
+        headers=response_headers,
+        background=BackgroundTask(r.aclose),
+    )
+
 @router.get("/version")
-async def relay_version():
-    async with httpx.AsyncClient(base_url=settings.OLLAMA_BASE_URL) as client:
-        r = await client.get("/api/version")
-        return Response(content=r.content, status_code=r.status_code,
-                        media_type=r.headers.get("content-type", "application/json"))
+async def relay_version(request: Request):
+    return await _passthrough(request, "version")
 
 @router.get("/ps")
-async def relay_ps():
-    async with httpx.AsyncClient(base_url=settings.OLLAMA_BASE_URL) as client:
-        r = await client.get("/api/ps")
-        return Response(content=r.content, status_code=r.status_code,
-                        media_type=r.headers.get("content-type", "application/json"))
+async def relay_ps(request: Request):
+    return await _passthrough(request, "ps")
 
 def _iso_now() -> str:
     return datetime.datetime.utcnow().isoformat(timespec="milliseconds") + "Z"
 
+def _ollama_stats(journal: RequestJournal) -> dict:
+    """Ollama の done 行に載せる統計。トークン数は最終回答の呼び出し分、total_duration はリクエスト全体"""
+    call = journal.final_call()
+    stats = {
+        "total_duration": int(journal.elapsed_ms() * 1e6),
+        "load_duration": call.get("load_duration"),
+        "prompt_eval_count": call.get("prompt_tokens"),
+        "prompt_eval_duration": call.get("prompt_eval_duration"),
+        "eval_count": call.get("completion_tokens"),
+        "eval_duration": call.get("eval_duration"),
+    }
+    return {k: v for k, v in stats.items() if v is not None}
+
 @router.post("/chat")
 async def relay_chat(request: Request, session: AsyncSession = Depends(get_async_session)):
     payload = await request.json()
     model = payload.get("model")
+    prefix = settings.PASSTHROUGH_MODEL_PREFIX
+    if prefix and isinstance(model, str) and model.startswith(prefix):
+        # 接頭辞付きモデルはグラフを通さずに Ollama へ素通しする
+        payload["model"] = model[len(prefix):]
+        return await _passthrough(request, "chat", json.dumps(payload, ensure_ascii=False).encode())
     messages = payload.get("messages")
     prompt = payload.get("prompt")
 
@@ -55,89 +119,164 @@ async def relay_chat(request: Request, session: AsyncSession = Depends(get_async
         return JSONResponse({"error": "messages or prompt required"}, status_code=400)
 
     stream = payload.get("stream", True)
-    temperature = (payload.get("options") or {}).get("temperature") or payload.get("temperature") or 0.7
-
-    graph = get_chat_graph()
+    if stream:
+        # 切断前のストリームの続き (X-Stream-Id + X-Stream-Offset) なら再生成せずにバッファから返す
+        resumed = stream_registry.resume(request)
+        if resumed is not None:
+            return resumed
+    options = payload.get("options") or {}
+    temperature = options.get("temperature") or payload.get("temperature") or 0.7
+    top_p = options.get("top_p")
+    max_tokens = options.get("num_predict")
+    if max_tokens is not None and max_tokens <= 0:
+        max_tokens = None  # Ollama の -1 / -2 は「上限なし」
 
-    config = RunnableConfig(session=session)
+    aux_task = detect_aux_task(messages)
+    config = RunnableConfig(session=session, tenant_id=tenant_id_for(request), aux_task=aux_task, memory_pipeline=memory_pipeline_for(request))
+    graph = get_chat_graph(memory_pipeline_mode(config))
+    journal = start_journal("/api/chat", client_key(request))
+    deadline = start_deadline(timeout_for(request))
+    try:
+        lease = await admit_request(request, messages, max_tokens, PRIORITY_LOW if aux_task else PRIORITY_INTERACTIVE)
+    except AdmissionError as e:
+        journal.finish(e)
+        raise
+    journal.queue_ms = lease.queued_seconds * 1000
 
     if not stream:
         init_state = {
             "model": model,
             "raw_messages": messages,
             "temperature": temperature,
+            "top_p": top_p,
+            "max_tokens": max_tokens,
             "stream": False,
         }
-        out = await graph.ainvoke(init_state, config=config)
+        try:
+            out = await run_until_disconnect(request, graph.ainvoke(init_state, config=config))
+        except BaseException as e:
+            journal.finish(e)
+            raise
+        finally:
+            lease.release()
+        journal.record_state(out)
+        journal.finish()
         answer = out.get("answer", "")
         resp = {
             "model": f"{out['provider']}:{out['model']}",
             "created_at": _iso_now(),
             "message": {"role": "assistant", "content": answer},
             "done": True,
-            "total_duration": 0,
+            **_ollama_stats(journal),
         }
-        return JSONResponse(resp)
+        headers = {
+            "X-Graph-Route": ",".join(out.get("route", [])),
+            "X-Request-Id": journal.request_id,
+            "Server-Timing": journal.server_timing(),
+        }
+        if out.get("degraded"):
+            headers["X-Degraded"] = "memory"
+        return JSONResponse(resp, headers=headers)
 
     async def gen():
-        start = time.perf_counter()
-        init_state = {
-            "model": model,
-            "raw_messages": messages,
-            "temperature": temperature,
-            "stream": True,
-        }
-        full = ""
-        async for namespace, mode, data in graph.astream(init_state, stream_mode=["custom", "values"], subgraphs=True, config=config):
-            if mode == "custom":
-                if data.get("event_name") != "token":
-                    continue
-                delta = data.get("delta")
-                if not delta:
-                    continue
-                full += delta
-                # Ollama /api/chat 互換: chunk は message + done:false
-                chunk = {
-                    "model": f"{data.get('provider')}:{data.get('model')}",
-                    "created_at": _iso_now(),
-                    "message": {"role": "assistant", "content": delta},
-                    "done": False,
-                }
-                yield (json.dumps(chunk, ensure_ascii=False) + "\n").encode()
-            elif mode == "values":
-                # 最終スナップショット (answer が state に格納)
-                # if "answer" not in data:
-                #     continue
-                # final_answer = data["answer"]
-                # full = final_answer  # 念のため同期
-                # final_line = {
-                #     "model": f"{data.get('provider')}:{data.get('model')}",
-                #     "created_at": _iso_now(),
-                #     # 最終行で全文をもう一度 message で流したい場合は以下を有効に:
-                #     "message": {"role": "assistant", "content": final_answer},
-                #     "done": False,
-                #     "total_duration": int((time.perf_counter() - start) * 1e9),
-                # }
-                # yield (json.dumps(final_line, ensure_ascii=False) + "\n").encode()
-                pass
-
-        # 念のため done:true が未送出なら送る (冪等)
-        # （上の values ブロックで送れていればこの分はクライアント側で無視される）
-        tail = {
-            "model": f"{data.get('provider')}:{data.get('model')}",
-            "created_at": _iso_now(),
-            "message": {"role": "assistant", "content": ""},
-            "done": True,
-            "total_duration": int((time.perf_counter() - start) * 1e9),
-        }
-        yield (json.dumps(tail, ensure_ascii=False) + "\n").encode()
+        use_journal(journal)
+        use_deadline(deadline)
+        error = None
+        try:
+            start = time.perf_counter()
+            init_state = {
+                "model": model,
+                "raw_messages": messages,
+                "temperature": temperature,
+                "top_p": top_p,
+                "max_tokens": max_tokens,
+                "stream": True,
+            }
+            full = ""
+            final_state = {}
+            events = graph.astream(init_state, stream_mode=["custom", "values"], subgraphs=True, config=config)
+            if not stream_registry.enabled:
+                # 再開しないなら切断でグラフごと止める (再開可能なら猶予が切れるまで生成を続ける)
+                events = iterate_until_disconnect(request, events)
+            async for namespace, mode, data in events:
+                if mode == "custom":
+                    if data.get("event_name") != "token":
+                        continue
+                    delta = data.get("delta")
+                    if not delta:
+                        continue
+                    full += delta
+                    # Ollama /api/chat 互換: chunk は message + done:false
+                    chunk = {
+                        "model": f"{data.get('provider')}:{data.get('model')}",
+                        "created_at": _iso_now(),
+                        "message": {"role": "assistant", "content": delta},
+                        "done": False,
+                    }
+                    yield (json.dumps(chunk, ensure_ascii=False) + "\n").encode()
+                elif mode == "values":
+                    final_state = data
+                    # 最終スナップショット (answer が state に格納)
+                    # if "answer" not in data:
+                    #     continue
+                    # final_answer = data["answer"]
+                    # full = final_answer  # 念のため同期
+                    # final_line = {
+                    #     "model": f"{data.get('provider')}:{data.get('model')}",
+                    #     "created_at": _iso_now(),
+                    #     # 最終行で全文をもう一度 message で流したい場合は以下を有効に:
+                    #     "message": {"role": "assistant", "content": final_answer},
+                    #     "done": False,
+                    #     "total_duration": int((time.perf_counter() - start) * 1e9),
+                    # }
+                    # yield (json.dumps(final_line, ensure_ascii=False) + "\n").encode()
+                    pass
 
+            # 念のため done:true が未送出なら送る (冪等)
+            # （上の values ブロックで送れていればこの分はクライアント側で無視される）
+            journal.record_state(final_state)
+            tail = {
+                "model": f"{data.get('provider')}:{data.get('model')}",
+                "created_at": _iso_now(),
+                "message": {"role": "assistant", "content": ""},
+                "done": True,
+                **_ollama_stats(journal),
+                "total_duration": int((time.perf_counter() - start) * 1e9),
+            }
+            if final_state.get("degraded"):
+                tail["degraded"] = True
+            yield (json.dumps(tail, ensure_ascii=False) + "\n").encode()
+        except ClientDisconnectedError as e:
+            # 送り先が無いので何も返さずに終える
+            error = e
+        except DeadlineExceededError as e:
+            error = e
+            # Ollama のストリーム中のエラー行と同じ形
+            yield (json.dumps({"error": e.detail}, ensure_ascii=False) + "\n").encode()
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            lease.release()
+            journal.finish(error)
+
+    headers = {
+        "Cache-Control": "no-cache",
+        "Connection": "keep-alive",
+        "X-Accel-Buffering": "no",
+        "X-Request-Id": journal.request_id,
+    }
+    if stream_registry.enabled:
+        return stream_registry.open(request, gen(), "application/x-ndjson", headers, on_done=lease.release)
     return StreamingResponse(
         gen(),
         media_type="application/x-ndjson",
-        headers={
-            "Cache-Control": "no-cache",
-            "Connection": "keep-alive",
-            "X-Accel-Buffering": "no",
-        },
+        headers=headers,
+        background=BackgroundTask(lease.release),
     )
+
+@router.api_route("/{path:path}", methods=["GET", "POST", "DELETE", "HEAD"])
+async def relay_passthrough(path: str, request: Request):
+    if path.split("/", 1)[0] not in settings.PASSTHROUGH_PATHS:
+        return JSONResponse({"error": f"unsupported endpoint: /api/{path}"}, status_code=404)
+    return await _passthrough(request, path)
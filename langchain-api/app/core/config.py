@@ -1,4 +1,5 @@
 from __future__ import annotations
+import json
 import os
 
 class Settings:
@@ -9,5 +10,184 @@ class Settings:
     OPENAI_API_KEY: str | None = os.getenv("OPENAI_API_KEY")
     OPENAI_BASE_URL: str = os.getenv("OPENAI_BASE_URL", "https://api.openai.com/v1")
     DEFAULT_PROVIDER: str = os.getenv("DEFAULT_PROVIDER", "ollama")  # "openai" or "ollama"
+    # OpenAI クライアント (プロセスで共有)。再試行は SDK 側で行い、それでも駄目ならフォールバックに回る
+    OPENAI_TIMEOUT: float = float(os.getenv("OPENAI_TIMEOUT", "300"))
+    OPENAI_CONNECT_TIMEOUT: float = float(os.getenv("OPENAI_CONNECT_TIMEOUT", "10"))
+    OPENAI_MAX_RETRIES: int = int(os.getenv("OPENAI_MAX_RETRIES", "1"))
+    # temperature / top_p を送らないモデル (前方一致, カンマ区切り)。ここに無くても拒否されたら自動で外す
+    OPENAI_FIXED_SAMPLING_MODELS: str = os.getenv("OPENAI_FIXED_SAMPLING_MODELS", "o1,o3,o4,gpt-5")
+    OPENAI_STRUCTURED_STREAM: bool = os.getenv("OPENAI_STRUCTURED_STREAM", "1") == "1"  # 構造化出力もストリームで受ける
 
-settings = Settings()
\ No newline at end of file
+    # LLM 呼び出しの耐障害性 (秒)
+    LLM_TTFT_TIMEOUT: float = float(os.getenv("LLM_TTFT_TIMEOUT", "60"))     # 最初のトークンまでの上限
+    LLM_TOTAL_TIMEOUT: float = float(os.getenv("LLM_TOTAL_TIMEOUT", "300"))  # 1 呼び出し全体の上限
+    LLM_HEDGE_DELAY: float = float(os.getenv("LLM_HEDGE_DELAY", "0"))        # 0 以下ならヘッジしない (ストリームの最初のトークン待ちだけ)
+    LLM_FALLBACK_MODEL: str = os.getenv("LLM_FALLBACK_MODEL", "")            # 例: "openai:gpt-5-nano"
+    LLM_BREAKER_FAILURE_THRESHOLD: int = int(os.getenv("LLM_BREAKER_FAILURE_THRESHOLD", "3"))
+    LLM_BREAKER_RESET_TIMEOUT: float = float(os.getenv("LLM_BREAKER_RESET_TIMEOUT", "30"))
+
+    # リクエスト全体の期限 (秒)。ヘッダで指定でき、各ノード / LLM 呼び出しのタイムアウトは残り時間で切り詰める。0 以下で期限なし
+    REQUEST_TIMEOUT_HEADER: str = os.getenv("REQUEST_TIMEOUT_HEADER", "X-Request-Timeout")
+    REQUEST_DEFAULT_TIMEOUT: float = float(os.getenv("REQUEST_DEFAULT_TIMEOUT", "0"))
+    REQUEST_MAX_TIMEOUT: float = float(os.getenv("REQUEST_MAX_TIMEOUT", "0"))
+    # 残り時間がこれを切ったらメモリ段階を打ち切って最終回答へ進む
+    DEADLINE_ANSWER_RESERVE: float = float(os.getenv("DEADLINE_ANSWER_RESERVE", "15"))
+
+    # ノード毎のモデル / 出力上限 (メモリ系の補助ノードは小さいモデルで十分)
+    MEMORY_NODE_MODEL: str = os.getenv("MEMORY_NODE_MODEL", "")  # 例: "ollama:qwen2.5:1.5b" 空ならリクエストのモデル
+    # 0 は上限なし。補助ノードはどれも構造化出力なので、途中で切れると JSON が壊れてメモリ段階ごと失敗する
+    MEMORY_NODE_MAX_TOKENS: int = int(os.getenv("MEMORY_NODE_MAX_TOKENS", "0"))
+    # ノード単位の上書き。JSON 例: {"ask_updated_memories_node": {"model": "ollama:qwen2.5:3b", "max_tokens": 1024, "history": "compact"}}
+    NODE_ROUTES: dict = json.loads(os.getenv("NODE_ROUTES") or "{}")
+
+    # 会話履歴の渡し方。"full": 全履歴 / "compact": 直近 HISTORY_KEEP_TURNS 往復より前を要約 1 件に置き換える
+    # ノード毎には NODE_ROUTES[node]["history"] で上書きする
+    HISTORY_MODE: str = os.getenv("HISTORY_MODE", "full")
+    HISTORY_KEEP_TURNS: int = int(os.getenv("HISTORY_KEEP_TURNS", "4"))
+    HISTORY_MIN_COMPACT_MESSAGES: int = int(os.getenv("HISTORY_MIN_COMPACT_MESSAGES", "6"))  # 要約対象がこれ未満なら置き換えない
+    HISTORY_SUMMARY_MODEL: str = os.getenv("HISTORY_SUMMARY_MODEL", "")  # 空なら MEMORY_NODE_MODEL、それも空なら DEFAULT_MODEL
+    HISTORY_SUMMARY_MAX_TOKENS: int = int(os.getenv("HISTORY_SUMMARY_MAX_TOKENS", "512"))
+    HISTORY_SUMMARY_CACHE_SIZE: int = int(os.getenv("HISTORY_SUMMARY_CACHE_SIZE", "1000"))
+    HISTORY_SUMMARY_CONCURRENCY: int = int(os.getenv("HISTORY_SUMMARY_CONCURRENCY", "2"))  # 同時に走らせる要約の更新数
+    # compact 時の履歴のトークン上限 (0 で無制限)。モデル毎は JSON 例: {"ollama:llama3.1": 6000}
+    HISTORY_TOKEN_BUDGET: int = int(os.getenv("HISTORY_TOKEN_BUDGET", "0"))
+    HISTORY_TOKEN_BUDGETS: dict = json.loads(os.getenv("HISTORY_TOKEN_BUDGETS") or "{}")
+
+    # 語義取得で解放する memory_simplicity の上限 (0 / 500 / 1000)
+    MAX_MEMORY_SIMPLICITY: int = int(os.getenv("MAX_MEMORY_SIMPLICITY", "1000"))
+
+    # 受付制御 (クライアント毎のトークン数クォータ / 同時実行数 / 待ち行列)
+    ADMISSION_ENABLED: bool = os.getenv("ADMISSION_ENABLED", "1") == "1"
+    ADMISSION_MAX_CONCURRENCY: int = int(os.getenv("ADMISSION_MAX_CONCURRENCY", "4"))
+    ADMISSION_MAX_QUEUE: int = int(os.getenv("ADMISSION_MAX_QUEUE", "32"))
+    ADMISSION_TARGET_QUEUE_DELAY: float = float(os.getenv("ADMISSION_TARGET_QUEUE_DELAY", "20"))  # 秒。見込みがこれを超えたら 503
+    ADMISSION_INITIAL_SERVICE_TIME: float = float(os.getenv("ADMISSION_INITIAL_SERVICE_TIME", "5"))
+    ADMISSION_BUCKET_CAPACITY: float = float(os.getenv("ADMISSION_BUCKET_CAPACITY", "200000"))   # トークン
+    ADMISSION_REFILL_PER_SEC: float = float(os.getenv("ADMISSION_REFILL_PER_SEC", "2000"))       # トークン/秒
+    ADMISSION_DEFAULT_COMPLETION_TOKENS: int = int(os.getenv("ADMISSION_DEFAULT_COMPLETION_TOKENS", "512"))
+    ADMISSION_PROMPT_MULTIPLIER: float = float(os.getenv("ADMISSION_PROMPT_MULTIPLIER", "4"))    # 1 ターンで prefill される回数の目安
+    ADMISSION_MAX_CLIENTS: int = int(os.getenv("ADMISSION_MAX_CLIENTS", "10000"))
+    ADMISSION_CLIENT_HEADER: str = os.getenv("ADMISSION_CLIENT_HEADER", "X-OpenWebUI-User-Id")
+    # ADMISSION_CLIENT_HEADER / X-Forwarded-For を信じる。どちらも認証の無いヘッダなので、
+    # Open WebUI (やそれを通すリバースプロキシ) の背後に置き、直接は到達できないときだけ 1 にする
+    ADMISSION_TRUST_FORWARDED: bool = os.getenv("ADMISSION_TRUST_FORWARDED", "0") == "1"
+
+    # 素通し (ゲートウェイ処理なし) で Ollama に中継する /api/* のエンドポイントとモデル接頭辞
+    PASSTHROUGH_PATHS: set[str] = set(
+        p.strip() for p in os.getenv("PASSTHROUGH_PATHS", "generate,embed,embeddings,show,pull,version,ps").split(",") if p.strip()
+    )
+    PASSTHROUGH_MODEL_PREFIX: str = os.getenv("PASSTHROUGH_MODEL_PREFIX", "raw:")  # 例: model="raw:llama3.1" は /api/chat も素通し
+
+    # リクエストジャーナル (バッファしてバッチで Postgres に書き込む)
+    JOURNAL_ENABLED: bool = os.getenv("JOURNAL_ENABLED", "1") == "1"
+    JOURNAL_BUFFER_SIZE: int = int(os.getenv("JOURNAL_BUFFER_SIZE", "1000"))
+    JOURNAL_BATCH_SIZE: int = int(os.getenv("JOURNAL_BATCH_SIZE", "100"))
+    JOURNAL_FLUSH_INTERVAL: float = float(os.getenv("JOURNAL_FLUSH_INTERVAL", "2"))
+
+    # 管理用 (未設定なら /v1/admin/* とプロファイル用ヘッダは無効)
+    ADMIN_TOKEN: str = os.getenv("ADMIN_TOKEN", "")
+    PROFILE_INTERVAL_MS: float = float(os.getenv("PROFILE_INTERVAL_MS", "5"))
+    PROFILE_MAX_SECONDS: float = float(os.getenv("PROFILE_MAX_SECONDS", "60"))
+
+    # トラフィックキャプチャ (空なら無効)。scripts/replay_capture.py で再生できる
+    CAPTURE_PATH: str = os.getenv("CAPTURE_PATH", "")  # 例: "/data/capture.ndjson"
+    CAPTURE_ANONYMIZE: bool = os.getenv("CAPTURE_ANONYMIZE", "1") == "1"
+    CAPTURE_BUFFER_SIZE: int = int(os.getenv("CAPTURE_BUFFER_SIZE", "1000"))
+
+    # 論理削除済みメモリの退避ジョブ (app/jobs/compact_memories.py)
+    COMPACTION_INTERVAL_SECONDS: float = float(os.getenv("COMPACTION_INTERVAL_SECONDS", "86400"))  # 0 以下で定期実行しない
+    COMPACTION_RETENTION_DAYS: float = float(os.getenv("COMPACTION_RETENTION_DAYS", "30"))
+    COMPACTION_BATCH_SIZE: int = int(os.getenv("COMPACTION_BATCH_SIZE", "500"))
+    COMPACTION_BATCH_PAUSE: float = float(os.getenv("COMPACTION_BATCH_PAUSE", "0.2"))  # バッチ間の休み (秒)
+    COMPACTION_LOCK_TIMEOUT: float = float(os.getenv("COMPACTION_LOCK_TIMEOUT", "2"))   # 秒
+    COMPACTION_REINDEX: bool = os.getenv("COMPACTION_REINDEX", "0") == "1"
+
+    # メモリのテナント (ユーザ) 分離。ヘッダが無いリクエストは DEFAULT_TENANT を使う
+    # Open WebUI は ENABLE_FORWARD_USER_INFO_HEADERS=true で X-OpenWebUI-User-Id を付ける。空にすると全員で共有
+    TENANT_HEADER: str = os.getenv("TENANT_HEADER", "X-OpenWebUI-User-Id")
+    DEFAULT_TENANT: str = os.getenv("DEFAULT_TENANT", "default")
+
+    # 直近 MEMORY_PRECHECK_TURNS 件のユーザ発言にカタログの名称も記憶の依頼も無ければ、LLM を呼ぶメモリ段階を飛ばす
+    MEMORY_PRECHECK: bool = os.getenv("MEMORY_PRECHECK", "1") == "1"
+    MEMORY_PRECHECK_TURNS: int = int(os.getenv("MEMORY_PRECHECK_TURNS", "2"))
+
+    # メモリカタログの渡し方。"flat": 全 title を列挙 / "hierarchical": 親を持たないメモリを子の要約付きで列挙し、枝は要求されたときだけ展開する
+    MEMORY_CATALOGUE_MODE: str = os.getenv("MEMORY_CATALOGUE_MODE", "flat")
+    # 子の要約を作り直すバックグラウンドタスク (app/jobs/summarize_memories.py)。hierarchical のときだけ動く
+    MEMORY_SUMMARY_INTERVAL_SECONDS: float = float(os.getenv("MEMORY_SUMMARY_INTERVAL_SECONDS", "60"))
+    MEMORY_SUMMARY_BATCH_SIZE: int = int(os.getenv("MEMORY_SUMMARY_BATCH_SIZE", "20"))
+    MEMORY_SUMMARY_MODEL: str = os.getenv("MEMORY_SUMMARY_MODEL", "")  # 空なら MEMORY_NODE_MODEL、それも空なら DEFAULT_MODEL
+    MEMORY_SUMMARY_MAX_TOKENS: int = int(os.getenv("MEMORY_SUMMARY_MAX_TOKENS", "256"))
+    MEMORY_SUMMARY_MAX_CHILDREN: int = int(os.getenv("MEMORY_SUMMARY_MAX_CHILDREN", "50"))  # 要約の入力に使う子の上限
+
+    # /v1/files + /v1/batches (夜間の一括処理)。対話リクエストを優先し、空いた枠だけを使う
+    BATCH_CONCURRENCY: int = int(os.getenv("BATCH_CONCURRENCY", "2"))                   # 同時に処理する行数
+    BATCH_PAUSE_WHEN_INTERACTIVE: int = int(os.getenv("BATCH_PAUSE_WHEN_INTERACTIVE", "1"))  # 対話リクエストがこの件数以上走っていたら新しい行を始めない (0 で無効)
+    BATCH_POLL_INTERVAL: float = float(os.getenv("BATCH_POLL_INTERVAL", "5"))
+    BATCH_REQUEST_TIMEOUT: float = float(os.getenv("BATCH_REQUEST_TIMEOUT", "600"))     # 1 行あたりの期限 (秒)
+    BATCH_MAX_RETRIES: int = int(os.getenv("BATCH_MAX_RETRIES", "3"))                   # LLM が全滅したときの再試行回数
+    BATCH_MAX_FILE_BYTES: int = int(os.getenv("BATCH_MAX_FILE_BYTES", str(100 * 1024 * 1024)))
+    BATCH_MAX_LINES: int = int(os.getenv("BATCH_MAX_LINES", "50000"))
+
+    # /v1/embeddings (Ollama /api/embed)。同時に来た入力は短い窓でまとめて 1 回の呼び出しにする
+    EMBEDDING_DEFAULT_MODEL: str = os.getenv("EMBEDDING_DEFAULT_MODEL", "nomic-embed-text")
+    EMBEDDING_BATCH_WINDOW_MS: float = float(os.getenv("EMBEDDING_BATCH_WINDOW_MS", "5"))
+    EMBEDDING_MAX_BATCH: int = int(os.getenv("EMBEDDING_MAX_BATCH", "64"))              # 1 回の上流呼び出しに載せる入力数
+    EMBEDDING_TIMEOUT: float = float(os.getenv("EMBEDDING_TIMEOUT", "120"))
+    EMBEDDING_CACHE_SIZE: int = int(os.getenv("EMBEDDING_CACHE_SIZE", "5000"))          # プロセス内 LRU の件数 (0 で無効)
+    EMBEDDING_CACHE_PERSIST: bool = os.getenv("EMBEDDING_CACHE_PERSIST", "0") == "1"   # embedding_cache テーブルにも残す
+    EMBEDDING_STREAM_THRESHOLD: int = int(os.getenv("EMBEDDING_STREAM_THRESHOLD", "256"))  # これより多い入力は分割して逐次返す
+
+    # Postgres のタイムアウト (秒)。メモリ段階は DB が無くても回答できるので短めに切り、失敗が続いたらブレーカーで飛ばす
+    DB_CONNECT_TIMEOUT: float = float(os.getenv("DB_CONNECT_TIMEOUT", "5"))
+    DB_ACQUIRE_TIMEOUT: float = float(os.getenv("DB_ACQUIRE_TIMEOUT", "10"))       # プールから接続を借りるまで
+    DB_STATEMENT_TIMEOUT: float = float(os.getenv("DB_STATEMENT_TIMEOUT", "0"))    # サーバ側 statement_timeout (0 で設定しない)
+    DB_MEMORY_TIMEOUT: float = float(os.getenv("DB_MEMORY_TIMEOUT", "3"))          # メモリ段階の 1 操作 (接続の取得を含む)
+    DB_BREAKER_FAILURE_THRESHOLD: int = int(os.getenv("DB_BREAKER_FAILURE_THRESHOLD", "3"))
+    DB_BREAKER_RESET_TIMEOUT: float = float(os.getenv("DB_BREAKER_RESET_TIMEOUT", "30"))
+    # DB が使えない間のメモリ書き込みはここに溜め、復旧後に書き戻す
+    DB_WRITE_QUEUE_SIZE: int = int(os.getenv("DB_WRITE_QUEUE_SIZE", "1000"))
+    DB_WRITE_RETRY_INTERVAL: float = float(os.getenv("DB_WRITE_RETRY_INTERVAL", "5"))
+
+    # Open WebUI のタイトル / タグ / フォローアップ生成などの補助タスク。メモリ段階を飛ばし、小さいモデル・低優先度で処理する
+    AUX_TASK_DETECTION: bool = os.getenv("AUX_TASK_DETECTION", "1") == "1"
+    AUX_TASK_MODEL: str = os.getenv("AUX_TASK_MODEL", "")  # 例: "ollama:qwen2.5:1.5b" 空ならリクエストのモデル
+    AUX_TASK_MAX_TOKENS: int = int(os.getenv("AUX_TASK_MAX_TOKENS", "256"))
+    AUX_TASK_EXTRA_MARKERS: str = os.getenv("AUX_TASK_EXTRA_MARKERS", "")  # 補助タスクとみなす文字列 (カンマ区切り)
+
+    # 再開可能なストリーム。切断後もこの秒数は生成を続けてバッファし、Last-Event-ID / X-Stream-Offset で続きを返す (0 で無効)
+    # 有効にすると切断 / 停止で生成が止まらなくなる (猶予の間は受付枠と DB セッションも保持する) ので既定は無効
+    STREAM_RESUME_GRACE: float = float(os.getenv("STREAM_RESUME_GRACE", "0"))
+    STREAM_BUFFER_MAX_BYTES: int = int(os.getenv("STREAM_BUFFER_MAX_BYTES", str(1024 * 1024)))          # 1 ストリームのリングバッファ
+    STREAM_BUFFER_BUDGET_BYTES: int = int(os.getenv("STREAM_BUFFER_BUDGET_BYTES", str(64 * 1024 * 1024)))  # 全ストリームの合計
+
+    # 投機的な最終回答。メモリ段階と並行して素の会話で生成を始め、差し込む語義が無ければそのまま採用する
+    # (Ollama への同時呼び出しが増えるので既定は無効)
+    SPECULATIVE_ANSWER: bool = os.getenv("SPECULATIVE_ANSWER", "0") == "1"
+
+    # /v1/chat/ws: 1 本の WebSocket に複数のチャットを多重化する
+    WS_MAX_STREAMS_PER_CONNECTION: int = int(os.getenv("WS_MAX_STREAMS_PER_CONNECTION", "1024"))
+    WS_INITIAL_CREDITS: int = int(os.getenv("WS_INITIAL_CREDITS", "256"))  # start で credits を省略したときに送れる chunk 数
+    WS_CREDIT_TIMEOUT: float = float(os.getenv("WS_CREDIT_TIMEOUT", "30"))  # クレジット切れのストリームを待つ上限 (受付枠を握ったままなので必ず打ち切る)
+    WS_SEND_QUEUE_SIZE: int = int(os.getenv("WS_SEND_QUEUE_SIZE", "1024"))  # 接続毎の送信待ちフレーム数
+
+    # 最終回答の意味キャッシュ。最後のユーザ発言の埋め込みが近く、差し込んだメモリも同じなら前回の回答を返す (既定は無効)
+    SEMANTIC_CACHE: bool = os.getenv("SEMANTIC_CACHE", "0") == "1"
+    SEMANTIC_CACHE_EMBEDDING_MODEL: str = os.getenv("SEMANTIC_CACHE_EMBEDDING_MODEL", "")  # 空なら EMBEDDING_DEFAULT_MODEL
+    SEMANTIC_CACHE_EMBED_TIMEOUT: float = float(os.getenv("SEMANTIC_CACHE_EMBED_TIMEOUT", "2"))
+    SEMANTIC_CACHE_THRESHOLD: float = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.95"))  # コサイン類似度
+    SEMANTIC_CACHE_THRESHOLDS: dict = json.loads(os.getenv("SEMANTIC_CACHE_THRESHOLDS") or "{}")  # 例: {"ollama:llama3.1": 0.97}
+    SEMANTIC_CACHE_TTL: float = float(os.getenv("SEMANTIC_CACHE_TTL", "3600"))
+    SEMANTIC_CACHE_MAX_ENTRIES: int = int(os.getenv("SEMANTIC_CACHE_MAX_ENTRIES", "10000"))
+    SEMANTIC_CACHE_MAX_USER_TURNS: int = int(os.getenv("SEMANTIC_CACHE_MAX_USER_TURNS", "1"))  # これより長い会話は文脈次第なので対象外
+    SEMANTIC_CACHE_REGENERATE_WINDOW: float = float(os.getenv("SEMANTIC_CACHE_REGENERATE_WINDOW", "300"))  # キャッシュから返した質問がこの秒数内に再送されたら作り直す
+    SEMANTIC_CACHE_LSH_TABLES: int = int(os.getenv("SEMANTIC_CACHE_LSH_TABLES", "4"))
+    SEMANTIC_CACHE_LSH_BITS: int = int(os.getenv("SEMANTIC_CACHE_LSH_BITS", "10"))
+
+    # メモリ段階の進め方。"staged": 語の抽出 / 追加の語 / 記録の更新を別々に尋ねる (構造化出力 3 回)
+    # "planner": 1 回の構造化出力でまとめて決め、DB の参照と書き込みはその結果から行う
+    #   (既存の記録を更新 / 削除するターンは内容を読ませてから尋ね直すので 2 回。書き込まれる内容は staged と同じ条件で決まる)
+    MEMORY_PIPELINE_MODE: str = os.getenv("MEMORY_PIPELINE_MODE", "staged")
+    MEMORY_PIPELINE_HEADER: str = os.getenv("MEMORY_PIPELINE_HEADER", "X-Memory-Pipeline")  # リクエスト毎の上書き (比較用)。空で無効
+
+settings = Settings()
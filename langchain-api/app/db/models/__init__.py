@@ -1 +1,6 @@
-from .memory import Memory, MemoryRelation  # noqa: F401
\ No newline at end of file
+from .memory import Memory, MemoryRelation  # noqa: F401
+from .journal import RequestJournalEntry  # noqa: F401
+from .archive import ArchivedMemory  # noqa: F401
+from .merge_log import MemoryMerge  # noqa: F401
+from .batch import Batch, BatchFile, BatchResult  # noqa: F401
+from .embedding import EmbeddingCacheEntry  # noqa: F401
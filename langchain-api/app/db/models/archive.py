@@ -0,0 +1,27 @@
+from __future__ import annotations
+from sqlalchemy import String, Integer, DateTime, JSON, func
+from sqlalchemy.orm import Mapped, mapped_column
+from app.db.session import Base
+
+class ArchivedMemory(Base):
+    """
+    論理削除から保持期間を過ぎて memories から退避したメモリ。
+    id は元の memories.id をそのまま使い、外していた親子関係も relations に残す (手で戻せるように)。
+    """
+    __tablename__ = "memories_archive"
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=False)
+    tenant_id: Mapped[str] = mapped_column(String(64), nullable=False, server_default="default")
+    title: Mapped[str] = mapped_column(String(255), index=True, nullable=False)
+    content: Mapped[str] = mapped_column(String, nullable=False)
+    source_url: Mapped[str | None] = mapped_column(String(500), nullable=True)
+    memory_simplicity: Mapped[int] = mapped_column(Integer, nullable=False, server_default="0")
+    created_at: Mapped["DateTime"] = mapped_column(DateTime(timezone=True), nullable=False)
+    updated_at: Mapped["DateTime"] = mapped_column(DateTime(timezone=True), nullable=False)
+    deleted_at: Mapped["DateTime"] = mapped_column(DateTime(timezone=True), nullable=False)
+    archived_at: Mapped["DateTime"] = mapped_column(
+        DateTime(timezone=True),
+        server_default=func.now(),
+        nullable=False
+    )
+    relations: Mapped[list] = mapped_column(JSON, nullable=False, default=list)  # [{parent_id, child_id, relation}]
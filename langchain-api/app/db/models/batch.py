@@ -0,0 +1,79 @@
+from __future__ import annotations
+from sqlalchemy import String, Integer, DateTime, JSON, ForeignKey, UniqueConstraint, func
+from sqlalchemy.orm import Mapped, mapped_column
+from app.db.session import Base
+
+class BatchFile(Base):
+    """/v1/files でアップロードされたファイル (バッチの入力 JSONL) と、バッチが書き出した結果 JSONL"""
+    __tablename__ = "batch_files"
+
+    id: Mapped[str] = mapped_column(String(64), primary_key=True)  # "file-..."
+    tenant_id: Mapped[str] = mapped_column(String(64), index=True, nullable=False, server_default="default")
+    client_key: Mapped[str | None] = mapped_column(String(255), nullable=True)  # 作成者 (admission.client_key)。出力はバッチの作成者
+    purpose: Mapped[str] = mapped_column(String(32), nullable=False)  # "batch" / "batch_output"
+    filename: Mapped[str] = mapped_column(String(255), nullable=False)
+    bytes: Mapped[int] = mapped_column(Integer, nullable=False)
+    # 最大 BATCH_MAX_FILE_BYTES あるので一覧などでは読まない。必要な所で undefer(BatchFile.content) する
+    content: Mapped[str] = mapped_column(String, nullable=False, deferred=True)
+    created_at: Mapped["DateTime"] = mapped_column(
+        DateTime(timezone=True),
+        server_default=func.now(),
+        nullable=False
+    )
+
+class Batch(Base):
+    """
+    /v1/batches のバッチ 1 件。status は OpenAI と同じ
+    validating -> in_progress -> finalizing -> completed (途中で failed / cancelling -> cancelled / expired)
+    """
+    __tablename__ = "batches"
+
+    id: Mapped[str] = mapped_column(String(64), primary_key=True)  # "batch_..."
+    tenant_id: Mapped[str] = mapped_column(String(64), index=True, nullable=False, server_default="default")
+    client_key: Mapped[str | None] = mapped_column(String(255), nullable=True)
+    endpoint: Mapped[str] = mapped_column(String(100), nullable=False)
+    input_file_id: Mapped[str] = mapped_column(String(64), ForeignKey("batch_files.id"), nullable=False)
+    output_file_id: Mapped[str | None] = mapped_column(String(64), nullable=True)
+    error_file_id: Mapped[str | None] = mapped_column(String(64), nullable=True)
+    completion_window: Mapped[str] = mapped_column(String(16), nullable=False, server_default="24h")
+    status: Mapped[str] = mapped_column(String(20), index=True, nullable=False)
+    errors: Mapped[list | None] = mapped_column(JSON, nullable=True)  # 入力の検証エラー [{code, message, line}]
+    total: Mapped[int] = mapped_column(Integer, nullable=False, server_default="0")
+    completed: Mapped[int] = mapped_column(Integer, nullable=False, server_default="0")
+    failed: Mapped[int] = mapped_column(Integer, nullable=False, server_default="0")
+    batch_metadata: Mapped[dict | None] = mapped_column("metadata", JSON, nullable=True)
+    created_at: Mapped["DateTime"] = mapped_column(
+        DateTime(timezone=True),
+        server_default=func.now(),
+        nullable=False
+    )
+    in_progress_at: Mapped["DateTime | None"] = mapped_column(DateTime(timezone=True), nullable=True)
+    expires_at: Mapped["DateTime | None"] = mapped_column(DateTime(timezone=True), nullable=True)
+    finalizing_at: Mapped["DateTime | None"] = mapped_column(DateTime(timezone=True), nullable=True)
+    completed_at: Mapped["DateTime | None"] = mapped_column(DateTime(timezone=True), nullable=True)
+    failed_at: Mapped["DateTime | None"] = mapped_column(DateTime(timezone=True), nullable=True)
+    expired_at: Mapped["DateTime | None"] = mapped_column(DateTime(timezone=True), nullable=True)
+    cancelling_at: Mapped["DateTime | None"] = mapped_column(DateTime(timezone=True), nullable=True)
+    cancelled_at: Mapped["DateTime | None"] = mapped_column(DateTime(timezone=True), nullable=True)
+
+class BatchResult(Base):
+    """
+    バッチの 1 行分の結果。行毎にコミットするのでこれがチェックポイントになり、
+    再起動後は結果の無い行だけを処理する。出力ファイルは最後にこれを line_index 順に並べて作る。
+    """
+    __tablename__ = "batch_results"
+    __table_args__ = (UniqueConstraint("batch_id", "line_index", name="uq_batch_results_batch_line"),)
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    batch_id: Mapped[str] = mapped_column(String(64), ForeignKey("batches.id", ondelete="CASCADE"), nullable=False)
+    line_index: Mapped[int] = mapped_column(Integer, nullable=False)
+    custom_id: Mapped[str] = mapped_column(String(255), nullable=False)
+    request_id: Mapped[str] = mapped_column(String(64), nullable=False)
+    status_code: Mapped[int] = mapped_column(Integer, nullable=False)
+    body: Mapped[dict | None] = mapped_column(JSON, nullable=True)   # 成功時の chat.completion
+    error: Mapped[dict | None] = mapped_column(JSON, nullable=True)  # 失敗時の {code, message}
+    created_at: Mapped["DateTime"] = mapped_column(
+        DateTime(timezone=True),
+        server_default=func.now(),
+        nullable=False
+    )
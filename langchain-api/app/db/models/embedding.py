@@ -0,0 +1,18 @@
+from __future__ import annotations
+from sqlalchemy import String, Integer, DateTime, LargeBinary, func
+from sqlalchemy.orm import Mapped, mapped_column
+from app.db.session import Base
+
+class EmbeddingCacheEntry(Base):
+    """/v1/embeddings の永続キャッシュ (EMBEDDING_CACHE_PERSIST=1 のとき)。key は (model, text) の sha256"""
+    __tablename__ = "embedding_cache"
+
+    key: Mapped[str] = mapped_column(String(64), primary_key=True)
+    model: Mapped[str] = mapped_column(String(255), nullable=False)
+    dims: Mapped[int] = mapped_column(Integer, nullable=False)
+    vector: Mapped[bytes] = mapped_column(LargeBinary, nullable=False)  # array("d").tobytes() (float64)
+    created_at: Mapped["DateTime"] = mapped_column(
+        DateTime(timezone=True),
+        server_default=func.now(),
+        nullable=False
+    )
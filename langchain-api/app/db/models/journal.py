@@ -0,0 +1,35 @@
+from __future__ import annotations
+from sqlalchemy import String, Integer, Float, DateTime, JSON, func
+from sqlalchemy.orm import Mapped, mapped_column
+from app.db.session import Base
+
+class RequestJournalEntry(Base):
+    """1 リクエスト分の処理記録 (遅延調査用)"""
+    __tablename__ = "request_journals"
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    request_id: Mapped[str] = mapped_column(String(64), index=True, nullable=False)
+    endpoint: Mapped[str] = mapped_column(String(100), nullable=False)
+    client_key: Mapped[str | None] = mapped_column(String(255), nullable=True)
+    provider: Mapped[str | None] = mapped_column(String(20), nullable=True)
+    model: Mapped[str | None] = mapped_column(String(255), nullable=True)
+    status: Mapped[str] = mapped_column(String(20), nullable=False)
+    error: Mapped[str | None] = mapped_column(String, nullable=True)
+    started_at: Mapped["DateTime"] = mapped_column(DateTime(timezone=True), index=True, nullable=False)
+    queue_ms: Mapped[float] = mapped_column(Float, nullable=False, server_default="0")
+    ttft_ms: Mapped[float | None] = mapped_column(Float, nullable=True)
+    total_ms: Mapped[float | None] = mapped_column(Float, nullable=True)
+    prompt_tokens: Mapped[int] = mapped_column(Integer, nullable=False, server_default="0")
+    completion_tokens: Mapped[int] = mapped_column(Integer, nullable=False, server_default="0")
+    memories_injected: Mapped[int] = mapped_column(Integer, nullable=False, server_default="0")
+    db_ms: Mapped[float] = mapped_column(Float, nullable=False, server_default="0")
+    route: Mapped[list] = mapped_column(JSON, nullable=False, default=list)
+    nodes: Mapped[list] = mapped_column(JSON, nullable=False, default=list)        # [{name, ms}]
+    llm_calls: Mapped[list] = mapped_column(JSON, nullable=False, default=list)    # [{node, provider, model, ms, ttft_ms, prompt_tokens, completion_tokens, ...}]
+    db_calls: Mapped[list] = mapped_column(JSON, nullable=False, default=list)     # [{label, ms}]
+    retrieval: Mapped[dict] = mapped_column(JSON, nullable=False, default=dict)
+    created_at: Mapped["DateTime"] = mapped_column(
+        DateTime(timezone=True),
+        server_default=func.now(),
+        nullable=False
+    )
@@ -1,16 +1,26 @@
 from __future__ import annotations
+from typing import AsyncIterator, Sequence
 from sqlalchemy import (
-    String, Integer, DateTime, func, ForeignKey, Index, Boolean, select
+    String, Integer, DateTime, Boolean, func, ForeignKeyConstraint, Index, Row, Select, Sequence as DbSequence, UniqueConstraint, exists, select, text, update
 )
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy.orm import Mapped, mapped_column, relationship
+from sqlalchemy.orm import Mapped, aliased, mapped_column, relationship
 from app.db.session import Base
+from app.db.partitioning import with_hash_partitions
+
+_memories_id_seq = DbSequence("memories_id_seq")
 
 class Memory(Base):
+    """
+    テナント (ユーザ) 毎のメモリ。tenant_id のハッシュでパーティション分割しているので、
+    クエリは必ず tenant_id で絞って 1 パーティションだけを見るようにする。
+    """
     __tablename__ = "memories"
 
-    id: Mapped[int] = mapped_column(Integer, primary_key=True)
-    title: Mapped[str] = mapped_column(String(255), unique=True, index=True, nullable=False)
+    tenant_id: Mapped[str] = mapped_column(String(64), primary_key=True, server_default="default")
+    # パーティションテーブルは IDENTITY を持てないので既存のシーケンスを使う
+    id: Mapped[int] = mapped_column(Integer, _memories_id_seq, server_default=_memories_id_seq.next_value(), primary_key=True)
+    title: Mapped[str] = mapped_column(String(255), nullable=False)
     content: Mapped[str] = mapped_column(String, nullable=False)
     source_url: Mapped[str | None] = mapped_column(String(500), nullable=True)
     memory_simplicity: Mapped[int] = mapped_column(Integer, nullable=False, server_default="0")
@@ -26,34 +36,72 @@ class Memory(Base):
         nullable=False
     )
     deleted_at: Mapped["DateTime | None"] = mapped_column(  # 追加
-        DateTime(timezone=True), nullable=True, index=True
+        DateTime(timezone=True), nullable=True
     )
+    # 子メモリの要約 (階層モードでカタログに載せる)。子が変わると summary_stale が立ち、バックグラウンドで作り直す
+    summary: Mapped[str | None] = mapped_column(String, nullable=True)
+    summary_stale: Mapped[bool] = mapped_column(Boolean, nullable=False, server_default="false")
+    summary_updated_at: Mapped["DateTime | None"] = mapped_column(DateTime(timezone=True), nullable=True)
 
     # 子 = 自分を親とする関係
     children = relationship(
         "MemoryRelation",
-        foreign_keys="MemoryRelation.parent_id",
+        foreign_keys="[MemoryRelation.tenant_id, MemoryRelation.parent_id]",
         cascade="all, delete-orphan",
         back_populates="parent",
+        overlaps="parents,child",
     )
     # 親 = 自分を子とする関係
     parents = relationship(
         "MemoryRelation",
-        foreign_keys="MemoryRelation.child_id",
+        foreign_keys="[MemoryRelation.tenant_id, MemoryRelation.child_id]",
         cascade="all, delete-orphan",
         back_populates="child",
+        overlaps="children,parent",
     )
 
     __table_args__ = (
-        Index("ix_memories_memory_simplicity", "memory_simplicity"),
+        # title の一意性はテナント内だけ
+        UniqueConstraint("tenant_id", "title", name="uq_memories_tenant_title"),
+        # 有効な行だけの部分インデックス。カタログ取得を title 順の index only scan で済ませる
+        Index(
+            "ix_memories_active_title",
+            "tenant_id",
+            "title",
+            postgresql_include=["memory_simplicity"],
+            postgresql_where=text("deleted_at IS NULL"),
+        ),
+        # memory_simplicity で絞り込む割合が大きい (0 だけ等) 場合用
+        Index(
+            "ix_memories_active_simplicity_title",
+            "tenant_id",
+            "memory_simplicity",
+            "title",
+            postgresql_where=text("deleted_at IS NULL"),
+        ),
+        # 要約の作り直し待ち
+        Index(
+            "ix_memories_summary_stale",
+            "tenant_id",
+            "id",
+            postgresql_where=text("summary_stale"),
+        ),
+        # 退避ジョブ用 (論理削除済みの行だけ)
+        Index(
+            "ix_memories_deleted_at",
+            "deleted_at",
+            postgresql_where=text("deleted_at IS NOT NULL"),
+        ),
+        {"postgresql_partition_by": "HASH (tenant_id)"},
     )
 
 
 class MemoryRelation(Base):
     __tablename__ = "memory_relations"
 
-    parent_id: Mapped[int] = mapped_column(ForeignKey("memories.id"), primary_key=True)
-    child_id: Mapped[int] = mapped_column(ForeignKey("memories.id"), primary_key=True)
+    tenant_id: Mapped[str] = mapped_column(String(64), primary_key=True, server_default="default")
+    parent_id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    child_id: Mapped[int] = mapped_column(Integer, primary_key=True)
     relation: Mapped[str] = mapped_column(String(50), nullable=False)
     created_at: Mapped["DateTime"] = mapped_column(
         DateTime(timezone=True),
@@ -67,21 +115,135 @@ class MemoryRelation(Base):
         nullable=False
     )
 
-    parent = relationship("Memory", foreign_keys=[parent_id], back_populates="children")
-    child = relationship("Memory", foreign_keys=[child_id], back_populates="parents")
+    parent = relationship("Memory", foreign_keys=[tenant_id, parent_id], back_populates="children", overlaps="child,parents")
+    child = relationship("Memory", foreign_keys=[tenant_id, child_id], back_populates="parents", overlaps="parent,children")
+
+    __table_args__ = (
+        ForeignKeyConstraint(["tenant_id", "parent_id"], ["memories.tenant_id", "memories.id"]),
+        ForeignKeyConstraint(["tenant_id", "child_id"], ["memories.tenant_id", "memories.id"]),
+        # 主キー (tenant_id, parent_id, child_id) は子からの逆引きに使えない
+        Index("ix_memory_relations_child_id", "tenant_id", "child_id"),
+        {"postgresql_partition_by": "HASH (tenant_id)"},
+    )
+
+with_hash_partitions(Memory.__table__)
+with_hash_partitions(MemoryRelation.__table__)
+
+def active_catalogue_stmt(tenant_id: str, memory_simplicity: int, after_title: str | None = None, limit: int | None = None) -> Select:
+    """
+    テナントの有効なメモリの (title, memory_simplicity) を title 順に返すクエリ。
+    title はテナント内で unique なので DISTINCT は不要。after_title を渡すとその次から (keyset pagination)。
+    """
+    stmt = (
+        select(Memory.title, Memory.memory_simplicity)
+        .where(Memory.tenant_id == tenant_id)
+        .where(Memory.memory_simplicity <= memory_simplicity)
+        .where(Memory.deleted_at == None)
+        .order_by(Memory.title)
+    )
+    if after_title is not None:
+        stmt = stmt.where(Memory.title > after_title)
+    if limit is not None:
+        stmt = stmt.limit(limit)
+    return stmt
+
+async def select_active_memorys_by_memory_simplicity(session: AsyncSession, tenant_id: str, memory_simplicity: int) -> Sequence[Row]:
+    result = await session.execute(active_catalogue_stmt(tenant_id, memory_simplicity))
+    return result.all()
+
+async def select_active_memorys_page(session: AsyncSession, tenant_id: str, memory_simplicity: int, after_title: str | None = None, limit: int = 1000) -> Sequence[Row]:
+    """カタログの 1 ページ分。次ページは最後の行の title を after_title に渡す"""
+    result = await session.execute(active_catalogue_stmt(tenant_id, memory_simplicity, after_title, limit))
+    return result.all()
 
-async def select_active_memorys_by_memory_simplicity(session: AsyncSession, memory_simplicity: int) -> list[str]:
-    stmt = select(Memory.title, Memory.memory_simplicity).where(Memory.memory_simplicity <= memory_simplicity).where(Memory.deleted_at == None)
-    stmt = stmt.distinct().order_by(Memory.title)
+async def stream_active_memorys_by_memory_simplicity(session: AsyncSession, tenant_id: str, memory_simplicity: int, batch_size: int = 1000) -> AsyncIterator[Sequence[Row]]:
+    """
+    サーバサイドカーソルで batch_size 件ずつ返す。全件をメモリに載せずに済む。
+    カーソルはトランザクション内でしか生きないので、使い終わるまで同じセッションで他のクエリを流さないこと。
+    """
+    result = await session.stream(active_catalogue_stmt(tenant_id, memory_simplicity).execution_options(yield_per=batch_size))
+    async for rows in result.partitions():
+        yield rows
+
+async def select_top_level_catalogue(session: AsyncSession, tenant_id: str, memory_simplicity: int) -> Sequence[Row]:
+    """
+    階層モードのカタログ。有効な親を持たないメモリだけを (title, memory_simplicity, summary, child_count) で返す。
+    子は select_child_catalogue で枝毎に展開する。
+    """
+    parent = aliased(Memory)
+    child = aliased(Memory)
+    has_parent = exists(
+        select(MemoryRelation.parent_id)
+        .join(parent, (parent.tenant_id == MemoryRelation.tenant_id) & (parent.id == MemoryRelation.parent_id))
+        .where(MemoryRelation.tenant_id == tenant_id, MemoryRelation.child_id == Memory.id, parent.deleted_at == None, parent.memory_simplicity <= memory_simplicity)
+    )
+    child_counts = (
+        select(MemoryRelation.parent_id, func.count().label("child_count"))
+        .join(child, (child.tenant_id == MemoryRelation.tenant_id) & (child.id == MemoryRelation.child_id))
+        .where(MemoryRelation.tenant_id == tenant_id, child.deleted_at == None, child.memory_simplicity <= memory_simplicity)
+        .group_by(MemoryRelation.parent_id)
+        .subquery()
+    )
+    stmt = (
+        select(Memory.title, Memory.memory_simplicity, Memory.summary, func.coalesce(child_counts.c.child_count, 0).label("child_count"))
+        .outerjoin(child_counts, child_counts.c.parent_id == Memory.id)
+        .where(Memory.tenant_id == tenant_id, Memory.memory_simplicity <= memory_simplicity, Memory.deleted_at == None)
+        .where(~has_parent)
+        .order_by(Memory.title)
+    )
+    result = await session.execute(stmt)
+    return result.all()
 
+async def select_child_catalogue(session: AsyncSession, tenant_id: str, parent_titles: list[str], memory_simplicity: int) -> Sequence[Row]:
+    """親 title 毎の子を (parent_title, title, memory_simplicity, summary, child_count) で返す"""
+    if not parent_titles:
+        return []
+    parent = aliased(Memory)
+    grandchild = aliased(Memory)
+    grandchild_rel = aliased(MemoryRelation)
+    child_count = (
+        select(func.count())
+        .select_from(grandchild_rel)
+        .join(grandchild, (grandchild.tenant_id == grandchild_rel.tenant_id) & (grandchild.id == grandchild_rel.child_id))
+        .where(
+            grandchild_rel.tenant_id == tenant_id,
+            grandchild_rel.parent_id == Memory.id,
+            grandchild.deleted_at == None,
+            grandchild.memory_simplicity <= memory_simplicity,
+        )
+        .scalar_subquery()
+    )
+    stmt = (
+        select(parent.title.label("parent_title"), Memory.title, Memory.memory_simplicity, Memory.summary, child_count.label("child_count"))
+        .select_from(MemoryRelation)
+        .join(parent, (parent.tenant_id == MemoryRelation.tenant_id) & (parent.id == MemoryRelation.parent_id))
+        .join(Memory, (Memory.tenant_id == MemoryRelation.tenant_id) & (Memory.id == MemoryRelation.child_id))
+        .where(MemoryRelation.tenant_id == tenant_id, parent.title.in_(parent_titles), parent.deleted_at == None)
+        .where(Memory.deleted_at == None, Memory.memory_simplicity <= memory_simplicity)
+        .order_by(parent.title, Memory.title)
+    )
     result = await session.execute(stmt)
     return result.all()
 
-async def select_active_memories(session: AsyncSession, titles: list[str], memory_simplicity: int) -> list[Memory]:
+async def mark_parents_stale(session: AsyncSession, tenant_id: str, memory_id: int) -> None:
+    """子が変わったので親の要約を作り直し待ちにする"""
+    await session.execute(
+        update(Memory)
+        .where(
+            Memory.tenant_id == tenant_id,
+            Memory.id.in_(
+                select(MemoryRelation.parent_id).where(MemoryRelation.tenant_id == tenant_id, MemoryRelation.child_id == memory_id)
+            ),
+        )
+        .values(summary_stale=True)
+    )
+
+async def select_active_memories(session: AsyncSession, tenant_id: str, titles: list[str], memory_simplicity: int) -> Sequence[Row]:
     if not titles:
         return []
     stmt = (
         select(Memory.title, Memory.content)
+        .where(Memory.tenant_id == tenant_id)
         .where(Memory.title.in_(titles))
         .where(Memory.memory_simplicity <= memory_simplicity)
         .where(Memory.deleted_at == None)
@@ -89,9 +251,21 @@ async def select_active_memories(session: AsyncSession, titles: list[str], memor
     rows = await session.execute(stmt)
     return rows.all()
 
-async def upsert_memory(session: AsyncSession, title: str, content: str, parent_titles: list[str], source_url: str | None = None, memory_simplicity: int = 0) -> Memory:
+async def select_active_titles(session: AsyncSession, tenant_id: str, titles: list[str]) -> list[str]:
+    """titles のうち有効なメモリとして存在するもの (memory_simplicity は問わない)"""
+    if not titles:
+        return []
+    stmt = (
+        select(Memory.title)
+        .where(Memory.tenant_id == tenant_id)
+        .where(Memory.title.in_(titles))
+        .where(Memory.deleted_at == None)
+    )
+    return list((await session.execute(stmt)).scalars().all())
+
+async def upsert_memory(session: AsyncSession, tenant_id: str, title: str, content: str, parent_titles: list[str], source_url: str | None = None, memory_simplicity: int = 0) -> Memory:
     # titleでメモリを検索
-    stmt = select(Memory).where(Memory.title == title)
+    stmt = select(Memory).where(Memory.tenant_id == tenant_id, Memory.title == title)
     memory = (await session.execute(stmt)).scalars().first()
     if memory:
         # 既存のメモリがあれば更新
@@ -102,6 +276,7 @@ async def upsert_memory(session: AsyncSession, title: str, content: str, parent_
     else:
         # 新しいメモリを作成
         memory = Memory(
+            tenant_id=tenant_id,
             title=title,
             content=content,
             source_url=source_url,
@@ -111,28 +286,37 @@ async def upsert_memory(session: AsyncSession, title: str, content: str, parent_
         await session.flush()  # IDを取得するためにflush
 
     if parent_titles:
-        for parent_title in parent_titles:
-            # 親メモリをタイトルで検索
-            parent_memory = session.query(Memory).filter(Memory.title == parent_title).first()
-            if parent_memory:
-                # 親子関係が存在しない場合のみ追加
-                existing_relation = session.query(MemoryRelation).filter(
-                    MemoryRelation.parent_id == parent_memory.id,
-                    MemoryRelation.child_id == memory.id
-                ).first()
-                if not existing_relation:
+        # 親メモリをタイトルで検索
+        parents = (await session.execute(
+            select(Memory.id).where(Memory.tenant_id == tenant_id, Memory.title.in_(parent_titles))
+        )).scalars().all()
+        if parents:
+            # 親子関係が存在しない場合のみ追加
+            existing = set((await session.execute(
+                select(MemoryRelation.parent_id).where(
+                    MemoryRelation.tenant_id == tenant_id,
+                    MemoryRelation.parent_id.in_(parents),
+                    MemoryRelation.child_id == memory.id,
+                )
+            )).scalars().all())
+            for parent_id in parents:
+                if parent_id not in existing:
                     relation = MemoryRelation(
-                        parent_id=parent_memory.id,
+                        tenant_id=tenant_id,
+                        parent_id=parent_id,
                         child_id=memory.id,
                         relation="related"  # 必要に応じて関係の種類を変更
                     )
                     session.add(relation)
+            await session.flush()
+    await mark_parents_stale(session, tenant_id, memory.id)
     return memory
 
-async def mark_memory_as_deleted(session: AsyncSession, title: str) -> bool:
-    stmt = select(Memory).where(Memory.title == title, Memory.deleted_at == None)
+async def mark_memory_as_deleted(session: AsyncSession, tenant_id: str, title: str) -> bool:
+    stmt = select(Memory).where(Memory.tenant_id == tenant_id, Memory.title == title, Memory.deleted_at == None)
     memory = (await session.execute(stmt)).scalars().first()
     if memory:
         memory.deleted_at = func.now()
+        await mark_parents_stale(session, tenant_id, memory.id)
         return True
     return False
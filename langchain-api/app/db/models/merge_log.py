@@ -0,0 +1,30 @@
+from __future__ import annotations
+from sqlalchemy import String, Integer, Float, DateTime, JSON, func
+from sqlalchemy.orm import Mapped, mapped_column
+from app.db.session import Base
+
+class MemoryMerge(Base):
+    """
+    重複メモリの統合ログ。1 行 = 統合された (論理削除された) メモリ 1 件。
+    付け替えた関係の前後を残しておき、merge_id 単位で元に戻せるようにする。
+    """
+    __tablename__ = "memory_merges"
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    merge_id: Mapped[str] = mapped_column(String(64), index=True, nullable=False)  # 1 クラスタ = 1 merge_id
+    tenant_id: Mapped[str] = mapped_column(String(64), nullable=False)
+    canonical_id: Mapped[int] = mapped_column(Integer, nullable=False)
+    canonical_title: Mapped[str] = mapped_column(String(255), nullable=False)
+    canonical_simplicity_before: Mapped[int] = mapped_column(Integer, nullable=False)
+    canonical_content_before: Mapped[str | None] = mapped_column(String, nullable=True)  # 統合したものの content を足す前
+    merged_id: Mapped[int] = mapped_column(Integer, nullable=False)
+    merged_title: Mapped[str] = mapped_column(String(255), nullable=False)
+    similarity: Mapped[float] = mapped_column(Float, nullable=False)
+    relations_removed: Mapped[list] = mapped_column(JSON, nullable=False, default=list)  # [{parent_id, child_id, relation}]
+    relations_added: Mapped[list] = mapped_column(JSON, nullable=False, default=list)
+    created_at: Mapped["DateTime"] = mapped_column(
+        DateTime(timezone=True),
+        server_default=func.now(),
+        nullable=False
+    )
+    reverted_at: Mapped["DateTime | None"] = mapped_column(DateTime(timezone=True), nullable=True)
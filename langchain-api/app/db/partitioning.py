@@ -0,0 +1,18 @@
+from __future__ import annotations
+from sqlalchemy import DDL, Table, event
+
+# テナント毎のハッシュパーティション数。変えるにはデータの入れ直しが必要なので設定値にはしない
+MEMORY_PARTITIONS = 16
+
+def hash_partition_ddl(table_name: str, modulus: int = MEMORY_PARTITIONS) -> list[str]:
+    return [
+        f"CREATE TABLE IF NOT EXISTS {table_name}_p{i} PARTITION OF {table_name} "
+        f"FOR VALUES WITH (MODULUS {modulus}, REMAINDER {i})"
+        for i in range(modulus)
+    ]
+
+def with_hash_partitions(table: Table, modulus: int = MEMORY_PARTITIONS) -> Table:
+    """metadata.create_all でパーティション本体も一緒に作られるようにする (マイグレーションは自前で作る)"""
+    for ddl in hash_partition_ddl(table.name, modulus):
+        event.listen(table, "after_create", DDL(ddl).execute_if(dialect="postgresql"))
+    return table
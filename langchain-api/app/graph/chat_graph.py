@@ -1,12 +1,21 @@
 import os
+import re
 from typing import TypedDict, List, Dict, Any, Literal
 from langgraph.graph import StateGraph
 from langchain_core.messages import BaseMessage, SystemMessage, HumanMessage, AIMessage
 from typing import AsyncGenerator
-from app.graph.self_maintenance_memories_graph import ask_more_word_meanings_node, ask_updated_memories_node, ask_word_meanings_node, fetch_wellknown_words_node, fetch_word_meanings_node, save_updated_memories_node
+from app.graph.self_maintenance_memories_graph import apply_memory_plan_node, ask_more_word_meanings_node, ask_updated_memories_node, ask_word_meanings_node, fetch_wellknown_words_node, fetch_word_meanings_node, plan_memory_node, save_updated_memories_node
 from langchain_core.runnables import RunnableLambda, RunnableConfig
 from app.graph.type import ChatState
 from app.graph.provider_chat_graph import call_llm_node
+from app.graph.node_routing import history_compaction_enabled, resolve_node_route, route_messages
+from app.graph.tracing import traced_node
+from app.core.config import settings
+from app.services.deadline import remaining as deadline_remaining
+from app.services.history import history_compactor
+from app.services.journal import current_journal
+from app.services.memory_store import memory_store_available
+from app.services.speculation import Speculation
 from app.services.providers import (
     resolve_provider,
 )
@@ -26,30 +35,176 @@ def _to_lc_messages(raw: List[Dict[str, str]]) -> List[BaseMessage]:
             out.append(HumanMessage(content=c))
     return out
 
-def prepare_node(state: ChatState) -> ChatState:
+async def prepare_node(state: ChatState, config: RunnableConfig) -> ChatState:
     provider, pure = resolve_provider(state.get("model"), state.get("provider"))
     state["provider"] = provider
     state["model"] = pure
     state.setdefault("partial_answer", "")
+    state.setdefault("memory_simplicity", 0)
+    state.setdefault("max_memory_simplicity", settings.MAX_MEMORY_SIMPLICITY)
     state["lc_messages"] = _to_lc_messages(state["raw_messages"])
+    aux_task = config["configurable"].get("aux_task")
+    if aux_task:
+        state["aux_task"] = aux_task
+    state["memory_pipeline"] = memory_pipeline_mode(config)
+    state["history_len"] = len(state["lc_messages"])
+    if history_compaction_enabled():
+        state["compact_history"] = history_compactor.compact(state["lc_messages"])
+    if not memory_store_available():
+        # DB のブレーカーが開いている間はメモリ段階を丸ごと飛ばす
+        state["degraded"] = True
+    if settings.SPECULATIVE_ANSWER and route_after_prepare(state) != "call_llm_node" and not _short_of_time() and current_journal() is not None:
+        # 最終回答を素の会話で先に始めておき、call_llm_node で採用するか捨てるか決める
+        route = resolve_node_route(state, "call_llm_node")
+        state["speculation"] = Speculation(route, route_messages(state, route), state.get("stream", False))
     return state
 
+# ============= フロー制御 =============
+# 不要なメモリ段階を飛ばす。LLM を呼ぶ補助ノードは必要なときだけ通す。
+
+def _short_of_time() -> bool:
+    """リクエストの残り時間が最終回答の分 (DEADLINE_ANSWER_RESERVE) しか無い"""
+    left = deadline_remaining()
+    return left is not None and left < settings.DEADLINE_ANSWER_RESERVE
+
+def _skip_memory(state: ChatState) -> bool:
+    """時間切れが近いか、DB が使えずメモリ無しで答える (degraded) とき"""
+    return _short_of_time() or bool(state.get("degraded"))
+
+def route_after_prepare(state: ChatState) -> Literal["fetch_wellknown_words_node", "call_llm_node"]:
+    # 補助タスク (タイトル生成など) はメモリを引かず、書き戻しもしない
+    if state.get("degraded") or state.get("aux_task"):
+        return "call_llm_node"
+    return "fetch_wellknown_words_node"
+
+# 記憶の追加 / 変更 / 削除を頼んでいそうな言い回し (当たらなければ ask_updated_memories_node を呼んでも更新は出てこない)
+_SAVE_REQUEST = re.compile(r"覚え|記憶|メモ|忘れ|保存|登録|remember|memori[sz]e|forget|save|note (?:that|this)|keep in mind", re.IGNORECASE)
+
+def _recent_user_text(state: ChatState) -> str:
+    users = [m for m in state.get("lc_messages", [])[:state.get("history_len")] if isinstance(m, HumanMessage)]
+    parts = []
+    for m in users[-settings.MEMORY_PRECHECK_TURNS:]:
+        content = m.content
+        if isinstance(content, list):
+            content = " ".join(p.get("text", "") for p in content if isinstance(p, dict))
+        parts.append(str(content or ""))
+    return "\n".join(parts).lower()
+
+def _mentions(text: str, title: str) -> bool:
+    title = title.strip().lower()
+    if not title:
+        return False
+    if title.isascii():
+        # 英数字の名称は語の途中 ("ai" と "said" など) には当てない
+        return re.search(r"(?<![0-9a-z])" + re.escape(title) + r"(?![0-9a-z])", text) is not None
+    return title in text
+
+def _memory_relevant(state: ChatState) -> bool:
+    """
+    LLM を呼ぶメモリ段階の前の安い判定。直近のユーザ発言にカタログの名称が出てこず、記憶の依頼でもなければ飛ばす。
+    階層モードでまだ展開していない下位の名称は見えないので、親の名称に触れていない言及は取りこぼす
+    """
+    if not settings.MEMORY_PRECHECK:
+        return True
+    text = _recent_user_text(state)
+    if _SAVE_REQUEST.search(text):
+        return True
+    return any(_mentions(text, t) for t in state.get("wellknown_words", []) + state.get("wellknown_memories", []))
+
+async def skip_memory_node(state: ChatState) -> ChatState:
+    """_memory_relevant で飛ばしたことを route に残すだけ"""
+    return state
+
+def route_after_wellknown_words(state: ChatState) -> Literal["ask_word_meanings_node", "ask_updated_memories_node", "skip_memory_node", "call_llm_node"]:
+    if _skip_memory(state):
+        return "call_llm_node"
+    if not _memory_relevant(state):
+        return "skip_memory_node"
+    # 既知の単語も記録も無ければ引くものが無い
+    if not state.get("wellknown_words") and not state.get("wellknown_memories"):
+        return "ask_updated_memories_node"
+    return "ask_word_meanings_node"
+
+def route_after_ask_word_meanings(state: ChatState) -> Literal["fetch_word_meanings_node", "ask_updated_memories_node", "call_llm_node"]:
+    if _skip_memory(state):
+        return "call_llm_node"
+    if not state.get("requested_words"):
+        return "ask_updated_memories_node"
+    return "fetch_word_meanings_node"
+
+def route_after_fetch_word_meanings(state: ChatState) -> Literal["ask_more_word_meanings_node", "ask_updated_memories_node", "call_llm_node"]:
+    if _skip_memory(state):
+        return "call_llm_node"
+    # 何も見つからなければ追加の語義を尋ねても得るものが無い
+    if not state.get("last_found_count"):
+        return "ask_updated_memories_node"
+    return "ask_more_word_meanings_node"
+
+def route_after_ask_more_word_meanings(state: ChatState) -> Literal["fetch_word_meanings_node", "ask_updated_memories_node", "call_llm_node"]:
+    if _skip_memory(state):
+        return "call_llm_node"
+    # 新しい語が挙がり、かつ simplicity の上限内のときだけ fetch / ask_more をもう一周
+    looked_up = set(state.get("looked_up_words", []))
+    new_words = [w for w in state.get("requested_words", []) if w not in looked_up]
+    if new_words and state.get("memory_simplicity", 0) <= state.get("max_memory_simplicity", 1000):
+        return "fetch_word_meanings_node"
+    return "ask_updated_memories_node"
+
+def route_after_ask_updated_memories(state: ChatState) -> Literal["save_updated_memories_node", "call_llm_node"]:
+    if not state.get("updated_words") and not state.get("updated_memories"):
+        return "call_llm_node"
+    return "save_updated_memories_node"
+
+# planner: カタログ -> plan_memory_node (構造化出力 1 回) -> apply_memory_plan_node (DB のみ) -> 最終回答
+
+def route_after_wellknown_words_planner(state: ChatState) -> Literal["plan_memory_node", "skip_memory_node", "call_llm_node"]:
+    if _skip_memory(state):
+        return "call_llm_node"
+    if not _memory_relevant(state):
+        return "skip_memory_node"
+    # カタログが空でも記録の更新はあり得るのでプランは立てる
+    return "plan_memory_node"
+
+def route_after_plan_memory(state: ChatState) -> Literal["apply_memory_plan_node", "call_llm_node"]:
+    if not state.get("requested_words") and not state.get("updated_words") and not state.get("updated_memories"):
+        return "call_llm_node"
+    return "apply_memory_plan_node"
+
 # ---- 親グラフ ----
-_graph = None
-def get_chat_graph():
-    global _graph
-    if _graph:
-        return _graph
+# "staged": 語の抽出 / 追加の語 / 記録の更新を別々の構造化出力で尋ねる (既定)
+# "planner": 1 回の構造化出力 (MemoryPlanAnswer) でまとめて決める。既存の記録を更新 / 削除するターンだけは
+#            内容を読ませて ask_updated_memories_node で尋ね直すので 2 回になる
+MEMORY_PIPELINE_MODES = ("staged", "planner")
+
+def memory_pipeline_mode(config: RunnableConfig | None) -> str:
+    config = config or {}
+    mode = config.get("memory_pipeline") or config.get("configurable", {}).get("memory_pipeline")
+    return mode if mode in MEMORY_PIPELINE_MODES else settings.MEMORY_PIPELINE_MODE
+
+_graphs: Dict[str, Any] = {}
+def get_chat_graph(mode: str | None = None):
+    """モード毎にコンパイル済みのグラフを使い回す。mode を省略すると MEMORY_PIPELINE_MODE"""
+    if mode not in MEMORY_PIPELINE_MODES:
+        mode = settings.MEMORY_PIPELINE_MODE
+    if mode not in _graphs:
+        _graphs[mode] = _build_chat_graph(mode)
+    return _graphs[mode]
+
+def _build_chat_graph(mode: str):
     g = StateGraph(ChatState)
-    g.add_node("prepare_node", RunnableLambda(prepare_node))
-    g.add_node("fetch_wellknown_words_node", RunnableLambda(fetch_wellknown_words_node))
-    g.add_node("ask_word_meanings_node", ask_word_meanings_node)
-    g.add_node("fetch_word_meanings_node", RunnableLambda(fetch_word_meanings_node))
-    g.add_node("ask_more_word_meanings_node", ask_more_word_meanings_node)
-    g.add_node("ask_updated_memories_node", ask_updated_memories_node)
-    g.add_node("save_updated_memories_node", RunnableLambda(save_updated_memories_node))
-    g.add_node("call_llm_node", call_llm_node)
-    g.add_node("finalize_node", finalize_node)
+    g.add_node("prepare_node", RunnableLambda(traced_node("prepare_node", prepare_node)))
+    g.add_node("fetch_wellknown_words_node", RunnableLambda(traced_node("fetch_wellknown_words_node", fetch_wellknown_words_node)))
+    g.add_node("ask_word_meanings_node", traced_node("ask_word_meanings_node", ask_word_meanings_node))
+    g.add_node("fetch_word_meanings_node", RunnableLambda(traced_node("fetch_word_meanings_node", fetch_word_meanings_node)))
+    g.add_node("ask_more_word_meanings_node", traced_node("ask_more_word_meanings_node", ask_more_word_meanings_node))
+    g.add_node("ask_updated_memories_node", traced_node("ask_updated_memories_node", ask_updated_memories_node))
+    g.add_node("save_updated_memories_node", RunnableLambda(traced_node("save_updated_memories_node", save_updated_memories_node)))
+    if mode == "planner":
+        g.add_node("plan_memory_node", traced_node("plan_memory_node", plan_memory_node))
+        g.add_node("apply_memory_plan_node", RunnableLambda(traced_node("apply_memory_plan_node", apply_memory_plan_node)))
+    g.add_node("skip_memory_node", RunnableLambda(traced_node("skip_memory_node", skip_memory_node)))
+    g.add_node("call_llm_node", traced_node("call_llm_node", call_llm_node))
+    g.add_node("finalize_node", traced_node("finalize_node", finalize_node))
 
     g.set_entry_point("prepare_node")
 
@@ -58,84 +213,104 @@ def get_chat_graph():
         g.add_edge("prepare_node", "call_llm_node")
         g.add_edge("call_llm_node", "finalize_node")
         g.add_edge("finalize_node", "__end__")
+    elif mode == "planner":
+        g.add_conditional_edges("prepare_node", route_after_prepare)
+        g.add_conditional_edges("fetch_wellknown_words_node", route_after_wellknown_words_planner)
+        g.add_conditional_edges("plan_memory_node", route_after_plan_memory)
+        g.add_edge("apply_memory_plan_node", "call_llm_node")
+        g.add_edge("skip_memory_node", "call_llm_node")
+        g.add_edge("call_llm_node", "finalize_node")
+        g.add_edge("finalize_node", "__end__")
     else:
-        g.add_edge("prepare_node", "fetch_wellknown_words_node")
-        g.add_edge("fetch_wellknown_words_node", "ask_word_meanings_node")
-        g.add_edge("ask_word_meanings_node", "fetch_word_meanings_node")
-        g.add_edge("fetch_word_meanings_node", "ask_more_word_meanings_node")
-        g.add_edge("ask_more_word_meanings_node", "ask_updated_memories_node")
-        g.add_edge("ask_updated_memories_node", "save_updated_memories_node")
+        g.add_conditional_edges("prepare_node", route_after_prepare)
+        g.add_conditional_edges("fetch_wellknown_words_node", route_after_wellknown_words)
+        g.add_conditional_edges("ask_word_meanings_node", route_after_ask_word_meanings)
+        g.add_conditional_edges("fetch_word_meanings_node", route_after_fetch_word_meanings)
+        g.add_conditional_edges("ask_more_word_meanings_node", route_after_ask_more_word_meanings)
+        g.add_conditional_edges("ask_updated_memories_node", route_after_ask_updated_memories)
         g.add_edge("save_updated_memories_node", "call_llm_node")
+        g.add_edge("skip_memory_node", "call_llm_node")
         g.add_edge("call_llm_node", "finalize_node")
         g.add_edge("finalize_node", "__end__")
-    _graph = g.compile()
-    return _graph
+    return g.compile()
 
 def finalize_node(state: ChatState) -> ChatState:
     return state
 
 # ---- Backward compatible wrapper functions (add) ----
-async def run_chat_graph(model: str | None, messages: list[dict], temperature: float | None):
+async def run_chat_graph(model: str | None, messages: list[dict], temperature: float | None, top_p: float | None = None, max_tokens: int | None = None, config: RunnableConfig | None = None):
     """
     Non-stream wrapper used by /v1/chat/completions.
     Returns final state dict (answer, provider, model).
     """
-    graph = get_chat_graph()
+    graph = get_chat_graph(memory_pipeline_mode(config))
     init_state = {
         "model": model,
         "raw_messages": messages,
         "temperature": temperature or 0.7,
+        "top_p": top_p,
+        "max_tokens": max_tokens,
         "stream": False,
     }
-    out = await graph.ainvoke(init_state)
+    out = await graph.ainvoke(init_state, config=config)
     return out  # contains provider, model, answer
 
-async def stream_chat_graph(model: str | None, messages: list[dict], temperature: float | None) -> AsyncGenerator[dict, None]:
+async def stream_chat_graph(model: str | None, messages: list[dict], temperature: float | None, top_p: float | None = None, max_tokens: int | None = None, config: RunnableConfig | None = None) -> AsyncGenerator[dict, None]:
     """
     Stream wrapper yielding OpenAI-like chunk dicts:
       {"id": "...", "object":"chat.completion.chunk","choices":[{"delta":{"content":"..."},"index":0,"finish_reason":None}]}
     Final chunk sets finish_reason= "stop".
     """
-    graph = get_chat_graph()
+    graph = get_chat_graph(memory_pipeline_mode(config))
     init_state = {
         "model": model,
         "raw_messages": messages,
         "temperature": temperature or 0.7,
+        "top_p": top_p,
+        "max_tokens": max_tokens,
         "stream": True,
     }
-    accumulated = ""
     chunk_id = "chatcmpl-" + os.urandom(8).hex()
+    model_used = None
+    final_state: dict = {}
 
-    async for ev in graph.astream(init_state, stream_mode="updates"):
-        updates = ev.get("updates")
-        if not updates:
+    # トークンは call_llm が stream writer で流す custom イベントから、最終 state は values から拾う
+    async for mode, data in graph.astream(init_state, stream_mode=["custom", "values"], config=config):
+        if mode == "values":
+            final_state = data
+            continue
+        if data.get("event_name") != "token":
             continue
-        for diff in updates:
-            # provider / model を diff に含めない設計なので保持用に拾う
-            # (必要ならノード内で provider / model も yield するよう拡張可)
-            if "partial_answer" in diff:
-                full = diff["partial_answer"]
-                delta = full[len(accumulated):]
-                if not delta:
-                    continue
-                accumulated = full
-                yield {
-                    "id": chunk_id,
-                    "object": "chat.completion.chunk",
-                    "choices": [{
-                        "index": 0,
-                        "delta": {"content": delta},
-                        "finish_reason": None
-                    }],
-                }
-            if "answer" in diff:
-                # Final completion marker
-                yield {
-                    "id": chunk_id,
-                    "object": "chat.completion.chunk",
-                    "choices": [{
-                        "index": 0,
-                        "delta": {},
-                        "finish_reason": "stop"
-                    }],
-                }
+        delta = data.get("delta")
+        if not delta:
+            continue
+        model_used = f"{data.get('provider')}:{data.get('model')}"
+        yield {
+            "id": chunk_id,
+            "object": "chat.completion.chunk",
+            "model": model_used,
+            "choices": [{
+                "index": 0,
+                "delta": {"content": delta},
+                "finish_reason": None
+            }],
+        }
+
+    journal = current_journal()
+    if journal is not None:
+        journal.record_state(final_state)
+    # Final completion marker
+    final_chunk = {
+        "id": chunk_id,
+        "object": "chat.completion.chunk",
+        "model": model_used or f"{final_state.get('provider')}:{final_state.get('model')}",
+        "choices": [{
+            "index": 0,
+            "delta": {},
+            "finish_reason": "stop"
+        }],
+    }
+    if final_state.get("degraded"):
+        # ストリームではヘッダを送り終えているので最終チャンクで知らせる
+        final_chunk["degraded"] = True
+    yield final_chunk
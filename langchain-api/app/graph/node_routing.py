@@ -0,0 +1,68 @@
+from __future__ import annotations
+from typing import Any, Dict, List
+from langchain_core.messages import BaseMessage
+from app.core.config import settings
+from app.graph.type import ChatState
+from app.services.history import fit_budget, history_budget
+from app.services.providers import resolve_provider
+
+# 構造化出力で語の抽出・記憶の更新だけを行う補助ノード
+MEMORY_AUX_NODES = (
+    "ask_word_meanings_node",
+    "ask_more_word_meanings_node",
+    "ask_updated_memories_node",
+    "plan_memory_node",
+)
+
+def resolve_node_route(state: ChatState, node_name: str) -> Dict[str, Any]:
+    """
+    ノードが使う provider / model / 生成パラメータを決める。
+    - 最終回答ノード: リクエストの model / temperature / top_p / max_tokens をそのまま使う
+    - 補助ノード: MEMORY_NODE_MODEL (未設定ならリクエストのモデル) と MEMORY_NODE_MAX_TOKENS (0 なら上限なし)
+    - NODE_ROUTES[node_name] があればその値で上書き
+    - history: "full" / "compact" (既定は HISTORY_MODE)
+    - 補助タスク (state["aux_task"]) の最終回答: AUX_TASK_MODEL と AUX_TASK_MAX_TOKENS
+    """
+    route: Dict[str, Any] = {
+        "provider": state["provider"],
+        "model": state["model"],
+        "temperature": state.get("temperature"),
+        "top_p": state.get("top_p"),
+        "max_tokens": state.get("max_tokens"),
+    }
+    if node_name in MEMORY_AUX_NODES:
+        route["top_p"] = None
+        route["max_tokens"] = settings.MEMORY_NODE_MAX_TOKENS or None
+        if settings.MEMORY_NODE_MODEL:
+            route["provider"], route["model"] = resolve_provider(settings.MEMORY_NODE_MODEL, None)
+
+    override = settings.NODE_ROUTES.get(node_name) or {}
+    if override.get("model"):
+        route["provider"], route["model"] = resolve_provider(override["model"], override.get("provider"))
+    for key in ("temperature", "top_p", "max_tokens"):
+        if key in override:
+            route[key] = override[key]
+    route["history"] = override.get("history") or settings.HISTORY_MODE
+    if state.get("aux_task") and node_name == "call_llm_node":
+        if settings.AUX_TASK_MODEL:
+            route["provider"], route["model"] = resolve_provider(settings.AUX_TASK_MODEL, None)
+        if settings.AUX_TASK_MAX_TOKENS:
+            route["max_tokens"] = min(route["max_tokens"] or settings.AUX_TASK_MAX_TOKENS, settings.AUX_TASK_MAX_TOKENS)
+        # テンプレート自体に会話履歴が埋め込まれているので圧縮しない
+        route["history"] = "full"
+    return route
+
+def history_compaction_enabled() -> bool:
+    """どれか 1 つでも compact を使うノードがあれば prepare_node で圧縮履歴を作る"""
+    return settings.HISTORY_MODE == "compact" or any(
+        (r or {}).get("history") == "compact" for r in settings.NODE_ROUTES.values()
+    )
+
+def route_messages(state: ChatState, route: Dict[str, Any]) -> List[BaseMessage]:
+    """ノードに渡す lc_messages。compact なら先頭の会話履歴を圧縮版に差し替え、モデルの予算に収める"""
+    messages = state.get("lc_messages", [])
+    compact = state.get("compact_history")
+    if route.get("history") != "compact" or compact is None:
+        return messages
+    history = fit_budget(compact, history_budget(route["provider"], route["model"]))
+    return history + messages[state.get("history_len", 0):]
@@ -6,23 +6,90 @@ from langchain_core.messages import BaseMessage, SystemMessage, HumanMessage, AI
 from app.graph.self_maintenance_memories_graph import build_word_meanings_prompt
 from app.services.llm import call_llm
 from app.graph.type import ChatState
+from app.graph.node_routing import resolve_node_route, route_messages
+from app.services.journal import current_journal
+from app.services.semantic_cache import CacheLookup, semantic_cache
+from app.services.tenancy import config_tenant_id
+from langchain_core.runnables import RunnableConfig
 from pydantic import BaseModel
 
 # ---- サブグラフ構築ヘルパ ----
 from langgraph.graph import StateGraph as _StateGraph
 
-async def call_llm_node(state: ChatState) -> ChatState:
-    messages_lc = state.get("lc_messages", [])
+async def call_llm_node(state: ChatState, config: RunnableConfig) -> ChatState:
+    route = resolve_node_route(state, "call_llm_node")
+    cached = await _lookup_semantic_cache(state, config, route)
+    if cached is not None and cached.answer is not None:
+        return await _serve_cached(state, route, cached)
+
+    speculation = state.get("speculation")
+    if speculation is not None:
+        state["speculation"] = None
+        if not state.get("word_meanings"):
+            # メモリから差し込むものが無い: 投機の出力がそのまま最終回答になる
+            answer = await speculation.commit(get_stream_writer() if state.get("stream") else None)
+            if answer is not None:
+                state["answer"] = answer
+                state["speculation_result"] = "committed"
+                if cached is not None:
+                    semantic_cache.store(cached, answer)
+                return state
+            state["speculation_result"] = "failed"
+        else:
+            await speculation.cancel()
+            state["speculation_result"] = "cancelled"
+
+    messages_lc = route_messages(state, route)
     word_meanings = state.get("word_meanings", [])
     if len(word_meanings) > 0:
         messages_lc = messages_lc + [build_word_meanings_prompt(word_meanings)]
 
     answer = await call_llm(
-        provider=state["provider"],
-        model=state["model"],
+        provider=route["provider"],
+        model=route["model"],
         messages_lc=messages_lc,
-        temperature=state.get("temperature"),
+        temperature=route["temperature"],
         stream=state.get("stream", False),
+        max_tokens=route["max_tokens"],
+        top_p=route["top_p"],
     )
     state["answer"] = answer
+    if cached is not None:
+        semantic_cache.store(cached, answer)
+    return state
+
+async def _lookup_semantic_cache(state: ChatState, config: RunnableConfig, route: Dict[str, Any]) -> CacheLookup | None:
+    """意味キャッシュの対象なら引く。補助タスクとメモリ無し (degraded) の回答は対象外"""
+    history = state["lc_messages"][:state.get("history_len", len(state["lc_messages"]))]
+    if state.get("aux_task") or state.get("degraded") or not semantic_cache.eligible(history):
+        return None
+    journal = current_journal()
+    cached = await semantic_cache.lookup(
+        config_tenant_id(config), route["provider"], route["model"], history, state.get("word_meanings"),
+        requester=journal.client_key if journal is not None else None,
+    )
+    if cached is not None:
+        state["semantic_cache"] = "hit" if cached.answer is not None else "miss"
+        state["semantic_similarity"] = cached.similarity
+    return cached
+
+async def _serve_cached(state: ChatState, route: Dict[str, Any], cached: CacheLookup) -> ChatState:
+    speculation = state.get("speculation")
+    if speculation is not None:
+        state["speculation"] = None
+        await speculation.cancel()
+        state["speculation_result"] = "cancelled"
+    if state.get("stream"):
+        # 通常の生成と同じ token イベントとして 1 回で流す
+        get_stream_writer()({
+            "event_name": "token",
+            "provider": route["provider"],
+            "model": route["model"],
+            "delta": cached.answer,
+            "partial": cached.answer,
+        })
+    journal = current_journal()
+    if journal is not None:
+        journal.mark_first_token()
+    state["answer"] = cached.answer
     return state
@@ -1,4 +1,7 @@
 from __future__ import annotations
+import asyncio
+import contextlib
+import functools
 from typing import TypedDict, List, Dict, Any, Optional, Literal
 from langgraph.graph import StateGraph
 from langgraph.config import get_stream_writer  # 使うなら (今は未使用)
@@ -7,11 +10,16 @@ from sqlalchemy import select
 from sqlalchemy.ext.asyncio import AsyncSession
 from app.graph.type import ChatState
 from app.services.llm import call_llm_with_output_type
+from app.graph.node_routing import resolve_node_route, route_messages
+from app.services.memory_store import MemoryStoreUnavailable, PendingMemoryWrite, guarded_db, memory_write_queue
+from app.services.tenancy import config_tenant_id
+from app.core.config import settings
+from app.jobs.summarize_memories import summary_scheduler
 from langchain_core.runnables.config import RunnableConfig
 from pydantic import BaseModel
 
 # --- DB Models ---
-from app.db.models.memory import Memory, mark_memory_as_deleted, select_active_memories, select_active_memorys_by_memory_simplicity, upsert_memory  # id, title, content, memory_simplicity,...
+from app.db.models.memory import Memory, mark_memory_as_deleted, select_active_memories, select_active_memorys_by_memory_simplicity, select_active_titles, select_child_catalogue, select_top_level_catalogue, upsert_memory  # id, title, content, memory_simplicity,...
 
 # --- LLM (任意: プロジェクト既存の provider 解決を流用してもよい) ---
 # ここでは抽象インターフェースだけ定義し、実装は後で差し替え
@@ -23,12 +31,101 @@ async def llm_call(prompt: str) -> str:
 
 # ============= ノード実装 =============
 
+def memory_optional(fn):
+    """DB が使えなければメモリ無しで先へ進む (state["degraded"] を立て、以降のメモリ段階は飛ばされる)"""
+    @functools.wraps(fn)
+    async def wrapper(state: ChatState, config: RunnableConfig) -> ChatState:
+        try:
+            return await fn(state, config)
+        except MemoryStoreUnavailable as e:
+            state["degraded"] = True
+            state["notes"] = state.get("notes", []) + [str(e)]
+            return state
+    return wrapper
+
+# カタログに載せる memory_simplicity の上限 (単語 0 と記録 500)
+CATALOGUE_SIMPLICITY = 500
+# 語義が見つからないときに memory_simplicity を上げる幅
+SIMPLICITY_STEP = 500
+
+def _catalogue_line(title: str, summary: str | None, child_count: int) -> str:
+    """階層モードのカタログ 1 行。下位を持つものは件数と要約を添える"""
+    if not child_count:
+        return f"- {title}"
+    return f"- {title} (下位 {child_count} 件): {summary or '要約未作成'}"
+
+async def _fetch_hierarchical_catalogue(state: ChatState, session: AsyncSession, tenant_id: str) -> SystemMessage:
+    wellknown_words = []
+    wellknown_memories = []
+    word_lines = []
+    memory_lines = []
+    expandable = []
+    async with guarded_db("select_catalogue"):
+        catalogue = await select_top_level_catalogue(session, tenant_id, CATALOGUE_SIMPLICITY)
+    for m in catalogue:
+        line = _catalogue_line(m.title, m.summary, m.child_count)
+        if m.memory_simplicity == 0:
+            wellknown_words.append(m.title)
+            word_lines.append(line)
+        else:
+            wellknown_memories.append(m.title)
+            memory_lines.append(line)
+        if m.child_count:
+            expandable.append(m.title)
+
+    state["wellknown_words"] = wellknown_words
+    state["wellknown_memories"] = wellknown_memories
+    state["expandable_memories"] = expandable
+    state["expanded_memories"] = []
+    return SystemMessage(content=(
+        "既知の単語と記録の名称を次に列挙する。下位を持つものは、その名称の意味を要求すると下位の名称も列挙される。\n"
+        + "単語:\n"
+        + "\n".join(word_lines)
+        + "\n記録:\n"
+        + "\n".join(memory_lines)
+    ))
+
+async def _expand_branches(state: ChatState, session: AsyncSession, tenant_id: str, titles: List[str]) -> int:
+    """
+    要求された title のうち下位を持つものを 1 段展開し、下位の名称をカタログに加える。
+    新しく見えるようになった名称の数を返す (語義ループを続けるかの判断に使う)
+    """
+    expanded = set(state.get("expanded_memories", []))
+    targets = [t for t in titles if t in set(state.get("expandable_memories", [])) and t not in expanded]
+    if not targets:
+        return 0
+    async with guarded_db("select_children"):
+        children = await select_child_catalogue(session, tenant_id, targets, CATALOGUE_SIMPLICITY)
+    known = set(state.get("wellknown_words", [])) | set(state.get("wellknown_memories", []))
+    lines: Dict[str, List[str]] = {t: [] for t in targets}
+    added = 0
+    for c in children:
+        lines[c.parent_title].append(_catalogue_line(c.title, c.summary, c.child_count))
+        if c.title in known:
+            continue
+        known.add(c.title)
+        added += 1
+        key = "wellknown_words" if c.memory_simplicity == 0 else "wellknown_memories"
+        state[key] = state.get(key, []) + [c.title]
+        if c.child_count:
+            state["expandable_memories"] = state.get("expandable_memories", []) + [c.title]
+    state["expanded_memories"] = list(expanded) + targets
+    if added:
+        state["lc_messages"] = state.get("lc_messages", []) + [
+            SystemMessage(content="\n".join(
+                f"「{t}」の下位の名称:\n" + "\n".join(lines[t]) for t in targets if lines[t]
+            ))
+        ]
+    return added
+
+@memory_optional
 async def fetch_wellknown_words_node(state: ChatState, config: RunnableConfig) -> ChatState:
     """
     memory_simplicity <= 0 の語彙を title リストで取得して state["wellknown_words"] に格納
     オプション: state に limit / offset / distinct フラグがあれば反映
     """
     session: AsyncSession = config["configurable"]["session"]
+    tenant_id = config_tenant_id(config)
     state.setdefault("wellknown_words", [])
     state.setdefault("word_meanings", [])
     state.setdefault("requested_words", [])
@@ -36,9 +133,15 @@ async def fetch_wellknown_words_node(state: ChatState, config: RunnableConfig) -
 
     memory_simplicity = state.get("memory_simplicity", 0)
 
+    if settings.MEMORY_CATALOGUE_MODE == "hierarchical":
+        state["lc_messages"] = state.get("lc_messages", []) + [await _fetch_hierarchical_catalogue(state, session, tenant_id)]
+        return state
+
     wellknown_words = []
     wellknown_memories = []
-    for m in await select_active_memorys_by_memory_simplicity(session, 500):
+    async with guarded_db("select_catalogue"):
+        catalogue = await select_active_memorys_by_memory_simplicity(session, tenant_id, CATALOGUE_SIMPLICITY)
+    for m in catalogue:
         if m.memory_simplicity == 0:
             wellknown_words.append(m.title)
         else:
@@ -74,7 +177,8 @@ async def ask_word_meanings_node(state: ChatState) -> ChatState:
         wellknown_words = []
         state["requested_words"] = []
         return state
-    lc_messages = state.get("lc_messages", [])
+    route = resolve_node_route(state, "ask_word_meanings_node")
+    lc_messages = route_messages(state, route)
     lc_messages = lc_messages + [
         SystemMessage(content=(
             "列挙されている既知の単語と記録の名称から、この会話において意味の取得が必要なものを列挙せよ。"
@@ -82,35 +186,57 @@ async def ask_word_meanings_node(state: ChatState) -> ChatState:
     ]
 
     out = await call_llm_with_output_type(
-        provider=state["provider"],
-        model=state["model"],
+        provider=route["provider"],
+        model=route["model"],
         messages_lc=lc_messages,
         output_structure=AskWordMeaningsAnswer,
-        temperature=state.get("temperature"),
+        temperature=route["temperature"],
+        max_tokens=route["max_tokens"],
     )
 
     state["requested_words"] = out.requested_words
     return state
 
+@memory_optional
 async def fetch_word_meanings_node(state: ChatState, config: RunnableConfig) -> ChatState:
     """
-    requested_words の中で DB にある単語の意味を取得 (current memory_simplicity の閾値まで)
+    requested_words の中で DB にある単語の意味を取得 (current memory_simplicity の閾値まで)。
+    その閾値で見つからない語は max_memory_simplicity まで閾値を上げて引き直す
     """
     session: AsyncSession = config["configurable"]["session"]
+    tenant_id = config_tenant_id(config)
+    state["last_found_count"] = 0
     if not state.get("requested_words"):
         return state
-    memory_simplicity = state.get("memory_simplicity", 0)
+    # max_memory_simplicity を超える記憶は解放しない
+    max_simplicity = state.get("max_memory_simplicity", 1000)
+    memory_simplicity = min(state.get("memory_simplicity", 0), max_simplicity)
     req = state["requested_words"]
     if not req:
         return state
-    
-    memories = await select_active_memories(session, req, memory_simplicity)
+
+    async with guarded_db("select_meanings"):
+        memories = await select_active_memories(session, tenant_id, req, memory_simplicity)
     found = [{"title": r[0], "content": r[1]} for r in memories]
+    # 見つからなかった語は simplicity を 1 段ずつ上げて引き直す (0 -> 500 -> 1000)
+    unresolved = [w for w in req if w not in {m["title"] for m in found}]
+    while unresolved and memory_simplicity < max_simplicity:
+        memory_simplicity = min(memory_simplicity + SIMPLICITY_STEP, max_simplicity)
+        async with guarded_db("select_meanings"):
+            memories = await select_active_memories(session, tenant_id, unresolved, memory_simplicity)
+        found += [{"title": r[0], "content": r[1]} for r in memories]
+        unresolved = [w for w in unresolved if w not in {m["title"] for m in found}]
+    state["memory_simplicity"] = max(state.get("memory_simplicity", 0), memory_simplicity)
     # 既存とマージ
     existing = {m["title"]: m for m in state.get("word_meanings", [])}
+    state["last_found_count"] = len([m for m in found if existing.get(m["title"]) != m])
     for m in found:
         existing[m["title"]] = m
     state["word_meanings"] = list(existing.values())
+    if settings.MEMORY_CATALOGUE_MODE == "hierarchical":
+        # 枝の展開で新しい名称が見えたら、それも「得たもの」としてループを続ける
+        state["last_found_count"] += await _expand_branches(state, session, tenant_id, req)
+    state["looked_up_words"] = list(dict.fromkeys(state.get("looked_up_words", []) + req))
     state["requested_words"] = []
 
     word_meanings = state.get("word_meanings", [])
@@ -129,18 +255,20 @@ async def ask_more_word_meanings_node(state: ChatState) -> ChatState:
     単語の意味を付加した上で回答を試みる。
     LLM に投げて 'require_more_memory' を判定 (簡易ルール)。
     """
-    lc_messages = state.get("lc_messages", [])
+    route = resolve_node_route(state, "ask_more_word_meanings_node")
+    lc_messages = route_messages(state, route)
     lc_messages = lc_messages + [
         SystemMessage(content=(
             "この会話において、更に言葉の意味が必要な場合は requested_words に羅列して返せ。これ以上の意味が不要なら requested_words は空にせよ。"
         ))]
 
     out = await call_llm_with_output_type(
-        provider=state["provider"],
-        model=state["model"],
+        provider=route["provider"],
+        model=route["model"],
         messages_lc=lc_messages,
         output_structure=AskMoreWordMeaningsAnswer,
-        temperature=state.get("temperature"),
+        temperature=route["temperature"],
+        max_tokens=route["max_tokens"],
     )
     state["requested_words"] = out.requested_words
     state["memory_simplicity"] = state.get("memory_simplicity", 0) + 500
@@ -156,6 +284,7 @@ def build_word_meanings_prompt(word_meanings: List[dict]) -> str:
 class WordDefinition(BaseModel):
     title: str
     content: str
+    parent_title: Optional[str] = None
 
 class AskUpdatedMemoriesAnswer(BaseModel):
     updated_words: List[WordDefinition]
@@ -167,22 +296,25 @@ async def ask_updated_memories_node(state: ChatState) -> ChatState:
     簡易: requested_words のうち未登録 = updated_words。
     updated_memories は今回は空の雛形。
     """
-    lc_messages = state.get("lc_messages", [])
+    route = resolve_node_route(state, "ask_updated_memories_node")
+    lc_messages = route_messages(state, route)
     lc_messages = lc_messages + [
         SystemMessage(content=(
             "この会話における、あなたの知らなかった固有名詞や特徴的な意味の単語や、記憶しておくべき知識や出来事を記録したいです。" \
             "記録すべき単語は updated_words の title に名前を、 content に説明を含む辞書のリストとして返せ。" \
             "記録すべき知識や出来事は updated_memories の title に名前を、 content に説明を含む辞書のリストとして返せ。" \
             "ここで指定した title は今後の会話で参照されるため、あなたが識別しやすい名前をつけよ。" \
+            "既知の記録の下位に置くべきものは parent_title にその記録の名称を指定せよ。" \
             "不要なものや削除するように指示されたものには content を空文字列を指定せよ。" \
         ))]
 
     out = await call_llm_with_output_type(
-        provider=state["provider"],
-        model=state["model"],
+        provider=route["provider"],
+        model=route["model"],
         messages_lc=lc_messages,
         output_structure=AskUpdatedMemoriesAnswer,
-        temperature=state.get("temperature"),
+        temperature=route["temperature"],
+        max_tokens=route["max_tokens"],
     )
 
     state["updated_words"] = out.updated_words
@@ -191,29 +323,163 @@ async def ask_updated_memories_node(state: ChatState) -> ChatState:
 
 async def save_updated_memories_node(state: ChatState, config: RunnableConfig) -> ChatState:
     """
-    updated_words / updated_memories を DB に upsert (簡易: INSERT IGNORE 的挙動)
+    updated_words (simplicity=0) / updated_memories (simplicity=500) を DB に upsert する。content が空なら論理削除。
+    DB が使えなければ書き込みを memory_write_queue に預けて復旧後に書き戻す。
     """
     session: AsyncSession = config["configurable"]["session"]
-    if state.get("updated_words"):
-        for w in state["updated_words"]:
-            if w.content is None or w.content == "":
-                # content が None の場合は削除
-                await mark_memory_as_deleted(session, title=w.title)
-            else:
-                await upsert_memory(session, title=w.title, content=w.content or "", parent_titles=[], memory_simplicity=0)  # 型チェック回避のダミー呼び出し
-    # updated_memories (simplicity=500)
-    if state.get("updated_memories"):
-        for w in state["updated_memories"]:
-            if w.content is None or w.content == "":
-                # content が None の場合は削除
-                await mark_memory_as_deleted(session, title=w.title)
-            else:
-                await upsert_memory(session, title=w.title, content=w.content or "", parent_titles=[], memory_simplicity=500)  # 型チェック回避のダミー呼び出し
+    tenant_id = config_tenant_id(config)
+    writes = _pending_writes(state, tenant_id)
+    if not writes:
+        return state
+    if state.get("degraded"):
+        memory_write_queue.put(writes)
+        return state
     try:
-        await session.commit()
+        async with guarded_db("save_memories"):
+            for w in writes:
+                if w.content:
+                    await upsert_memory(session, tenant_id, title=w.title, content=w.content, parent_titles=w.parent_titles, memory_simplicity=w.memory_simplicity)
+                else:
+                    await mark_memory_as_deleted(session, tenant_id, title=w.title)
+            await session.commit()
+    except MemoryStoreUnavailable as e:
+        with contextlib.suppress(Exception):
+            async with asyncio.timeout(settings.DB_MEMORY_TIMEOUT or None):
+                await session.rollback()
+        memory_write_queue.put(writes)
+        state["degraded"] = True
+        state["notes"] = state.get("notes", []) + [str(e)]
+        return state
     except Exception as e:
         await session.rollback()
         state["error"] = f"commit failed: {e}"
+        return state
+    # 親の要約の作り直しはバックグラウンドで
+    summary_scheduler.notify()
+    return state
+
+def _pending_writes(state: ChatState, tenant_id: str) -> List[PendingMemoryWrite]:
+    writes = []
+    for key, memory_simplicity in (("updated_words", 0), ("updated_memories", 500)):
+        for w in state.get(key) or []:
+            writes.append(PendingMemoryWrite(tenant_id, w.title, w.content or "", _parent_titles(w), memory_simplicity))
+    return writes
+
+def _parent_titles(w: WordDefinition) -> List[str]:
+    if not w.parent_title or w.parent_title == w.title:
+        return []
+    return [w.parent_title]
+
+# ============= 一括プランナー (MEMORY_PIPELINE_MODE=planner) =============
+# ask_word_meanings / ask_more_word_meanings / ask_updated_memories の 3 回の構造化出力を 1 回にまとめる。
+# 同じ会話とカタログを 3 回 prefill せずに済む代わりに、語義を読んでから追加の語や更新内容を決めることはできない。
+
+class MemoryPlanAnswer(BaseModel):
+    requested_words: List[str]
+    follow_up_words: List[str]
+    updated_words: List[WordDefinition]
+    updated_memories: List[WordDefinition]
+
+async def plan_memory_node(state: ChatState) -> ChatState:
+    """1 回の構造化出力で、引く語・追加で引く語・記録の更新をまとめて決める"""
+    route = resolve_node_route(state, "plan_memory_node")
+    lc_messages = route_messages(state, route)
+    lc_messages = lc_messages + [
+        SystemMessage(content=(
+            "この会話について次の 3 つをまとめて返せ。" \
+            "requested_words: 列挙されている既知の単語と記録の名称から、この会話において意味の取得が必要なもの。" \
+            "follow_up_words: 列挙されていないが記録されていそうな名称で、この会話に必要なもの。不要なら空にせよ。" \
+            "updated_words / updated_memories: この会話における、あなたの知らなかった固有名詞や特徴的な意味の単語 (updated_words) や、" \
+            "記憶しておくべき知識や出来事 (updated_memories) を、title に名前を、content に説明を含む辞書のリストとして返せ。" \
+            "ここで指定した title は今後の会話で参照されるため、あなたが識別しやすい名前をつけよ。" \
+            "既知の記録の下位に置くべきものは parent_title にその記録の名称を指定せよ。" \
+            "既知の名称の内容はここでは見えないので、既知の名称を更新・削除するなら title だけ合っていればよい (内容を読ませた上で改めて尋ねる)。" \
+            "不要なものや削除するように指示されたものには content を空文字列を指定せよ。"
+        ))]
+
+    out = await call_llm_with_output_type(
+        provider=route["provider"],
+        model=route["model"],
+        messages_lc=lc_messages,
+        output_structure=MemoryPlanAnswer,
+        temperature=route["temperature"],
+        max_tokens=route["max_tokens"],
+    )
+    state["requested_words"] = list(dict.fromkeys(out.requested_words + out.follow_up_words))
+    state["updated_words"] = out.updated_words
+    state["updated_memories"] = out.updated_memories
+    return state
+
+async def apply_memory_plan_node(state: ChatState, config: RunnableConfig) -> ChatState:
+    """
+    プランの語義を 1 回の問い合わせで引き、更新を書き込む。
+    follow_up_words はカタログに無い (simplicity の高い) ものなので、max_memory_simplicity までまとめて引く。
+    """
+    if state.get("requested_words") and not state.get("degraded"):
+        state["memory_simplicity"] = state.get("max_memory_simplicity", settings.MAX_MEMORY_SIMPLICITY)
+        state = await fetch_word_meanings_node(state, config)
+    if state.get("updated_words") or state.get("updated_memories"):
+        state = await _drop_blind_overwrites(state, config)
+    if state.get("updated_words") or state.get("updated_memories"):
+        state = await save_updated_memories_node(state, config)
+    return state
+
+_UPDATE_KEYS = ("updated_words", "updated_memories")
+
+async def _existing_titles(state: ChatState, config: RunnableConfig, titles: List[str]) -> set:
+    """titles のうち既にあるもの (カタログ / 取得済みの語義 / DB)。DB が使えなければ MemoryStoreUnavailable"""
+    known = set(state.get("wellknown_words") or []) | set(state.get("wellknown_memories") or [])
+    known |= {m["title"] for m in state.get("word_meanings") or []}
+    unknown = [t for t in dict.fromkeys(titles) if t not in known]
+    if unknown:
+        session: AsyncSession = config["configurable"]["session"]
+        async with guarded_db("select_existing_titles"):
+            known |= set(await select_active_titles(session, config_tenant_id(config), unknown))
+    return known & set(titles)
+
+async def _drop_blind_overwrites(state: ChatState, config: RunnableConfig) -> ChatState:
+    """
+    プランは既存のメモリの内容を読まずに作られる。新規の追加はそのまま残し、既存の title への更新 / 削除があれば
+    その内容を引いてから ask_updated_memories_node で尋ね直す (このときだけ構造化出力が 2 回になり、段階モードと同じ仕事をする)。
+    DB で存在を確かめられなければ (degraded) 何も書かない
+    """
+    updates = [w for key in _UPDATE_KEYS for w in state.get(key) or []]
+    try:
+        if state.get("degraded"):
+            raise MemoryStoreUnavailable("memory plan: cannot check existing memories")
+        existing = await _existing_titles(state, config, [w.title for w in updates])
+        # 中身が空 = 削除。存在しないものの削除は何もしないのと同じ
+        for key in _UPDATE_KEYS:
+            state[key] = [w for w in state.get(key) or [] if w.title not in existing and w.content]
+        if not existing:
+            return state
+        planned = {key: state[key] for key in _UPDATE_KEYS}
+        read = {m["title"] for m in state.get("word_meanings") or []}
+        state["requested_words"] = [t for t in existing if t not in read]
+        if state["requested_words"]:
+            state = await fetch_word_meanings_node(state, config)
+            if state.get("degraded"):
+                raise MemoryStoreUnavailable("memory plan: cannot read existing memories")
+        state = await ask_updated_memories_node(state)
+        # 尋ね直しでも、内容を読んでいない既存の title は書き換えない
+        read = {m["title"] for m in state.get("word_meanings") or []}
+        followed = [w for key in _UPDATE_KEYS for w in state.get(key) or []]
+        existing = await _existing_titles(state, config, [w.title for w in followed if w.title not in read])
+    except MemoryStoreUnavailable as e:
+        state["degraded"] = True
+        state["notes"] = state.get("notes", []) + [str(e)]
+        for key in _UPDATE_KEYS:
+            state[key] = []
+        if updates:
+            state["notes"] = state["notes"] + [f"memory plan: skipped updates: {', '.join(dict.fromkeys(w.title for w in updates))}"]
+        return state
+    skipped = [w.title for w in followed if w.title in existing]
+    if skipped:
+        state["notes"] = state.get("notes", []) + [f"memory plan: skipped updates to unread memories: {', '.join(dict.fromkeys(skipped))}"]
+    for key in _UPDATE_KEYS:
+        answered = [w for w in state.get(key) or [] if w.title not in existing]
+        titles = {w.title for w in answered}
+        state[key] = answered + [w for w in planned[key] if w.title not in titles]
     return state
 
 def finalize_node(state: ChatState) -> ChatState:
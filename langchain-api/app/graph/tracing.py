@@ -0,0 +1,32 @@
+from __future__ import annotations
+import functools
+import inspect
+import time
+from typing import Any, Callable
+from app.graph.type import ChatState
+from app.services.deadline import check as check_deadline
+from app.services.journal import current_journal, set_current_node
+
+def traced_node(name: str, fn: Callable[..., Any]) -> Callable[..., Any]:
+    """
+    ノード実行後に state["route"] へノード名を追記し、所要時間をリクエストジャーナルに記録するラッパー。
+    functools.wraps でシグネチャを引き継ぐので config 注入はそのまま効く。
+    """
+    @functools.wraps(fn)
+    async def wrapper(state: ChatState, *args, **kwargs):
+        # ノード内の LLM 呼び出しをこのノードに紐付ける
+        set_current_node(name)
+        # 期限切れならノードを始めない
+        check_deadline()
+        started = time.perf_counter()
+        try:
+            out = fn(state, *args, **kwargs)
+            if inspect.isawaitable(out):
+                out = await out
+        finally:
+            journal = current_journal()
+            if journal is not None:
+                journal.record_node(name, (time.perf_counter() - started) * 1000)
+        out["route"] = out.get("route", []) + [name]
+        return out
+    return wrapper
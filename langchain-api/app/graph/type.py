@@ -7,17 +7,27 @@ class ChatState(TypedDict, total=False):
     provider: str
     raw_messages: List[Dict[str, str]]
     temperature: float
+    top_p: float
+    max_tokens: int
     stream: bool
     partial_answer: str
     error: str
     # 入力
     lc_messages: List[BaseMessage]
+    history_len: int                      # lc_messages の先頭のうち会話履歴の件数 (以降はノードが足した文脈)
+    compact_history: List[BaseMessage]    # 古い往復を要約に置き換えた履歴 (compact を使うノード向け)
     # 制御
     memory_simplicity: int                # 0 -> 500 -> 1000
     max_memory_simplicity: int            # 上限 (既定 1000)
+    route: List[str]                      # 実行されたノード名 (経路の記録)
     # 取得済み
     wellknown_words: List[str]            # simplicity <= 0 の単語
+    wellknown_memories: List[str]         # simplicity <= 500 の記録
+    expandable_memories: List[str]        # 階層モードで下位を持つ (展開できる) 名称
+    expanded_memories: List[str]          # 階層モードで展開済みの名称
     requested_words: List[str]            # 意味要求が必要な単語
+    looked_up_words: List[str]            # DB に問い合わせ済みの単語
+    last_found_count: int                 # 直近の fetch で新たに得た語義の数
     word_meanings: List[Dict[str, str]]   # {title, content}
     # 応答生成
     answer: str
@@ -27,3 +37,10 @@ class ChatState(TypedDict, total=False):
     updated_memories: List[Dict[str, Any]]  # {title, content, parents:[memory_id]}
     # 出力補助
     notes: List[str]
+    degraded: bool                        # DB が使えずメモリ無しで回答した
+    aux_task: str                         # Open WebUI の補助タスク (title_generation など)。メモリ段階を飛ばす
+    speculation: Any                      # メモリ段階と並行して走らせている最終回答 (app.services.speculation.Speculation)
+    speculation_result: str               # "committed" / "cancelled" / "failed"
+    semantic_cache: str                   # "hit" / "miss" (意味キャッシュを引いたときだけ)
+    semantic_similarity: float            # 最も近かったキャッシュとの類似度
+    memory_pipeline: str                  # "staged" / "planner"
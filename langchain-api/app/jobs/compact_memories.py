@@ -0,0 +1,253 @@
+"""
+論理削除されたメモリの退避 (compaction) ジョブ。
+
+保持期間 (COMPACTION_RETENTION_DAYS) を過ぎた論理削除済みの memories を memories_archive へ移し、
+それに繋がる memory_relations を外してから、ホットなテーブルを VACUUM ANALYZE する。
+小さいバッチ毎にコミットし、他のトランザクションが掴んでいる行は SKIP LOCKED で飛ばすので
+リクエスト処理側を長く待たせない。
+
+    cd langchain-api
+    python -m app.jobs.compact_memories --dry-run
+    python -m app.jobs.compact_memories --retention-days 7 --reindex
+"""
+from __future__ import annotations
+import argparse
+import asyncio
+import contextlib
+import datetime
+import json
+import logging
+from dataclasses import asdict, dataclass, field
+from typing import Any, Dict, List
+from sqlalchemy import delete, func, insert, or_, select, text, tuple_
+from sqlalchemy.exc import DBAPIError
+from app.core.config import settings
+from app.db.session import AsyncSessionLocal, engine
+from app.db.models.archive import ArchivedMemory
+from app.db.models.memory import Memory, MemoryRelation
+
+logger = logging.getLogger(__name__)
+
+# 複数ワーカーで同時に走らせないための advisory lock のキー
+_ADVISORY_LOCK_KEY = 0x6D656D6F  # "memo"
+
+# 退避後に作り直す候補 (リクエスト毎のクエリが使うインデックス)
+_HOT_INDEXES = ("ix_memories_active_title", "ix_memories_active_simplicity_title", "ix_memory_relations_child_id")
+
+@dataclass
+class CompactionReport:
+    dry_run: bool
+    retention_days: float
+    cutoff: str
+    candidates: int = 0
+    candidate_relations: int = 0
+    oldest_deleted_at: str | None = None
+    archived: int = 0
+    relations_removed: int = 0
+    batches: int = 0
+    skipped_locked: bool = False
+    maintenance: List[str] = field(default_factory=list)
+    table_sizes: Dict[str, Dict[str, int]] = field(default_factory=dict)
+    error: str | None = None
+
+    def to_dict(self) -> Dict[str, Any]:
+        return asdict(self)
+
+async def _table_sizes(conn) -> Dict[str, Dict[str, int]]:
+    rows = await conn.execute(text(
+        """
+        SELECT regexp_replace(relname, '_p[0-9]+$', '') AS name,
+               sum(n_live_tup), sum(n_dead_tup), sum(pg_total_relation_size(relid)), sum(pg_indexes_size(relid))
+        FROM pg_stat_user_tables
+        WHERE regexp_replace(relname, '_p[0-9]+$', '') IN ('memories', 'memory_relations', 'memories_archive')
+        GROUP BY 1
+        """
+    ))
+    return {
+        # パーティションは親テーブル名でまとめる
+        name: {"live_rows": int(live), "dead_rows": int(dead), "total_bytes": int(total), "index_bytes": int(indexes)}
+        for name, live, dead, total, indexes in rows.all()
+    }
+
+async def _survey(conn, cutoff: datetime.datetime, report: CompactionReport) -> None:
+    expired = select(Memory.tenant_id, Memory.id).where(Memory.deleted_at != None, Memory.deleted_at < cutoff)
+    report.candidates, oldest = (await conn.execute(
+        select(func.count(), func.min(Memory.deleted_at)).where(Memory.deleted_at != None, Memory.deleted_at < cutoff)
+    )).one()
+    report.oldest_deleted_at = oldest.isoformat() if oldest else None
+    report.candidate_relations = (await conn.execute(
+        select(func.count()).select_from(MemoryRelation).where(
+            or_(
+                tuple_(MemoryRelation.tenant_id, MemoryRelation.parent_id).in_(expired),
+                tuple_(MemoryRelation.tenant_id, MemoryRelation.child_id).in_(expired),
+            )
+        )
+    )).scalar_one()
+
+async def _archive_batch(cutoff: datetime.datetime, batch_size: int) -> tuple[int, int, bool]:
+    """1 バッチ分を 1 トランザクションで退避する。(退避件数, 外した関係数, ロック中で飛ばした行があったか)"""
+    async with AsyncSessionLocal() as session:
+        async with session.begin():
+            # 行ロック待ちで詰まらないよう短く打ち切る
+            await session.execute(text(f"SET LOCAL lock_timeout = '{int(settings.COMPACTION_LOCK_TIMEOUT * 1000)}ms'"))
+            memories = (await session.execute(
+                select(Memory)
+                .where(Memory.deleted_at != None, Memory.deleted_at < cutoff)
+                .order_by(Memory.id)
+                .limit(batch_size)
+                .with_for_update(skip_locked=True)
+            )).scalars().all()
+            if not memories:
+                return 0, 0, False
+            keys = [(m.tenant_id, m.id) for m in memories]
+            touching = or_(
+                tuple_(MemoryRelation.tenant_id, MemoryRelation.parent_id).in_(keys),
+                tuple_(MemoryRelation.tenant_id, MemoryRelation.child_id).in_(keys),
+            )
+            relations = (await session.execute(
+                select(MemoryRelation).where(touching).with_for_update()
+            )).scalars().all()
+            by_memory: Dict[tuple, List[Dict[str, Any]]] = {k: [] for k in keys}
+            for r in relations:
+                snapshot = {"parent_id": r.parent_id, "child_id": r.child_id, "relation": r.relation}
+                for i in {r.parent_id, r.child_id}:
+                    if (r.tenant_id, i) in by_memory:
+                        by_memory[(r.tenant_id, i)].append(snapshot)
+
+            await session.execute(insert(ArchivedMemory), [
+                {
+                    "id": m.id,
+                    "tenant_id": m.tenant_id,
+                    "title": m.title,
+                    "content": m.content,
+                    "source_url": m.source_url,
+                    "memory_simplicity": m.memory_simplicity,
+                    "created_at": m.created_at,
+                    "updated_at": m.updated_at,
+                    "deleted_at": m.deleted_at,
+                    "relations": by_memory[(m.tenant_id, m.id)],
+                }
+                for m in memories
+            ])
+            removed = 0
+            if relations:
+                result = await session.execute(delete(MemoryRelation).where(touching))
+                removed = result.rowcount or 0
+            await session.execute(delete(Memory).where(tuple_(Memory.tenant_id, Memory.id).in_(keys)))
+            return len(keys), removed, len(keys) < batch_size
+
+async def _maintenance(reindex: bool) -> List[str]:
+    """VACUUM / REINDEX CONCURRENTLY はトランザクション外でしか実行できない"""
+    done = []
+    async with engine.connect() as conn:
+        conn = await conn.execution_options(isolation_level="AUTOCOMMIT")
+        for table in ("memories", "memory_relations"):
+            await conn.execute(text(f"VACUUM (ANALYZE) {table}"))
+            done.append(f"VACUUM (ANALYZE) {table}")
+        if reindex:
+            for index in _HOT_INDEXES:
+                await conn.execute(text(f"REINDEX INDEX CONCURRENTLY {index}"))
+                done.append(f"REINDEX INDEX CONCURRENTLY {index}")
+    return done
+
+async def compact_memories(
+    retention_days: float | None = None,
+    batch_size: int | None = None,
+    dry_run: bool = False,
+    reindex: bool | None = None,
+) -> CompactionReport:
+    retention_days = settings.COMPACTION_RETENTION_DAYS if retention_days is None else retention_days
+    batch_size = batch_size or settings.COMPACTION_BATCH_SIZE
+    reindex = settings.COMPACTION_REINDEX if reindex is None else reindex
+    cutoff = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(days=retention_days)
+    report = CompactionReport(dry_run=dry_run, retention_days=retention_days, cutoff=cutoff.isoformat())
+
+    async with engine.connect() as lock_conn:
+        # セッションレベルの advisory lock は接続に紐付くので、終わるまでこの接続を持ち続ける
+        locked = (await lock_conn.execute(select(func.pg_try_advisory_lock(_ADVISORY_LOCK_KEY)))).scalar_one()
+        if not locked:
+            report.error = "another compaction is running"
+            return report
+        try:
+            await _survey(lock_conn, cutoff, report)
+            report.table_sizes = await _table_sizes(lock_conn)
+            await lock_conn.commit()
+            if dry_run or report.candidates == 0:
+                return report
+
+            while True:
+                try:
+                    archived, removed, partial = await _archive_batch(cutoff, batch_size)
+                except DBAPIError as e:
+                    # lock_timeout 等。済んだバッチはコミット済みなので残りは次回
+                    report.error = repr(e.orig)[:500]
+                    break
+                if archived == 0:
+                    break
+                report.batches += 1
+                report.archived += archived
+                report.relations_removed += removed
+                if partial:
+                    # 残りはロック中の行だけ (次回に回す)
+                    report.skipped_locked = report.archived < report.candidates
+                    break
+                await asyncio.sleep(settings.COMPACTION_BATCH_PAUSE)
+
+            if report.archived:
+                report.maintenance = await _maintenance(reindex)
+                report.table_sizes = await _table_sizes(lock_conn)
+        finally:
+            await lock_conn.execute(select(func.pg_advisory_unlock(_ADVISORY_LOCK_KEY)))
+            await lock_conn.commit()
+    return report
+
+class CompactionScheduler:
+    """COMPACTION_INTERVAL_SECONDS 毎に compact_memories を走らせるバックグラウンドタスク"""
+    def __init__(self):
+        self._task: asyncio.Task | None = None
+        self.last_report: CompactionReport | None = None
+
+    def start(self) -> None:
+        if settings.COMPACTION_INTERVAL_SECONDS <= 0 or self._task is not None:
+            return
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+        self._task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await self._task
+        self._task = None
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(settings.COMPACTION_INTERVAL_SECONDS)
+            try:
+                self.last_report = await compact_memories()
+                logger.info("memory compaction: %s", json.dumps(self.last_report.to_dict(), default=str))
+            except Exception:
+                # DB が落ちていても次の周期で再試行する
+                logger.exception("memory compaction failed")
+
+compaction_scheduler = CompactionScheduler()
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="論理削除済みメモリを memories_archive へ退避する")
+    parser.add_argument("--retention-days", type=float, default=None)
+    parser.add_argument("--batch-size", type=int, default=None)
+    parser.add_argument("--dry-run", action="store_true", help="対象件数とテーブルサイズだけ表示する")
+    parser.add_argument("--reindex", action="store_true", default=None, help="退避後にホットなインデックスを作り直す")
+    args = parser.parse_args()
+
+    async def run() -> CompactionReport:
+        try:
+            return await compact_memories(args.retention_days, args.batch_size, args.dry_run, args.reindex)
+        finally:
+            await engine.dispose()
+
+    report = asyncio.run(run())
+    print(json.dumps(report.to_dict(), indent=2, ensure_ascii=False))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,422 @@
+"""
+ほぼ重複したメモリ ("LangGraph" / "Lang Graph" / "langgraph library" 等) をまとめるオフラインジョブ。
+
+テナント毎に、正規化した title と content の MinHash を LSH にかけて候補の組を出し、
+実際の Jaccard 係数で確かめてから union-find でクラスタにする。
+クラスタ毎に代表 (canonical) を 1 件選び、残りの content のうち代表に無い行を代表に足し、
+memory_relations を代表に付け替えて論理削除する。付け替えの前後は memory_merges に残るので --revert で戻せる。
+
+    cd langchain-api
+    python -m app.jobs.consolidate_memories                  # レポートだけ (dry-run)
+    python -m app.jobs.consolidate_memories --apply
+    python -m app.jobs.consolidate_memories --revert <merge_id>
+"""
+from __future__ import annotations
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import random
+import re
+import unicodedata
+from collections import defaultdict
+from dataclasses import asdict, dataclass, field
+from typing import Any, Dict, Iterable, List, Sequence
+from sqlalchemy import delete, func, insert, or_, select, update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from app.db.session import AsyncSessionLocal, engine
+from app.db.models.memory import Memory, MemoryRelation, mark_parents_stale
+from app.db.models.merge_log import MemoryMerge
+
+# 候補の判定
+TITLE_THRESHOLD = 0.5      # title の 3-gram Jaccard
+CONTENT_THRESHOLD = 0.3    # title が近いときに content に求める Jaccard
+SAME_CONTENT_THRESHOLD = 0.8  # title が違っても content がここまで同じなら重複
+CONTENT_CHARS = 2000       # content は先頭だけで比べる
+
+# MinHash / LSH (64 = 16 バンド x 4 行。Jaccard 0.5 前後から候補に上がる)
+NUM_PERM = 64
+BANDS = 16
+_MERSENNE = (1 << 61) - 1
+
+_NON_WORD_RE = re.compile(r"[\W_]+", re.UNICODE)
+_DIGITS_RE = re.compile(r"\d+")
+
+def normalize_title(title: str) -> str:
+    """全角半角・大小文字・空白や記号の違いを吸収する"""
+    return _NON_WORD_RE.sub("", unicodedata.normalize("NFKC", title).casefold())
+
+def shingles(text: str, k: int) -> set[str]:
+    if len(text) <= k:
+        return {text} if text else set()
+    return {text[i:i + k] for i in range(len(text) - k + 1)}
+
+def jaccard(a: set[str], b: set[str]) -> float:
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+class MinHasher:
+    def __init__(self, num_perm: int = NUM_PERM, seed: int = 1):
+        rng = random.Random(seed)
+        self.params = [(rng.randrange(1, _MERSENNE), rng.randrange(0, _MERSENNE)) for _ in range(num_perm)]
+
+    def signature(self, items: Iterable[str]) -> tuple[int, ...]:
+        hashes = [int.from_bytes(hashlib.blake2b(s.encode(), digest_size=8).digest(), "little") for s in items]
+        if not hashes:
+            return tuple(_MERSENNE for _ in self.params)
+        return tuple(min((a * h + b) % _MERSENNE for h in hashes) for a, b in self.params)
+
+def lsh_candidates(signatures: Dict[int, tuple[int, ...]], bands: int = BANDS) -> set[tuple[int, int]]:
+    rows = len(next(iter(signatures.values()))) // bands if signatures else 0
+    pairs: set[tuple[int, int]] = set()
+    for band in range(bands):
+        buckets: Dict[tuple[int, ...], List[int]] = defaultdict(list)
+        for key, sig in signatures.items():
+            buckets[sig[band * rows:(band + 1) * rows]].append(key)
+        for members in buckets.values():
+            for i in range(len(members)):
+                for j in range(i + 1, len(members)):
+                    pairs.add((min(members[i], members[j]), max(members[i], members[j])))
+    return pairs
+
+@dataclass
+class _Doc:
+    id: int
+    title: str
+    content: str
+    memory_simplicity: int
+    norm_title: str
+    title_shingles: set[str]
+    content_shingles: set[str]
+
+def _similarity(a: _Doc, b: _Doc) -> float | None:
+    """重複とみなすなら類似度、違うなら None"""
+    content_sim = jaccard(a.content_shingles, b.content_shingles)
+    if a.norm_title == b.norm_title:
+        return 1.0
+    if _DIGITS_RE.findall(a.norm_title) != _DIGITS_RE.findall(b.norm_title):
+        # "GPT-4" と "GPT-5" のように番号だけ違うものは別物
+        return None
+    title_sim = jaccard(a.title_shingles, b.title_shingles)
+    shorter, longer = sorted((a.norm_title, b.norm_title), key=len)
+    if len(shorter) >= 4 and shorter in longer:
+        # "langgraph" と "langgraphlibrary" のような包含
+        title_sim = max(title_sim, 0.8)
+    if title_sim >= TITLE_THRESHOLD and content_sim >= CONTENT_THRESHOLD:
+        return round((title_sim + content_sim) / 2, 4)
+    if content_sim >= SAME_CONTENT_THRESHOLD:
+        return round(content_sim, 4)
+    return None
+
+@dataclass
+class Cluster:
+    canonical_id: int
+    canonical_title: str
+    members: List[Dict[str, Any]] = field(default_factory=list)  # [{id, title, similarity}] (代表以外)
+    merge_id: str | None = None
+
+@dataclass
+class ConsolidationReport:
+    tenant_id: str
+    dry_run: bool
+    memories: int = 0
+    candidate_pairs: int = 0
+    clusters: List[Cluster] = field(default_factory=list)
+    merged: int = 0
+    relations_repointed: int = 0
+
+    def to_dict(self) -> Dict[str, Any]:
+        return asdict(self)
+
+def find_clusters(rows: Sequence[Any], relation_counts: Dict[int, int]) -> tuple[List[Cluster], int]:
+    """(クラスタ, LSH で出た候補の組の数)"""
+    hasher = MinHasher()
+    docs: Dict[int, _Doc] = {}
+    for r in rows:
+        norm = normalize_title(r.title)
+        content = unicodedata.normalize("NFKC", r.content or "").casefold()[:CONTENT_CHARS]
+        docs[r.id] = _Doc(
+            id=r.id,
+            title=r.title,
+            content=r.content or "",
+            memory_simplicity=r.memory_simplicity,
+            norm_title=norm,
+            title_shingles=shingles(norm, 3),
+            content_shingles=shingles(_NON_WORD_RE.sub(" ", content), 4),
+        )
+    # title と content で別々に候補を出す (片方だけ似ている組も拾う)
+    pairs = lsh_candidates({i: hasher.signature(d.title_shingles) for i, d in docs.items()})
+    pairs |= lsh_candidates({i: hasher.signature(d.content_shingles) for i, d in docs.items()})
+    # 正規化 title が完全一致するものは LSH に頼らず必ず組にする
+    by_norm: Dict[str, List[int]] = defaultdict(list)
+    for d in docs.values():
+        by_norm[d.norm_title].append(d.id)
+    for ids in by_norm.values():
+        pairs |= {(min(a, b), max(a, b)) for a in ids for b in ids if a != b}
+
+    parent = {i: i for i in docs}
+
+    def find(i: int) -> int:
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    sims: Dict[tuple[int, int], float] = {}
+    for a, b in pairs:
+        sim = _similarity(docs[a], docs[b])
+        if sim is not None:
+            sims[(a, b)] = sim
+            parent[find(a)] = find(b)
+
+    groups: Dict[int, List[int]] = defaultdict(list)
+    for i in docs:
+        groups[find(i)].append(i)
+
+    clusters = []
+    for ids in groups.values():
+        if len(ids) < 2:
+            continue
+        # 代表: 関係の多いもの > content の長いもの > 古いもの
+        canonical = min(ids, key=lambda i: (-relation_counts.get(i, 0), -len(docs[i].content), i))
+        members = []
+        for i in sorted(ids):
+            if i == canonical:
+                continue
+            # 他のメンバー経由で繋がっただけのもの (A~B, B~C で A と C は似ていない) は今回は見送る
+            sim = sims.get((min(i, canonical), max(i, canonical)))
+            if sim is not None:
+                members.append({"id": i, "title": docs[i].title, "similarity": sim})
+        if not members:
+            continue
+        clusters.append(Cluster(canonical_id=canonical, canonical_title=docs[canonical].title, members=members))
+    clusters.sort(key=lambda c: -len(c.members))
+    return clusters, len(pairs)
+
+def _content_key(line: str) -> str:
+    return _NON_WORD_RE.sub("", unicodedata.normalize("NFKC", line).casefold())
+
+def fold_contents(canonical: str, others: Sequence[str]) -> str:
+    """others の行のうち canonical (と先に足した行) に無いものを末尾に足す。表記揺れだけの違いは同じ行とみなす"""
+    lines = canonical.split("\n") if canonical else []
+    seen = {_content_key(line) for line in lines}
+    whole = _content_key(canonical)
+    for text in others:
+        for line in (text or "").split("\n"):
+            key = _content_key(line)
+            if not key or key in seen or key in whole:
+                continue
+            seen.add(key)
+            lines.append(line)
+    return "\n".join(lines)
+
+def _relation_dict(r: MemoryRelation) -> Dict[str, Any]:
+    return {"parent_id": r.parent_id, "child_id": r.child_id, "relation": r.relation}
+
+async def _merge_cluster(tenant_id: str, cluster: Cluster) -> int:
+    """1 クラスタを 1 トランザクションで統合する。付け替えた関係の数を返す"""
+    merge_id = "merge-" + os.urandom(8).hex()
+    merged_ids = [m["id"] for m in cluster.members]
+    repointed = 0
+    async with AsyncSessionLocal() as session:
+        async with session.begin():
+            members = {
+                m.id: m for m in (await session.execute(
+                    select(Memory)
+                    .where(Memory.tenant_id == tenant_id, Memory.id.in_([cluster.canonical_id] + merged_ids))
+                    .with_for_update()
+                )).scalars().all()
+            }
+            canonical = members.get(cluster.canonical_id)
+            if canonical is None or canonical.deleted_at is not None:
+                return 0
+            simplicity_before = canonical.memory_simplicity
+            content_before = canonical.content
+            merged_ids = [i for i in merged_ids if i in members and members[i].deleted_at is None]
+            if not merged_ids:
+                return 0
+            # 一番見えやすい (小さい) memory_simplicity に揃える
+            canonical.memory_simplicity = min(members[i].memory_simplicity for i in [cluster.canonical_id] + merged_ids)
+            # 重複側にしか無い事実を失わないよう、代表に無い行を足す
+            canonical.content = fold_contents(canonical.content, [members[i].content for i in merged_ids])
+            # 関係を消す前に、統合されるものの親の要約を作り直し待ちにする
+            for i in merged_ids:
+                await mark_parents_stale(session, tenant_id, i)
+
+            relations = (await session.execute(
+                select(MemoryRelation).where(
+                    MemoryRelation.tenant_id == tenant_id,
+                    or_(MemoryRelation.parent_id.in_(merged_ids), MemoryRelation.child_id.in_(merged_ids)),
+                ).with_for_update()
+            )).scalars().all()
+            existing = set((await session.execute(
+                select(MemoryRelation.parent_id, MemoryRelation.child_id).where(
+                    MemoryRelation.tenant_id == tenant_id,
+                    or_(MemoryRelation.parent_id == canonical.id, MemoryRelation.child_id == canonical.id),
+                )
+            )).all())
+
+            removed: Dict[int, List[Dict[str, Any]]] = defaultdict(list)
+            added: Dict[int, List[Dict[str, Any]]] = defaultdict(list)
+            for r in relations:
+                owner = r.parent_id if r.parent_id in merged_ids else r.child_id
+                removed[owner].append(_relation_dict(r))
+                parent_id = canonical.id if r.parent_id in merged_ids else r.parent_id
+                child_id = canonical.id if r.child_id in merged_ids else r.child_id
+                if parent_id == child_id or (parent_id, child_id) in existing:
+                    continue
+                existing.add((parent_id, child_id))
+                added[owner].append({"parent_id": parent_id, "child_id": child_id, "relation": r.relation})
+            if relations:
+                await session.execute(delete(MemoryRelation).where(
+                    MemoryRelation.tenant_id == tenant_id,
+                    or_(MemoryRelation.parent_id.in_(merged_ids), MemoryRelation.child_id.in_(merged_ids)),
+                ))
+            new_relations = [{"tenant_id": tenant_id, **a} for rows in added.values() for a in rows]
+            if new_relations:
+                await session.execute(pg_insert(MemoryRelation).on_conflict_do_nothing(), new_relations)
+                repointed = len(new_relations)
+
+            await session.execute(
+                update(Memory)
+                .where(Memory.tenant_id == tenant_id, Memory.id.in_(merged_ids))
+                .values(deleted_at=func.now())
+            )
+            # 代表の content と (付け替えで増えた) 子が変わったので、代表自身と付け替え後の親の要約も作り直す
+            canonical.summary_stale = True
+            await session.flush()
+            await mark_parents_stale(session, tenant_id, canonical.id)
+            similarity = {m["id"]: m["similarity"] for m in cluster.members}
+            await session.execute(insert(MemoryMerge), [
+                {
+                    "merge_id": merge_id,
+                    "tenant_id": tenant_id,
+                    "canonical_id": canonical.id,
+                    "canonical_title": canonical.title,
+                    "canonical_simplicity_before": simplicity_before,
+                    "canonical_content_before": content_before,
+                    "merged_id": i,
+                    "merged_title": members[i].title,
+                    "similarity": similarity[i],
+                    "relations_removed": removed[i],
+                    "relations_added": added[i],
+                }
+                for i in merged_ids
+            ])
+    cluster.merge_id = merge_id
+    return repointed
+
+async def consolidate_memories(tenant_id: str, dry_run: bool = True) -> ConsolidationReport:
+    report = ConsolidationReport(tenant_id=tenant_id, dry_run=dry_run)
+    async with AsyncSessionLocal() as session:
+        rows = (await session.execute(
+            select(Memory.id, Memory.title, Memory.content, Memory.memory_simplicity)
+            .where(Memory.tenant_id == tenant_id, Memory.deleted_at == None)
+        )).all()
+        relation_counts: Dict[int, int] = defaultdict(int)
+        for parent_id, child_id in (await session.execute(
+            select(MemoryRelation.parent_id, MemoryRelation.child_id).where(MemoryRelation.tenant_id == tenant_id)
+        )).all():
+            relation_counts[parent_id] += 1
+            relation_counts[child_id] += 1
+    report.memories = len(rows)
+    report.clusters, report.candidate_pairs = find_clusters(rows, relation_counts)
+    if dry_run:
+        return report
+    for cluster in report.clusters:
+        report.relations_repointed += await _merge_cluster(tenant_id, cluster)
+        if cluster.merge_id:
+            report.merged += len(cluster.members)
+    return report
+
+async def revert_merge(merge_id: str) -> int:
+    """merge_id の統合を取り消す。戻したメモリの件数を返す (退避ジョブで archive 済みのものは戻せない)"""
+    async with AsyncSessionLocal() as session:
+        async with session.begin():
+            logs = (await session.execute(
+                select(MemoryMerge).where(MemoryMerge.merge_id == merge_id, MemoryMerge.reverted_at == None).with_for_update()
+            )).scalars().all()
+            if not logs:
+                return 0
+            tenant_id = logs[0].tenant_id
+            for log in logs:
+                for a in log.relations_added:
+                    await session.execute(delete(MemoryRelation).where(
+                        MemoryRelation.tenant_id == tenant_id,
+                        MemoryRelation.parent_id == a["parent_id"],
+                        MemoryRelation.child_id == a["child_id"],
+                    ))
+            restored = (await session.execute(
+                update(Memory)
+                .where(Memory.tenant_id == tenant_id, Memory.id.in_([log.merged_id for log in logs]))
+                .values(deleted_at=None)
+                .returning(Memory.id)
+            )).scalars().all()
+            removed = [
+                {"tenant_id": tenant_id, **r}
+                for log in logs if log.merged_id in restored
+                for r in log.relations_removed
+            ]
+            if removed:
+                await session.execute(pg_insert(MemoryRelation).on_conflict_do_nothing(), removed)
+            canonical_values: Dict[str, Any] = {"memory_simplicity": logs[0].canonical_simplicity_before, "summary_stale": True}
+            if logs[0].canonical_content_before is not None:
+                canonical_values["content"] = logs[0].canonical_content_before
+            await session.execute(
+                update(Memory)
+                .where(Memory.tenant_id == tenant_id, Memory.id == logs[0].canonical_id)
+                .values(**canonical_values)
+            )
+            for memory_id in [logs[0].canonical_id] + list(restored):
+                await mark_parents_stale(session, tenant_id, memory_id)
+            await session.execute(
+                update(MemoryMerge).where(MemoryMerge.merge_id == merge_id).values(reverted_at=func.now())
+            )
+            return len(restored)
+
+async def list_tenants() -> List[str]:
+    async with AsyncSessionLocal() as session:
+        return list((await session.execute(
+            select(Memory.tenant_id).where(Memory.deleted_at == None).distinct()
+        )).scalars().all())
+
+def print_report(report: ConsolidationReport) -> None:
+    mode = "dry-run" if report.dry_run else "applied"
+    print(f"[{report.tenant_id}] {mode}: {report.memories} memories, {report.candidate_pairs} candidate pairs, {len(report.clusters)} clusters")
+    for c in report.clusters:
+        suffix = f"  ({c.merge_id})" if c.merge_id else ""
+        print(f"  * {c.canonical_title} [#{c.canonical_id}]{suffix}")
+        for m in c.members:
+            print(f"      <- {m['title']} [#{m['id']}] similarity={m['similarity']}")
+    if not report.dry_run:
+        print(f"  merged {report.merged}, re-pointed {report.relations_repointed} relations")
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="ほぼ重複したメモリを統合する")
+    parser.add_argument("--tenant", action="append", help="対象テナント (省略時は全テナント)")
+    parser.add_argument("--apply", action="store_true", help="実際に統合する (省略時はレポートのみ)")
+    parser.add_argument("--revert", metavar="MERGE_ID", help="統合を取り消す")
+    parser.add_argument("--json", action="store_true")
+    args = parser.parse_args()
+
+    async def run() -> None:
+        try:
+            if args.revert:
+                print(f"restored {await revert_merge(args.revert)} memories")
+                return
+            tenants = args.tenant or await list_tenants()
+            reports = [await consolidate_memories(t, dry_run=not args.apply) for t in tenants]
+            if args.json:
+                print(json.dumps([r.to_dict() for r in reports], indent=2, ensure_ascii=False))
+            else:
+                for r in reports:
+                    print_report(r)
+        finally:
+            await engine.dispose()
+
+    asyncio.run(run())
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,204 @@
+"""
+階層モード (MEMORY_CATALOGUE_MODE=hierarchical) の親メモリ要約ジョブ。
+
+子が追加・更新・削除されると upsert_memory / mark_memory_as_deleted が親の summary_stale を立てる。
+このジョブは stale な親だけを拾って子の一覧から要約を作り直し、要約が変わった親はさらにその親を stale にする。
+変更のあった枝だけを根に向かって辿るので、ストア全体を舐め直すことはない。
+
+    cd langchain-api
+    python -m app.jobs.summarize_memories
+    python -m app.jobs.summarize_memories --batch-size 100
+"""
+from __future__ import annotations
+import argparse
+import asyncio
+import contextlib
+import json
+import logging
+from dataclasses import asdict, dataclass
+from typing import Any, Dict, List, Set, Tuple
+from langchain_core.messages import HumanMessage, SystemMessage
+from sqlalchemy import func, select, tuple_, update
+from app.core.config import settings
+from app.db.session import AsyncSessionLocal, engine
+from app.db.models.memory import Memory, MemoryRelation, mark_parents_stale
+from app.services.llm import call_llm
+from app.services.providers import resolve_provider
+
+logger = logging.getLogger(__name__)
+
+# 要約の入力に載せる子 1 件あたりの文字数
+_CHILD_TEXT_LIMIT = 300
+
+@dataclass
+class SummaryReport:
+    summarized: int = 0
+    cleared: int = 0       # 子が居なくなって要約を消した親
+    propagated: int = 0    # 要約が変わり、その親を stale にした件数
+    failed: int = 0
+    error: str | None = None
+
+    def to_dict(self) -> Dict[str, Any]:
+        return asdict(self)
+
+def summary_route() -> Tuple[str, str]:
+    return resolve_provider(settings.MEMORY_SUMMARY_MODEL or settings.MEMORY_NODE_MODEL or settings.DEFAULT_MODEL, None)
+
+async def _claim(batch_size: int, seen: Set[Tuple[str, int]]) -> List[Tuple[str, int, str]]:
+    """stale な親を取って stale を下ろす。生成中に子が変われば再び立つので取りこぼさない"""
+    async with AsyncSessionLocal() as session:
+        async with session.begin():
+            stmt = (
+                select(Memory.tenant_id, Memory.id, Memory.title)
+                .where(Memory.summary_stale == True, Memory.deleted_at == None)
+                .order_by(Memory.id)
+                .limit(batch_size)
+                .with_for_update(skip_locked=True)
+            )
+            if seen:
+                # 同じ起床中に要約済みのもの (循環した関係) は次の周期へ回す
+                stmt = stmt.where(tuple_(Memory.tenant_id, Memory.id).notin_(seen))
+            rows = (await session.execute(stmt)).all()
+            if rows:
+                await session.execute(
+                    update(Memory)
+                    .where(tuple_(Memory.tenant_id, Memory.id).in_([(r.tenant_id, r.id) for r in rows]))
+                    .values(summary_stale=False)
+                )
+    return [(r.tenant_id, r.id, r.title) for r in rows]
+
+async def _children(tenant_id: str, parent_id: int) -> List[Tuple[str, str, str | None]]:
+    async with AsyncSessionLocal() as session:
+        rows = (await session.execute(
+            select(Memory.title, Memory.content, Memory.summary)
+            .join(MemoryRelation, (MemoryRelation.tenant_id == Memory.tenant_id) & (MemoryRelation.child_id == Memory.id))
+            .where(MemoryRelation.tenant_id == tenant_id, MemoryRelation.parent_id == parent_id, Memory.deleted_at == None)
+            .order_by(Memory.updated_at.desc())
+            .limit(settings.MEMORY_SUMMARY_MAX_CHILDREN)
+        )).all()
+    return [(r.title, r.content, r.summary) for r in rows]
+
+async def _summarize(title: str, children: List[Tuple[str, str, str | None]]) -> str:
+    provider, model = summary_route()
+    lines = []
+    for child_title, content, summary in children:
+        text = f"{content} (配下: {summary})" if summary else content
+        lines.append(f"- {child_title}: {text[:_CHILD_TEXT_LIMIT]}")
+    messages = [
+        SystemMessage(content=(
+            f"次は記録「{title}」の下位にある記録の一覧である。"
+            "どのような内容が下位にあるか、会話中に展開が必要か判断できるように 2〜3 文で要約せよ。要約だけを出力せよ。"
+        )),
+        HumanMessage(content="\n".join(lines)),
+    ]
+    out = await call_llm(provider, model, messages, temperature=0.0, stream=False, max_tokens=settings.MEMORY_SUMMARY_MAX_TOKENS or None)
+    return out.strip()
+
+async def _store(tenant_id: str, memory_id: int, summary: str | None, report: SummaryReport) -> None:
+    async with AsyncSessionLocal() as session:
+        async with session.begin():
+            before = (await session.execute(
+                select(Memory.summary).where(Memory.tenant_id == tenant_id, Memory.id == memory_id, Memory.deleted_at == None)
+            )).first()
+            if before is None:
+                return
+            await session.execute(
+                update(Memory)
+                .where(Memory.tenant_id == tenant_id, Memory.id == memory_id)
+                .values(summary=summary, summary_updated_at=func.now())
+            )
+            if before.summary != summary:
+                # 上位の要約は子の要約を含むので根に向かって伝播させる
+                await mark_parents_stale(session, tenant_id, memory_id)
+                report.propagated += 1
+
+async def _restale(keys: List[Tuple[str, int]]) -> None:
+    async with AsyncSessionLocal() as session:
+        async with session.begin():
+            await session.execute(
+                update(Memory).where(tuple_(Memory.tenant_id, Memory.id).in_(keys)).values(summary_stale=True)
+            )
+
+async def summarize_stale_memories(batch_size: int | None = None) -> SummaryReport:
+    """stale な親が無くなるまで (または LLM が失敗するまで) 要約を作り直す"""
+    batch_size = batch_size or settings.MEMORY_SUMMARY_BATCH_SIZE
+    report = SummaryReport()
+    seen: Set[Tuple[str, int]] = set()
+    while True:
+        claimed = await _claim(batch_size, seen)
+        if not claimed:
+            return report
+        for i, (tenant_id, memory_id, title) in enumerate(claimed):
+            seen.add((tenant_id, memory_id))
+            children = await _children(tenant_id, memory_id)
+            if not children:
+                await _store(tenant_id, memory_id, None, report)
+                report.cleared += 1
+                continue
+            try:
+                summary = await _summarize(title, children)
+            except Exception as e:
+                # LLM が落ちているなら残りも失敗するので stale に戻して次の周期へ
+                report.failed += 1
+                report.error = repr(e)[:500]
+                await _restale([(t, m) for t, m, _ in claimed[i:]])
+                return report
+            await _store(tenant_id, memory_id, summary or None, report)
+            report.summarized += 1
+
+class SummaryScheduler:
+    """notify() されるか MEMORY_SUMMARY_INTERVAL_SECONDS 経つ毎に summarize_stale_memories を走らせる"""
+    def __init__(self):
+        self._task: asyncio.Task | None = None
+        self._wakeup = asyncio.Event()
+        self.last_report: SummaryReport | None = None
+
+    def start(self) -> None:
+        if settings.MEMORY_CATALOGUE_MODE != "hierarchical" or settings.MEMORY_SUMMARY_INTERVAL_SECONDS <= 0 or self._task is not None:
+            return
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+        self._task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await self._task
+        self._task = None
+
+    def notify(self) -> None:
+        """メモリ保存後に呼ぶ。リクエスト側は待たない"""
+        if self._task is not None:
+            self._wakeup.set()
+
+    async def _run(self) -> None:
+        while True:
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self._wakeup.wait(), timeout=settings.MEMORY_SUMMARY_INTERVAL_SECONDS)
+            self._wakeup.clear()
+            try:
+                self.last_report = await summarize_stale_memories()
+                if self.last_report.summarized or self.last_report.failed:
+                    logger.info("memory summaries: %s", json.dumps(self.last_report.to_dict()))
+            except Exception:
+                # DB が落ちていても次の周期で再試行する
+                logger.exception("memory summary update failed")
+
+summary_scheduler = SummaryScheduler()
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="stale な親メモリの要約を作り直す")
+    parser.add_argument("--batch-size", type=int, default=None)
+    args = parser.parse_args()
+
+    async def run() -> SummaryReport:
+        try:
+            return await summarize_stale_memories(args.batch_size)
+        finally:
+            await engine.dispose()
+
+    report = asyncio.run(run())
+    print(json.dumps(report.to_dict(), indent=2, ensure_ascii=False))
+
+if __name__ == "__main__":
+    main()
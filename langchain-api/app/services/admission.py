@@ -0,0 +1,204 @@
+from __future__ import annotations
+import asyncio
+import hashlib
+import heapq
+import itertools
+import math
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Tuple
+from fastapi import Request
+from app.core.config import settings
+
+# 優先度 (小さいほど先に通す)
+PRIORITY_INTERACTIVE = 0
+PRIORITY_LOW = 10
+
+class AdmissionError(Exception):
+    """受け付けを拒否した。main.py の例外ハンドラで Retry-After 付きのレスポンスにする"""
+    def __init__(self, status_code: int, detail: str, retry_after: float):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+        self.retry_after = max(1, math.ceil(retry_after))
+
+def client_key(request: Request) -> str:
+    """
+    クォータ (と再開できるストリームの持ち主) の単位となるクライアント識別子。
+    API キー > クライアント IP の順に採用する。ADMISSION_TRUST_FORWARDED のときだけ
+    ユーザヘッダ (Open WebUI の転送ヘッダ) を最優先にする (でなければ付け替えるだけで新しいバケツが手に入る)
+    """
+    if settings.ADMISSION_TRUST_FORWARDED and settings.ADMISSION_CLIENT_HEADER:
+        user = request.headers.get(settings.ADMISSION_CLIENT_HEADER)
+        if user:
+            return "user:" + user
+    auth = request.headers.get("authorization", "")
+    if auth.lower().startswith("bearer ") and len(auth) > 7:
+        # キーそのものは保持しない
+        return "key:" + hashlib.sha256(auth[7:].encode()).hexdigest()[:16]
+    if settings.ADMISSION_TRUST_FORWARDED:
+        forwarded = request.headers.get("x-forwarded-for")
+        if forwarded:
+            return "ip:" + forwarded.split(",")[0].strip()
+    return "ip:" + (request.client.host if request.client else "unknown")
+
+def estimate_tokens(messages: List[Dict[str, Any]] | None, max_tokens: int | None) -> int:
+    """
+    リクエストのコストをトークン数で概算する (4 文字 ≒ 1 トークン)。
+    メモリ段階の補助呼び出しで同じ会話が何度も prefill されるので倍率を掛ける。
+    """
+    chars = sum(len(str(m.get("content") or "")) for m in (messages or []))
+    prompt_tokens = chars // 4 + 1
+    completion_tokens = max_tokens or settings.ADMISSION_DEFAULT_COMPLETION_TOKENS
+    return int(prompt_tokens * settings.ADMISSION_PROMPT_MULTIPLIER) + completion_tokens
+
+class TokenBucket:
+    def __init__(self, capacity: float, refill_per_sec: float):
+        self.capacity = capacity
+        self.refill_per_sec = refill_per_sec
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.refill_per_sec)
+        self.updated = now
+
+    def try_take(self, cost: float) -> float:
+        """取れたら 0、取れなければ貯まるまでの秒数を返す"""
+        self._refill()
+        # 容量を超える大きなリクエストも満タンなら通す
+        cost = min(cost, self.capacity)
+        if self.tokens >= cost:
+            self.tokens -= cost
+            return 0.0
+        if self.refill_per_sec <= 0:
+            return float(settings.ADMISSION_TARGET_QUEUE_DELAY)
+        return (cost - self.tokens) / self.refill_per_sec
+
+    def refund(self, cost: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + min(cost, self.capacity))
+
+class Lease:
+    """同時実行枠。release は何度呼んでもよい (ストリーム終了と BackgroundTask の両方から呼ぶ)"""
+    def __init__(self, controller: "AdmissionController | None", priority: int = PRIORITY_INTERACTIVE):
+        self._controller = controller
+        self.priority = priority
+        self.started = time.monotonic()
+        self.queued_seconds = 0.0
+
+    def release(self) -> None:
+        controller, self._controller = self._controller, None
+        if controller is not None:
+            controller._release(self)
+
+class AdmissionController:
+    """
+    クライアント毎のトークンバケット + 全体の同時実行枠 + 優先度付きの有界待ち行列。
+    待ち時間の見込みが目標を超える場合は待たせずに 503 で落とす (load shedding)。
+    """
+    def __init__(self):
+        self._in_flight = 0
+        self._in_flight_by_priority: Dict[int, int] = {}
+        self._waiters: List[Tuple[int, int, asyncio.Future]] = []
+        self._seq = itertools.count()
+        self._buckets: "OrderedDict[str, TokenBucket]" = OrderedDict()
+        self._avg_service_seconds = settings.ADMISSION_INITIAL_SERVICE_TIME
+        self.shed_count = 0
+        self.throttled_count = 0
+
+    def _bucket(self, key: str) -> TokenBucket:
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = TokenBucket(settings.ADMISSION_BUCKET_CAPACITY, settings.ADMISSION_REFILL_PER_SEC)
+            self._buckets[key] = bucket
+            # クライアント数が増え続けてもメモリを使い切らないよう古いものから捨てる
+            while len(self._buckets) > settings.ADMISSION_MAX_CLIENTS:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(key)
+        return bucket
+
+    def _waiting(self) -> int:
+        return sum(1 for _, _, fut in self._waiters if not fut.done())
+
+    async def admit(self, key: str, cost: int, priority: int = PRIORITY_INTERACTIVE) -> Lease:
+        if not settings.ADMISSION_ENABLED:
+            return Lease(None, priority)
+
+        bucket = self._bucket(key)
+        wait = bucket.try_take(cost)
+        if wait > 0:
+            self.throttled_count += 1
+            raise AdmissionError(429, "token quota exceeded", wait)
+
+        lease = Lease(self, priority)
+        if self._in_flight < settings.ADMISSION_MAX_CONCURRENCY and self._waiting() == 0:
+            self._acquire(priority)
+            return lease
+
+        waiting = self._waiting()
+        expected_delay = (waiting + 1) * self._avg_service_seconds / settings.ADMISSION_MAX_CONCURRENCY
+        if waiting >= settings.ADMISSION_MAX_QUEUE or expected_delay > settings.ADMISSION_TARGET_QUEUE_DELAY:
+            bucket.refund(cost)
+            self.shed_count += 1
+            raise AdmissionError(503, "server overloaded", expected_delay)
+
+        fut: asyncio.Future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._seq), fut))
+        queued_at = time.monotonic()
+        try:
+            await asyncio.wait_for(fut, timeout=settings.ADMISSION_TARGET_QUEUE_DELAY)
+        except asyncio.TimeoutError:
+            bucket.refund(cost)
+            self.shed_count += 1
+            raise AdmissionError(503, "queue delay exceeded", self._avg_service_seconds)
+        except asyncio.CancelledError:
+            # 枠を受け取った直後にキャンセルされた場合は返す
+            if fut.done() and not fut.cancelled():
+                self._release_slot(priority)
+            raise
+        lease.queued_seconds = time.monotonic() - queued_at
+        lease.started = time.monotonic()
+        return lease
+
+    def _acquire(self, priority: int) -> None:
+        self._in_flight += 1
+        self._in_flight_by_priority[priority] = self._in_flight_by_priority.get(priority, 0) + 1
+
+    def _release(self, lease: Lease) -> None:
+        elapsed = time.monotonic() - lease.started
+        # 平均処理時間 (EWMA) を待ち時間の見込みに使う
+        self._avg_service_seconds = 0.8 * self._avg_service_seconds + 0.2 * elapsed
+        self._release_slot(lease.priority)
+
+    def _release_slot(self, priority: int) -> None:
+        self._in_flight -= 1
+        self._in_flight_by_priority[priority] = self._in_flight_by_priority.get(priority, 1) - 1
+        while self._waiters and self._in_flight < settings.ADMISSION_MAX_CONCURRENCY:
+            next_priority, _, fut = heapq.heappop(self._waiters)
+            if fut.done():
+                continue
+            self._acquire(next_priority)
+            fut.set_result(None)
+
+    def in_flight(self, max_priority: int | None = None) -> int:
+        """実行中の件数。max_priority を指定するとその優先度以下 (より重要) のみ数える"""
+        if max_priority is None:
+            return self._in_flight
+        return sum(n for p, n in self._in_flight_by_priority.items() if p <= max_priority)
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "enabled": settings.ADMISSION_ENABLED,
+            "in_flight": self._in_flight,
+            "waiting": self._waiting(),
+            "avg_service_seconds": round(self._avg_service_seconds, 3),
+            "shed": self.shed_count,
+            "throttled": self.throttled_count,
+        }
+
+admission = AdmissionController()
+
+async def admit_request(request: Request, messages: List[Dict[str, Any]] | None, max_tokens: int | None, priority: int = PRIORITY_INTERACTIVE) -> Lease:
+    return await admission.admit(client_key(request), estimate_tokens(messages, max_tokens), priority)
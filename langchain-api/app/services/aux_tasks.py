@@ -0,0 +1,46 @@
+from __future__ import annotations
+import re
+from typing import Any, Dict, List
+from app.core.config import settings
+
+# Open WebUI のタスク用プロンプト (タイトル / タグ / フォローアップ / 検索クエリ生成など)。
+# いずれも最後の user メッセージに "### Task:" から始まるテンプレートとして入ってくる
+AUX_TASK_PATTERNS: Dict[str, re.Pattern] = {
+    "title_generation": re.compile(r"(Generate|Create) a concise, 3-5 word title", re.I),
+    "tags_generation": re.compile(r"Generate 1-3 broad tags", re.I),
+    "follow_up_generation": re.compile(r"Suggest 3-5 relevant follow-up questions", re.I),
+    "query_generation": re.compile(r"determine the necessity of generating search queries|Generate a list of relevant search queries", re.I),
+    "autocomplete_generation": re.compile(r"You are an autocompletion system", re.I),
+    "emoji_generation": re.compile(r"reflect the speaker's likely facial expression", re.I),
+}
+# 上に無いテンプレートでも、この形ならタスク用とみなす
+_GENERIC_TASK = re.compile(r"^\s*### Task:.*<chat_history>", re.S)
+# テンプレートの見出し行 ("### Task:" など)。キャプチャの匿名化でこの行だけはそのまま残す
+TEMPLATE_HEADER = re.compile(r"^### (Task|Guidelines|Output|Examples?|Chat History|Context|Instructions?|Rules)\s*:?\s*$", re.I)
+
+def is_task_template(text: str) -> bool:
+    """Open WebUI のタスク用テンプレートの形をしている (AUX_TASK_DETECTION とは無関係に判定)"""
+    return any(p.search(text) for p in AUX_TASK_PATTERNS.values()) or bool(_GENERIC_TASK.search(text))
+
+def _last_user_text(messages: List[Dict[str, Any]]) -> str:
+    for m in reversed(messages or []):
+        if m.get("role") == "user":
+            return str(m.get("content") or "")
+    return ""
+
+def _extra_markers() -> List[str]:
+    return [m.strip() for m in settings.AUX_TASK_EXTRA_MARKERS.split(",") if m.strip()]
+
+def detect_aux_task(messages: List[Dict[str, Any]] | None) -> str | None:
+    """補助タスクならその種類 (title_generation など)、通常の会話なら None"""
+    if not settings.AUX_TASK_DETECTION:
+        return None
+    text = _last_user_text(messages)
+    if not text:
+        return None
+    for name, pattern in AUX_TASK_PATTERNS.items():
+        if pattern.search(text):
+            return name
+    if any(marker in text for marker in _extra_markers()) or _GENERIC_TASK.search(text):
+        return "task"
+    return None
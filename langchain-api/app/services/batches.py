@@ -0,0 +1,398 @@
+from __future__ import annotations
+import asyncio
+import contextlib
+import datetime
+import json
+import logging
+import os
+from dataclasses import dataclass
+from typing import Any, Dict, Iterator, List, Tuple
+from pydantic import ValidationError
+from sqlalchemy import select, update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.orm import undefer
+from langchain_core.runnables.config import RunnableConfig
+from app.core.config import settings
+from app.db.session import AsyncSessionLocal
+from app.db.models.batch import Batch, BatchFile, BatchResult
+from app.services.completions import ChatRequest, run_completion
+from app.services.admission import PRIORITY_INTERACTIVE, PRIORITY_LOW, AdmissionError, admission, estimate_tokens
+from app.services.deadline import DeadlineExceededError, start_deadline
+from app.services.journal import start_journal
+from app.services.llm import LLMUnavailableError
+
+logger = logging.getLogger(__name__)
+
+BATCH_ENDPOINTS = ("/v1/chat/completions",)
+COMPLETION_WINDOWS = {"24h": datetime.timedelta(hours=24)}
+TERMINAL_STATUSES = ("completed", "failed", "expired", "cancelled")
+# ワーカーが拾う (途中で再起動してもここから続ける) 状態
+_ACTIVE_STATUSES = ("validating", "in_progress", "finalizing", "cancelling")
+
+def new_file_id() -> str:
+    return "file-" + os.urandom(12).hex()
+
+def new_batch_id() -> str:
+    return "batch_" + os.urandom(12).hex()
+
+def now_utc() -> datetime.datetime:
+    return datetime.datetime.now(datetime.timezone.utc)
+
+def _ts(value: datetime.datetime | None) -> int | None:
+    return int(value.timestamp()) if value is not None else None
+
+def visible_to(obj: BatchFile | Batch, tenant_id: str, owner: str) -> bool:
+    """
+    テナントに加えて作成者 (admission.client_key) も一致するものだけ見せる。
+    テナントのヘッダは認証されないので、それだけでは他人のバッチや出力を読めてしまう
+    """
+    return obj.tenant_id == tenant_id and obj.client_key == owner
+
+def file_object(f: BatchFile) -> Dict[str, Any]:
+    return {
+        "id": f.id,
+        "object": "file",
+        "bytes": f.bytes,
+        "created_at": _ts(f.created_at),
+        "filename": f.filename,
+        "purpose": f.purpose,
+        "status": "processed",
+    }
+
+def batch_object(b: Batch) -> Dict[str, Any]:
+    """OpenAI の Batch オブジェクトと同じ形"""
+    return {
+        "id": b.id,
+        "object": "batch",
+        "endpoint": b.endpoint,
+        "errors": {"object": "list", "data": b.errors} if b.errors else None,
+        "input_file_id": b.input_file_id,
+        "completion_window": b.completion_window,
+        "status": b.status,
+        "output_file_id": b.output_file_id,
+        "error_file_id": b.error_file_id,
+        "created_at": _ts(b.created_at),
+        "in_progress_at": _ts(b.in_progress_at),
+        "expires_at": _ts(b.expires_at),
+        "finalizing_at": _ts(b.finalizing_at),
+        "completed_at": _ts(b.completed_at),
+        "failed_at": _ts(b.failed_at),
+        "expired_at": _ts(b.expired_at),
+        "cancelling_at": _ts(b.cancelling_at),
+        "cancelled_at": _ts(b.cancelled_at),
+        "request_counts": {"total": b.total, "completed": b.completed, "failed": b.failed},
+        "metadata": b.batch_metadata,
+    }
+
+@dataclass
+class BatchLine:
+    index: int  # 入力ファイルの行番号 (0 始まり)。再起動後も同じ行を指す
+    custom_id: str
+    body: ChatRequest
+
+def parse_batch_input(content: str, endpoint: str) -> Tuple[List[BatchLine], List[Dict[str, Any]]]:
+    """入力 JSONL を検証する。戻り: (行, エラー)。エラーが 1 件でもあればバッチは failed にする"""
+    lines: List[BatchLine] = []
+    errors: List[Dict[str, Any]] = []
+    seen: set[str] = set()
+
+    def error(code: str, message: str, index: int) -> None:
+        errors.append({"code": code, "message": message, "param": None, "line": index + 1})
+
+    for index, raw in enumerate(content.splitlines()):
+        if not raw.strip():
+            continue
+        try:
+            obj = json.loads(raw)
+        except ValueError as e:
+            error("invalid_json_line", f"invalid JSON: {e}", index)
+            continue
+        if not isinstance(obj, dict):
+            error("invalid_request", "each line must be a JSON object", index)
+            continue
+        custom_id = obj.get("custom_id")
+        if not isinstance(custom_id, str) or not custom_id:
+            error("missing_custom_id", "custom_id is required", index)
+            continue
+        if custom_id in seen:
+            error("duplicate_custom_id", f"duplicate custom_id: {custom_id}", index)
+            continue
+        seen.add(custom_id)
+        if obj.get("method", "POST").upper() != "POST":
+            error("invalid_method", "only POST is supported", index)
+            continue
+        if obj.get("url") != endpoint:
+            error("mismatched_endpoint", f"url must be {endpoint}", index)
+            continue
+        try:
+            body = ChatRequest.model_validate(obj.get("body") or {})
+        except ValidationError as e:
+            error("invalid_request", str(e)[:500], index)
+            continue
+        # 結果は /v1/chat/completions の非ストリームと同じ形で返す
+        body.stream = False
+        lines.append(BatchLine(index, custom_id, body))
+    if not lines and not errors:
+        errors.append({"code": "empty_file", "message": "the input file has no requests", "param": None, "line": None})
+    if len(lines) > settings.BATCH_MAX_LINES:
+        errors.append({"code": "too_many_requests", "message": f"at most {settings.BATCH_MAX_LINES} requests per batch", "param": None, "line": None})
+    return lines, errors
+
+@dataclass
+class _BatchContext:
+    id: str
+    tenant_id: str
+    quota_key: str
+    endpoint: str
+    expires_at: datetime.datetime | None
+
+class BatchRunner:
+    """
+    バッチを 1 件ずつ、BATCH_CONCURRENCY 行ずつ処理するバックグラウンドタスク。
+    - 各行は PRIORITY_LOW で受付に並び、対話リクエストが走っている間は新しい行を始めない
+    - 行の結果は 1 行毎にコミットする (batch_results がチェックポイント)。再起動後は結果の無い行から続ける
+    """
+    def __init__(self):
+        self._task: asyncio.Task | None = None
+        self._wakeup = asyncio.Event()
+        self._cancelled: set[str] = set()
+        self._current: Tuple[str, asyncio.Future] | None = None
+
+    def start(self) -> None:
+        if settings.BATCH_CONCURRENCY <= 0 or self._task is not None:
+            return
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+        self._task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await self._task
+        self._task = None
+
+    def notify(self) -> None:
+        self._wakeup.set()
+
+    def cancel(self, batch_id: str) -> None:
+        """処理中の行も止める (結果には含めない)"""
+        self._cancelled.add(batch_id)
+        if self._current is not None and self._current[0] == batch_id:
+            self._current[1].cancel()
+        self._wakeup.set()
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                batch_id = await self._next_batch()
+                if batch_id is None:
+                    with contextlib.suppress(asyncio.TimeoutError):
+                        await asyncio.wait_for(self._wakeup.wait(), timeout=settings.BATCH_POLL_INTERVAL)
+                    self._wakeup.clear()
+                    continue
+                await self._process(batch_id)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                # DB が落ちていても次の周期で再試行する
+                logger.exception("batch runner failed")
+                await asyncio.sleep(settings.BATCH_POLL_INTERVAL)
+
+    async def _next_batch(self) -> str | None:
+        async with AsyncSessionLocal() as session:
+            return (await session.execute(
+                select(Batch.id).where(Batch.status.in_(_ACTIVE_STATUSES)).order_by(Batch.created_at).limit(1)
+            )).scalar_one_or_none()
+
+    async def _process(self, batch_id: str) -> None:
+        async with AsyncSessionLocal() as session:
+            batch = await session.get(Batch, batch_id)
+            if batch.status == "cancelling":
+                await self._finalize(batch_id, "cancelled")
+                return
+            if batch.status == "finalizing":
+                await self._finalize(batch_id, "completed")
+                return
+            input_file = await session.get(BatchFile, batch.input_file_id, options=[undefer(BatchFile.content)])
+            lines, errors = parse_batch_input(input_file.content, batch.endpoint)
+            if batch.status == "validating":
+                if errors:
+                    batch.status = "failed"
+                    batch.errors = errors
+                    batch.failed_at = now_utc()
+                    await session.commit()
+                    return
+                batch.status = "in_progress"
+                batch.total = len(lines)
+                batch.in_progress_at = now_utc()
+                await session.commit()
+            done = set((await session.execute(
+                select(BatchResult.line_index).where(BatchResult.batch_id == batch_id)
+            )).scalars().all())
+            ctx = _BatchContext(
+                id=batch.id,
+                tenant_id=batch.tenant_id,
+                # 利用者の対話用クォータを食い潰さないよう別のバケットにする
+                quota_key="batch:" + (batch.client_key or batch.id),
+                endpoint=batch.endpoint,
+                expires_at=batch.expires_at,
+            )
+
+        pending = [line for line in lines if line.index not in done]
+        if pending:
+            logger.info("batch %s: %d/%d lines to process", batch_id, len(pending), len(lines))
+        lines_task = asyncio.ensure_future(self._run_lines(ctx, pending))
+        self._current = (batch_id, lines_task)
+        try:
+            await lines_task
+        except asyncio.CancelledError:
+            # ランナー自体の停止ならそのまま抜ける (状態は in_progress のまま。次回起動時に続きから)
+            if asyncio.current_task().cancelling() or batch_id not in self._cancelled:
+                raise
+        finally:
+            self._current = None
+
+        if batch_id in self._cancelled or await self._status(batch_id) == "cancelling":
+            final = "cancelled"
+        elif self._expired(ctx):
+            final = "expired"
+        else:
+            final = "completed"
+        await self._finalize(batch_id, final)
+
+    async def _status(self, batch_id: str) -> str | None:
+        async with AsyncSessionLocal() as session:
+            return (await session.execute(select(Batch.status).where(Batch.id == batch_id))).scalar_one_or_none()
+
+    def _expired(self, ctx: _BatchContext) -> bool:
+        return ctx.expires_at is not None and now_utc() > ctx.expires_at
+
+    async def _run_lines(self, ctx: _BatchContext, pending: List[BatchLine]) -> None:
+        queue: Iterator[BatchLine] = iter(pending)
+
+        async def worker() -> None:
+            # 全ワーカーで 1 つのイテレータを共有する (next の間に await が無いので取り合いにならない)
+            for line in queue:
+                await self._wait_for_idle()
+                if ctx.id in self._cancelled or self._expired(ctx):
+                    return
+                await self._run_line(ctx, line)
+
+        await asyncio.gather(*(worker() for _ in range(max(1, settings.BATCH_CONCURRENCY))))
+
+    async def _wait_for_idle(self) -> None:
+        """対話リクエストが走っている間は待つ (走行中の行は止めない)"""
+        if settings.BATCH_PAUSE_WHEN_INTERACTIVE <= 0:
+            return
+        while admission.in_flight(PRIORITY_INTERACTIVE) >= settings.BATCH_PAUSE_WHEN_INTERACTIVE:
+            await asyncio.sleep(0.5)
+
+    async def _run_line(self, ctx: _BatchContext, line: BatchLine) -> None:
+        messages = [m.model_dump() for m in line.body.messages]
+        attempt = 0
+        while True:
+            try:
+                lease = await admission.admit(ctx.quota_key, estimate_tokens(messages, line.body.max_tokens), PRIORITY_LOW)
+            except AdmissionError as e:
+                # 混んでいるだけなので失敗にはせず待ち直す
+                await asyncio.sleep(e.retry_after)
+                continue
+            journal = start_journal("/v1/batches", ctx.quota_key)
+            journal.queue_ms = lease.queued_seconds * 1000
+            start_deadline(settings.BATCH_REQUEST_TIMEOUT or None)
+            status_code, body, error = 200, None, None
+            try:
+                async with AsyncSessionLocal() as session:
+                    _, body = await run_completion(line.body, RunnableConfig(session=session, tenant_id=ctx.tenant_id))
+            except LLMUnavailableError as e:
+                journal.finish(e)
+                attempt += 1
+                if attempt <= settings.BATCH_MAX_RETRIES:
+                    lease.release()
+                    await asyncio.sleep(min(300.0, settings.BATCH_POLL_INTERVAL * 2 ** attempt))
+                    continue
+                status_code, error = 503, {"code": "server_error", "message": str(e)[:1000]}
+            except DeadlineExceededError as e:
+                journal.finish(e)
+                status_code, error = 504, {"code": "timeout", "message": e.detail}
+            except Exception as e:
+                journal.finish(e)
+                status_code, error = 500, {"code": "server_error", "message": repr(e)[:1000]}
+            else:
+                journal.finish()
+            finally:
+                lease.release()
+            await self._record(ctx.id, line, journal.request_id, status_code, body, error)
+            return
+
+    async def _record(self, batch_id: str, line: BatchLine, request_id: str, status_code: int, body: Dict[str, Any] | None, error: Dict[str, Any] | None) -> None:
+        async with AsyncSessionLocal() as session:
+            async with session.begin():
+                inserted = (await session.execute(
+                    pg_insert(BatchResult)
+                    .values(
+                        batch_id=batch_id,
+                        line_index=line.index,
+                        custom_id=line.custom_id,
+                        request_id=request_id,
+                        status_code=status_code,
+                        body=body,
+                        error=error,
+                    )
+                    .on_conflict_do_nothing(constraint="uq_batch_results_batch_line")
+                    .returning(BatchResult.id)
+                )).scalar_one_or_none()
+                if inserted is None:
+                    return
+                counter = Batch.completed if error is None else Batch.failed
+                await session.execute(update(Batch).where(Batch.id == batch_id).values({counter: counter + 1}))
+
+    async def _finalize(self, batch_id: str, final_status: str) -> None:
+        """batch_results を行順に並べて出力 / エラーの JSONL を作り、終了状態にする"""
+        async with AsyncSessionLocal() as session:
+            batch = await session.get(Batch, batch_id)
+            batch.status = "finalizing"
+            batch.finalizing_at = batch.finalizing_at or now_utc()
+            await session.commit()
+
+            results = (await session.execute(
+                select(BatchResult).where(BatchResult.batch_id == batch_id).order_by(BatchResult.line_index)
+            )).scalars().all()
+            output: List[str] = []
+            failed: List[str] = []
+            for r in results:
+                row = {
+                    "id": f"batch_req_{r.id}",
+                    "custom_id": r.custom_id,
+                    "response": {
+                        "status_code": r.status_code,
+                        "request_id": r.request_id,
+                        "body": r.body if r.error is None else {"error": r.error},
+                    },
+                    "error": None,
+                }
+                (output if r.error is None else failed).append(json.dumps(row, ensure_ascii=False))
+
+            for rows, suffix, attr in ((output, "output", "output_file_id"), (failed, "error", "error_file_id")):
+                if not rows or getattr(batch, attr):
+                    continue
+                content = "\n".join(rows) + "\n"
+                f = BatchFile(
+                    id=new_file_id(),
+                    tenant_id=batch.tenant_id,
+                    client_key=batch.client_key,
+                    purpose="batch_output",
+                    filename=f"{batch_id}_{suffix}.jsonl",
+                    bytes=len(content.encode()),
+                    content=content,
+                )
+                session.add(f)
+                setattr(batch, attr, f.id)
+            batch.status = final_status
+            stamp = {"completed": "completed_at", "cancelled": "cancelled_at", "expired": "expired_at"}[final_status]
+            setattr(batch, stamp, now_utc())
+            await session.commit()
+        self._cancelled.discard(batch_id)
+        logger.info("batch %s %s: %d ok, %d failed", batch_id, final_status, len(output), len(failed))
+
+batch_runner = BatchRunner()
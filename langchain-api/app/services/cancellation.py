@@ -0,0 +1,83 @@
+from __future__ import annotations
+import asyncio
+import contextlib
+from typing import Any, AsyncIterator, Awaitable, TypeVar
+from fastapi import Request
+
+T = TypeVar("T")
+
+class ClientDisconnectedError(Exception):
+    """クライアントが切断したのでグラフの実行を打ち切った"""
+
+async def wait_for_disconnect(request: Request) -> None:
+    """http.disconnect を受け取るまで待つ (本文は読み終えている前提)"""
+    while True:
+        message = await request.receive()
+        if message["type"] == "http.disconnect":
+            return
+
+async def run_until_disconnect(request: Request, aw: Awaitable[T]) -> T:
+    """
+    aw を実行し、先にクライアントが切断したら aw をキャンセルして ClientDisconnectedError を送出する。
+    キャンセルは LLM / Ollama への HTTP 接続と DB のクエリまで伝わり、上流の生成も止まる。
+    """
+    task = asyncio.ensure_future(aw)
+    watcher = asyncio.ensure_future(wait_for_disconnect(request))
+    try:
+        await asyncio.wait({task, watcher}, return_when=asyncio.FIRST_COMPLETED)
+    except BaseException:
+        task.cancel()
+        with contextlib.suppress(BaseException):
+            await task
+        raise
+    finally:
+        watcher.cancel()
+    if not task.done():
+        task.cancel()
+        with contextlib.suppress(BaseException):
+            await task
+        raise ClientDisconnectedError()
+    return task.result()
+
+_END = object()
+
+async def iterate_until_disconnect(request: Request, source: AsyncIterator[Any], buffer: int = 16) -> AsyncIterator[Any]:
+    """
+    source を別タスクで回して中身を流す。クライアントが切断したら source ごとキャンセルして ClientDisconnectedError。
+    グラフがメモリ段階で何も送っていない間も切断に気付けるよう、送信の失敗ではなく受信側の http.disconnect を見る。
+    """
+    queue: asyncio.Queue = asyncio.Queue(maxsize=buffer)
+
+    async def pump() -> None:
+        try:
+            async for item in source:
+                await queue.put(item)
+        except Exception as e:
+            await queue.put(e)
+            return
+        await queue.put(_END)
+
+    producer = asyncio.ensure_future(pump())
+    watcher = asyncio.ensure_future(wait_for_disconnect(request))
+    try:
+        while True:
+            getter = asyncio.ensure_future(queue.get())
+            try:
+                await asyncio.wait({getter, watcher}, return_when=asyncio.FIRST_COMPLETED)
+            finally:
+                if not getter.done():
+                    getter.cancel()
+            if watcher.done():
+                raise ClientDisconnectedError()
+            item = getter.result()
+            if item is _END:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        watcher.cancel()
+        if not producer.done():
+            producer.cancel()
+            with contextlib.suppress(BaseException):
+                await producer
@@ -0,0 +1,150 @@
+from __future__ import annotations
+import asyncio
+import contextlib
+import datetime
+import hashlib
+import hmac
+import json
+import os
+import re
+import time
+from typing import Any, Dict
+from app.core.config import settings
+from app.services.aux_tasks import AUX_TASK_PATTERNS, TEMPLATE_HEADER, is_task_template
+
+# キャプチャ対象 (Open WebUI から実際に来るチャット系のみ)
+CAPTURE_PATHS = ("/api/chat", "/v1/chat/completions")
+
+_WORD_RE = re.compile(r"\w", re.UNICODE)
+
+def _template_line(line: str) -> bool:
+    if line.strip() in ("<chat_history>", "</chat_history>"):
+        return True
+    return bool(TEMPLATE_HEADER.match(line)) or any(p.search(line) for p in AUX_TASK_PATTERNS.values())
+
+def anonymize_text(text: str) -> str:
+    """
+    文字数・改行・記号の並びは残して単語文字だけ伏せる。
+    長さ (≒ prefill 量) は再生時にも再現される。Open WebUI のタスク用テンプレートなら、
+    見出しと指示の定型行だけ残して補助タスクとして判定されるようにする (ユーザ自身の見出しは伏せる)
+    """
+    template = is_task_template(text)
+    return "\n".join(
+        line if template and _template_line(line) else _WORD_RE.sub("x", line)
+        for line in text.split("\n")
+    )
+
+def anonymize_client(client: str, salt: bytes) -> str:
+    """IP アドレスは総当たりで戻せるので、キャプチャ毎のランダムな salt で HMAC を取る"""
+    return "anon-" + hmac.new(salt, client.encode(), hashlib.sha256).hexdigest()[:12]
+
+def anonymize_record(record: Dict[str, Any], salt: bytes) -> Dict[str, Any]:
+    body = record.get("body")
+    if isinstance(body, dict):
+        body = dict(body)
+        messages = []
+        for m in body.get("messages") or []:
+            m = dict(m)
+            if isinstance(m.get("content"), str):
+                m["content"] = anonymize_text(m["content"])
+            elif isinstance(m.get("content"), list):
+                # 画像 (base64 の data URL) などテキスト以外の部品は捨てる
+                m["content"] = [
+                    {**part, "text": anonymize_text(part["text"])}
+                    for part in m["content"]
+                    if isinstance(part, dict) and isinstance(part.get("text"), str)
+                ]
+            # 画像などのバイナリは捨てる
+            m.pop("images", None)
+            messages.append(m)
+        body["messages"] = messages
+        for key in ("user", "chat_id", "metadata"):
+            body.pop(key, None)
+    record = {**record, "body": body}
+    if record.get("client"):
+        record["client"] = anonymize_client(record["client"], salt)
+    return record
+
+class CaptureWriter:
+    """
+    リクエストボディと到着時刻を NDJSON に追記する。
+    offset は最初のキャプチャからの経過秒で、リプレイ時の到着間隔の再現に使う。
+    ファイル書き込みはバックグラウンドタスク側でまとめて行い、リクエストは待たせない。
+    """
+    def __init__(self):
+        self._queue: asyncio.Queue | None = None
+        self._task: asyncio.Task | None = None
+        self._t0: float | None = None
+        self._salt = b""
+        self.captured = 0
+        self.dropped = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self._queue is not None
+
+    def start(self) -> None:
+        if not settings.CAPTURE_PATH or self._task is not None:
+            return
+        self._queue = asyncio.Queue(maxsize=settings.CAPTURE_BUFFER_SIZE)
+        # 同じキャプチャ内ではクライアントを束ねられ、キャプチャを跨ぐと突き合わせられない
+        self._salt = os.urandom(16)
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+        self._task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await self._task
+        self._task = None
+        lines = []
+        while self._queue is not None and not self._queue.empty():
+            lines.append(self._queue.get_nowait())
+        if lines:
+            await asyncio.to_thread(self._append, lines)
+        self._queue = None
+
+    def record(self, path: str, body: bytes, client: str | None) -> None:
+        if self._queue is None:
+            return
+        now = time.monotonic()
+        if self._t0 is None:
+            self._t0 = now
+        try:
+            parsed: Any = json.loads(body)
+        except ValueError:
+            parsed = body.decode("utf-8", errors="replace")
+        record = {
+            "offset": round(now - self._t0, 6),
+            "ts": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            "path": path,
+            "client": client,
+            "body": parsed,
+        }
+        if settings.CAPTURE_ANONYMIZE:
+            record = anonymize_record(record, self._salt)
+        try:
+            self._queue.put_nowait(json.dumps(record, ensure_ascii=False))
+            self.captured += 1
+        except asyncio.QueueFull:
+            self.dropped += 1
+
+    async def _run(self) -> None:
+        while True:
+            lines = [await self._queue.get()]
+            while not self._queue.empty():
+                lines.append(self._queue.get_nowait())
+            try:
+                await asyncio.to_thread(self._append, lines)
+            except OSError:
+                self.dropped += len(lines)
+
+    def _append(self, lines: list[str]) -> None:
+        with open(settings.CAPTURE_PATH, "a", encoding="utf-8") as f:
+            f.write("".join(line + "\n" for line in lines))
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {"enabled": self.enabled, "captured": self.captured, "dropped": self.dropped}
+
+capture_writer = CaptureWriter()
@@ -0,0 +1,64 @@
+from __future__ import annotations
+import time
+from typing import Any, Dict
+
+class CircuitOpenError(RuntimeError):
+    """ブレーカーが open のため呼び出しを行わなかったことを示す"""
+    def __init__(self, name: str):
+        super().__init__(f"circuit open: {name}")
+        self.name = name
+
+class CircuitBreaker:
+    """
+    連続失敗回数ベースの簡易サーキットブレーカー。
+    closed -> (failure_threshold 回連続失敗) -> open -> (reset_timeout 経過) -> half_open
+    half_open では 1 件だけ試行を通し、成功なら closed、失敗なら再び open に戻す。
+    """
+    def __init__(self, name: str, failure_threshold: int, reset_timeout: float):
+        self.name = name
+        self.failure_threshold = max(1, failure_threshold)
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self._trial_in_flight = False
+
+    def allow(self) -> bool:
+        if self.state == "closed":
+            return True
+        if self.state == "open":
+            if time.monotonic() - self.opened_at < self.reset_timeout:
+                return False
+            self.state = "half_open"
+            self._trial_in_flight = False
+        # half_open: 試行は同時に 1 件のみ
+        if self._trial_in_flight:
+            return False
+        self._trial_in_flight = True
+        return True
+
+    def record_success(self) -> None:
+        self.state = "closed"
+        self.failures = 0
+        self._trial_in_flight = False
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        self._trial_in_flight = False
+        if self.state == "half_open" or self.failures >= self.failure_threshold:
+            self.state = "open"
+            self.opened_at = time.monotonic()
+
+    def record_cancel(self) -> None:
+        # ヘッジの負け側など、成否を判定せずに打ち切った場合
+        self._trial_in_flight = False
+
+    def snapshot(self) -> Dict[str, Any]:
+        retry_in = 0.0
+        if self.state == "open":
+            retry_in = max(0.0, self.reset_timeout - (time.monotonic() - self.opened_at))
+        return {
+            "state": self.state,
+            "failures": self.failures,
+            "retry_in": round(retry_in, 3),
+        }
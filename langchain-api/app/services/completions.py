@@ -0,0 +1,55 @@
+from __future__ import annotations
+import os
+import time
+from typing import Any, Dict, List, Literal, Optional
+from pydantic import BaseModel
+from langchain_core.runnables.config import RunnableConfig
+from app.graph.chat_graph import run_chat_graph
+from app.services.journal import current_journal
+
+# /v1/chat/completions の要求と非ストリーム応答。/v1/batches の各行も同じものを使う
+
+Role = Literal["system", "user", "assistant", "tool", "function"]
+
+class ChatMessage(BaseModel):
+    role: Role
+    content: str
+
+class ChatRequest(BaseModel):
+    model: Optional[str] = None
+    provider: Optional[str] = None   # 明示切替 (任意)
+    messages: List[ChatMessage]
+    temperature: Optional[float] = 0.7
+    top_p: Optional[float] = 1.0
+    max_tokens: Optional[int] = None
+    stream: Optional[bool] = True
+    stream_options: Optional[Dict[str, Any]] = None  # {"include_usage": true} で最終チャンクに usage
+
+def completion_obj(content: str, model: str, usage: Dict[str, int] | None = None) -> Dict[str, Any]:
+    obj = {
+        "id": "chatcmpl-" + os.urandom(8).hex(),
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{
+            "index": 0,
+            "message": {"role": "assistant", "content": content},
+            "finish_reason": "stop",
+        }],
+    }
+    if usage is not None:
+        obj["usage"] = usage
+    return obj
+
+async def run_completion(req: ChatRequest, config: RunnableConfig) -> tuple[Dict[str, Any], Dict[str, Any]]:
+    """
+    非ストリームの chat.completion を作る。/v1/batches のワーカーも同じものを使う。
+    戻り: (グラフの最終 state, レスポンス本文)
+    """
+    messages = [m.model_dump() for m in req.messages]
+    out = await run_chat_graph(req.model, messages, req.temperature, req.top_p, req.max_tokens, config=config)
+    journal = current_journal()
+    if journal is not None:
+        journal.record_state(out)
+    model_used = f"{out['provider']}:{out['model']}"
+    return out, completion_obj(out.get("answer", ""), model_used, journal.usage() if journal is not None else None)
@@ -0,0 +1,66 @@
+from __future__ import annotations
+import contextvars
+import time
+from fastapi import Request
+from app.core.config import settings
+
+class DeadlineExceededError(TimeoutError):
+    """リクエストの期限を過ぎた。main.py の例外ハンドラで 504 にする"""
+    def __init__(self, detail: str = "request deadline exceeded"):
+        super().__init__(detail)
+        self.detail = detail
+
+# 期限 (time.monotonic() 基準の絶対時刻)。asyncio のループ時刻と同じ時計
+_deadline: contextvars.ContextVar[float | None] = contextvars.ContextVar("request_deadline", default=None)
+
+def timeout_for(request: Request) -> float | None:
+    """
+    リクエストの持ち時間 (秒)。REQUEST_TIMEOUT_HEADER > REQUEST_DEFAULT_TIMEOUT の順に採用し、REQUEST_MAX_TIMEOUT で頭打ちにする。
+    0 以下 / 未指定なら期限なし。
+    """
+    timeout = settings.REQUEST_DEFAULT_TIMEOUT
+    raw = request.headers.get(settings.REQUEST_TIMEOUT_HEADER) if settings.REQUEST_TIMEOUT_HEADER else None
+    if raw:
+        try:
+            timeout = float(raw)
+        except ValueError:
+            pass
+    if settings.REQUEST_MAX_TIMEOUT > 0 and (timeout <= 0 or timeout > settings.REQUEST_MAX_TIMEOUT):
+        timeout = settings.REQUEST_MAX_TIMEOUT
+    return timeout if timeout > 0 else None
+
+def start_deadline(timeout: float | None) -> float | None:
+    deadline = time.monotonic() + timeout if timeout else None
+    _deadline.set(deadline)
+    return deadline
+
+def use_deadline(deadline: float | None) -> None:
+    # StreamingResponse のジェネレータなど、別タスクから続きを実行する場合に使う
+    _deadline.set(deadline)
+
+def current_deadline() -> float | None:
+    return _deadline.get()
+
+def remaining() -> float | None:
+    """期限までの残り秒数 (期限なしなら None)"""
+    deadline = _deadline.get()
+    if deadline is None:
+        return None
+    return deadline - time.monotonic()
+
+def expired() -> bool:
+    left = remaining()
+    return left is not None and left <= 0
+
+def check() -> None:
+    if expired():
+        raise DeadlineExceededError()
+
+def clamp(timeout: float) -> float:
+    """個々の呼び出しのタイムアウトを残り時間で切り詰める。既に期限切れなら DeadlineExceededError"""
+    left = remaining()
+    if left is None:
+        return timeout
+    if left <= 0:
+        raise DeadlineExceededError()
+    return min(timeout, left)
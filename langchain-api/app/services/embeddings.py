@@ -0,0 +1,199 @@
+from __future__ import annotations
+import asyncio
+import base64
+import hashlib
+import logging
+import sys
+from array import array
+from collections import OrderedDict
+from typing import Any, Dict, List, Tuple
+from sqlalchemy import select
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from app.core.config import settings
+from app.db.session import AsyncSessionLocal
+from app.db.models.embedding import EmbeddingCacheEntry
+from app.services.providers import ollama_embed
+
+logger = logging.getLogger(__name__)
+
+def cache_key(model: str, text: str) -> str:
+    return hashlib.sha256(f"{model}\0{text}".encode()).hexdigest()
+
+def _pack(vector: List[float]) -> array:
+    # list[float] の 1/4 程度のメモリで済む。float64 なので値は変わらない
+    return array("d", vector)
+
+def encode_base64(vector: List[float]) -> str:
+    """OpenAI の encoding_format="base64" と同じ float32 リトルエンディアン"""
+    packed = array("f", vector)
+    if sys.byteorder != "little":
+        packed.byteswap()
+    return base64.b64encode(packed.tobytes()).decode()
+
+class EmbeddingLRU:
+    """プロセス内の (model, text) -> 埋め込み のキャッシュ"""
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self._items: "OrderedDict[str, array]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str) -> List[float] | None:
+        packed = self._items.get(key)
+        if packed is None:
+            self.misses += 1
+            return None
+        self._items.move_to_end(key)
+        self.hits += 1
+        return packed.tolist()
+
+    def put(self, key: str, vector: List[float]) -> None:
+        if self.capacity <= 0:
+            return
+        self._items[key] = _pack(vector)
+        self._items.move_to_end(key)
+        while len(self._items) > self.capacity:
+            self._items.popitem(last=False)
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {"size": len(self._items), "capacity": self.capacity, "hits": self.hits, "misses": self.misses}
+
+class MicroBatcher:
+    """
+    同じモデル宛ての入力を EMBEDDING_BATCH_WINDOW_MS の間ためて 1 回の /api/embed にまとめる。
+    EMBEDDING_MAX_BATCH 件たまったら窓を待たずに送る。同じテキストは 1 回だけ計算する。
+    """
+    def __init__(self):
+        self._pending: Dict[str, List[Tuple[str, asyncio.Future]]] = {}
+        self._timers: Dict[str, asyncio.TimerHandle] = {}
+        self._calls: set[asyncio.Task] = set()
+        self.upstream_calls = 0
+        self.upstream_inputs = 0
+
+    async def embed(self, model: str, texts: List[str]) -> Tuple[List[List[float]], float]:
+        """戻り: (埋め込み, この入力分の prompt_tokens (上流呼び出しの分を文字数で按分))"""
+        loop = asyncio.get_running_loop()
+        futures: List[asyncio.Future] = []
+        for text in texts:
+            fut = loop.create_future()
+            self._pending.setdefault(model, []).append((text, fut))
+            futures.append(fut)
+            if len(self._pending[model]) >= settings.EMBEDDING_MAX_BATCH:
+                self._flush(model)
+        if self._pending.get(model) and model not in self._timers:
+            self._timers[model] = loop.call_later(settings.EMBEDDING_BATCH_WINDOW_MS / 1000, self._flush, model)
+        results = await asyncio.gather(*futures)
+        return [vector for vector, _ in results], sum(tokens for _, tokens in results)
+
+    def _flush(self, model: str) -> None:
+        timer = self._timers.pop(model, None)
+        if timer is not None:
+            timer.cancel()
+        batch = self._pending.pop(model, [])
+        if not batch:
+            return
+        task = asyncio.ensure_future(self._call(model, batch))
+        self._calls.add(task)
+        task.add_done_callback(self._calls.discard)
+
+    async def _call(self, model: str, batch: List[Tuple[str, asyncio.Future]]) -> None:
+        unique = list(dict.fromkeys(text for text, fut in batch if not fut.done()))
+        if not unique:
+            return
+        try:
+            vectors, tokens = await ollama_embed(model, unique)
+        except Exception as e:
+            for _, fut in batch:
+                if not fut.done():
+                    fut.set_exception(e)
+            return
+        self.upstream_calls += 1
+        self.upstream_inputs += len(unique)
+        by_text = dict(zip(unique, vectors))
+        total_chars = sum(len(t) for t in unique) or 1
+        for text, fut in batch:
+            if not fut.done():
+                fut.set_result((by_text[text], tokens * len(text) / total_chars))
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "upstream_calls": self.upstream_calls,
+            "upstream_inputs": self.upstream_inputs,
+            "pending": sum(len(v) for v in self._pending.values()),
+        }
+
+class EmbeddingService:
+    """LRU -> (任意) embedding_cache テーブル -> MicroBatcher の順に引く"""
+    def __init__(self):
+        self.cache = EmbeddingLRU(settings.EMBEDDING_CACHE_SIZE)
+        self.batcher = MicroBatcher()
+        self.persistent_hits = 0
+
+    async def embed(self, model: str, texts: List[str]) -> Tuple[List[List[float]], int]:
+        """戻り: (texts と同じ順の埋め込み, prompt_tokens)"""
+        keys = [cache_key(model, t) for t in texts]
+        vectors: Dict[str, List[float]] = {}
+        missing: Dict[str, str] = {}
+        for key, text in zip(keys, texts):
+            if key in vectors or key in missing:
+                continue
+            cached = self.cache.get(key)
+            if cached is not None:
+                vectors[key] = cached
+            else:
+                missing[key] = text
+
+        if missing and settings.EMBEDDING_CACHE_PERSIST:
+            for key, vector in (await self._load(list(missing))).items():
+                vectors[key] = vector
+                self.cache.put(key, vector)
+                del missing[key]
+                self.persistent_hits += 1
+
+        tokens = 0.0
+        if missing:
+            computed, tokens = await self.batcher.embed(model, list(missing.values()))
+            fresh = dict(zip(missing, computed))
+            for key, vector in fresh.items():
+                vectors[key] = vector
+                self.cache.put(key, vector)
+            if settings.EMBEDDING_CACHE_PERSIST:
+                await self._store(model, fresh)
+        return [vectors[key] for key in keys], round(tokens)
+
+    async def _load(self, keys: List[str]) -> Dict[str, List[float]]:
+        # 永続層は補助なので、DB が落ちていても計算し直せば済む
+        try:
+            async with AsyncSessionLocal() as session:
+                rows = (await session.execute(
+                    select(EmbeddingCacheEntry.key, EmbeddingCacheEntry.vector).where(EmbeddingCacheEntry.key.in_(keys))
+                )).all()
+        except Exception:
+            logger.warning("embedding cache lookup failed", exc_info=True)
+            return {}
+        return {key: array("d", vector).tolist() for key, vector in rows}
+
+    async def _store(self, model: str, vectors: Dict[str, List[float]]) -> None:
+        try:
+            async with AsyncSessionLocal() as session:
+                await session.execute(
+                    pg_insert(EmbeddingCacheEntry)
+                    .values([
+                        {"key": key, "model": model, "dims": len(vector), "vector": _pack(vector).tobytes()}
+                        for key, vector in vectors.items()
+                    ])
+                    .on_conflict_do_nothing(index_elements=["key"])
+                )
+                await session.commit()
+        except Exception:
+            logger.warning("embedding cache store failed", exc_info=True)
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "lru": self.cache.snapshot(),
+            "persistent": settings.EMBEDDING_CACHE_PERSIST,
+            "persistent_hits": self.persistent_hits,
+            **self.batcher.snapshot(),
+        }
+
+embedding_service = EmbeddingService()
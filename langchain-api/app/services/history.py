@@ -0,0 +1,164 @@
+from __future__ import annotations
+import asyncio
+import contextlib
+import contextvars
+import hashlib
+import logging
+from collections import OrderedDict
+from typing import Any, Dict, List, Tuple
+from langchain_core.messages import BaseMessage, HumanMessage, SystemMessage
+from app.core.config import settings
+from app.services.llm import call_llm
+from app.services.providers import resolve_provider
+
+logger = logging.getLogger(__name__)
+
+# 要約の入力に載せる 1 メッセージあたりの文字数
+_MESSAGE_TEXT_LIMIT = 2000
+
+def estimate_message_tokens(message: BaseMessage) -> int:
+    # admission.estimate_tokens と同じく 4 文字 ≒ 1 トークン
+    return len(str(message.content or "")) // 4 + 1
+
+def _prefix_hashes(messages: List[BaseMessage]) -> List[str]:
+    """hashes[i] は messages[:i + 1] の内容ハッシュ。前から連鎖させるので接頭辞が同じなら同じ値になる"""
+    hashes: List[str] = []
+    h = ""
+    for m in messages:
+        h = hashlib.sha256(f"{h}\0{m.type}\0{m.content}".encode()).hexdigest()
+        hashes.append(h)
+    return hashes
+
+def _split_head(messages: List[BaseMessage]) -> Tuple[List[BaseMessage], List[BaseMessage]]:
+    """先頭の system メッセージ (システムプロンプト) と会話本体に分ける"""
+    i = 0
+    while i < len(messages) and isinstance(messages[i], SystemMessage):
+        i += 1
+    return messages[:i], messages[i:]
+
+def _recent_start(conversation: List[BaseMessage], keep_turns: int) -> int:
+    """後ろから keep_turns 個目のユーザ発言の位置。そこから後ろはそのまま残す"""
+    seen = 0
+    for i in range(len(conversation) - 1, -1, -1):
+        if isinstance(conversation[i], HumanMessage):
+            seen += 1
+            if seen >= keep_turns:
+                return i
+    return 0
+
+def history_budget(provider: str, model: str) -> int:
+    """モデル毎の履歴のトークン上限。0 なら無制限"""
+    budgets = settings.HISTORY_TOKEN_BUDGETS
+    return int(budgets.get(f"{provider}:{model}") or budgets.get(model) or settings.HISTORY_TOKEN_BUDGET)
+
+def fit_budget(messages: List[BaseMessage], budget: int) -> List[BaseMessage]:
+    """system 以外を古い順に落として budget に収める。最後のメッセージは必ず残す"""
+    if budget <= 0:
+        return messages
+    out = list(messages)
+    total = sum(estimate_message_tokens(m) for m in out)
+    i = 0
+    while total > budget and i < len(out) - 1:
+        if isinstance(out[i], SystemMessage):
+            i += 1
+            continue
+        total -= estimate_message_tokens(out.pop(i))
+    return out
+
+class HistoryCompactor:
+    """
+    直近 HISTORY_KEEP_TURNS 往復より前の会話を要約 1 件に置き換える。
+    要約は会話の接頭辞ハッシュで引き、無い / 古いときはバックグラウンドで作り直す (リクエストは待たない)。
+    新しい往復が増えた分は前回の要約 + 差分から作るので、長い会話でも要約の入力は小さい。
+    """
+    def __init__(self):
+        self._summaries: "OrderedDict[str, str]" = OrderedDict()
+        self._pending: Dict[str, asyncio.Task] = {}
+        self.hits = 0
+        self.partial_hits = 0
+        self.misses = 0
+        self.updates = 0
+        self.failures = 0
+
+    def compact(self, messages: List[BaseMessage]) -> List[BaseMessage]:
+        head, conversation = _split_head(messages)
+        cut = _recent_start(conversation, settings.HISTORY_KEEP_TURNS)
+        older, recent = conversation[:cut], conversation[cut:]
+        if len(older) < settings.HISTORY_MIN_COMPACT_MESSAGES:
+            return messages
+        hashes = _prefix_hashes(older)
+        covered, summary = 0, None
+        for i in range(len(older), 0, -1):
+            summary = self._summaries.get(hashes[i - 1])
+            if summary is not None:
+                covered = i
+                self._summaries.move_to_end(hashes[i - 1])
+                break
+        if covered < len(older):
+            self._schedule(hashes[-1], summary, older[covered:])
+        if summary is None:
+            # 初回は要約が無いので全履歴のまま (予算はノード側で掛ける)
+            self.misses += 1
+            return messages
+        if covered == len(older):
+            self.hits += 1
+        else:
+            self.partial_hits += 1
+        return head + [SystemMessage(content=f"これまでの会話の要約:\n{summary}")] + older[covered:] + recent
+
+    def _schedule(self, key: str, previous: str | None, messages: List[BaseMessage]) -> None:
+        if key in self._pending or len(self._pending) >= settings.HISTORY_SUMMARY_CONCURRENCY:
+            # 溢れた分は次のリクエストで改めて頼まれる
+            return
+        # リクエストのジャーナル / 期限を引き継がないよう空のコンテキストで走らせる
+        task = asyncio.create_task(self._update(key, previous, messages), context=contextvars.Context())
+        self._pending[key] = task
+        task.add_done_callback(lambda _: self._pending.pop(key, None))
+
+    async def _update(self, key: str, previous: str | None, messages: List[BaseMessage]) -> None:
+        provider, model = resolve_provider(settings.HISTORY_SUMMARY_MODEL or settings.MEMORY_NODE_MODEL or settings.DEFAULT_MODEL, None)
+        transcript = "\n".join(f"{m.type}: {str(m.content)[:_MESSAGE_TEXT_LIMIT]}" for m in messages)
+        if previous:
+            transcript = f"これまでの要約:\n{previous}\n\n続きの会話:\n{transcript}"
+        prompt = [
+            SystemMessage(content=(
+                "次はユーザとアシスタントの会話の前半である。以降の会話で参照できるよう、"
+                "話題・決定事項・固有名詞・ユーザの要望を落とさずに簡潔に要約せよ。要約だけを出力せよ。"
+            )),
+            HumanMessage(content=transcript),
+        ]
+        try:
+            out = await call_llm(provider, model, prompt, temperature=0.0, stream=False, max_tokens=settings.HISTORY_SUMMARY_MAX_TOKENS or None)
+        except Exception:
+            self.failures += 1
+            logger.warning("history summary failed", exc_info=True)
+            return
+        if not out.strip():
+            self.failures += 1
+            return
+        self._summaries[key] = out.strip()
+        self._summaries.move_to_end(key)
+        while len(self._summaries) > settings.HISTORY_SUMMARY_CACHE_SIZE:
+            self._summaries.popitem(last=False)
+        self.updates += 1
+
+    async def stop(self) -> None:
+        tasks = list(self._pending.values())
+        for task in tasks:
+            task.cancel()
+        for task in tasks:
+            with contextlib.suppress(asyncio.CancelledError):
+                await task
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "cached": len(self._summaries),
+            "pending": len(self._pending),
+            "hits": self.hits,
+            "partial_hits": self.partial_hits,
+            "misses": self.misses,
+            "updates": self.updates,
+            "failures": self.failures,
+        }
+
+history_compactor = HistoryCompactor()
@@ -0,0 +1,267 @@
+from __future__ import annotations
+import asyncio
+import contextlib
+import contextvars
+import datetime
+import os
+import time
+from typing import Any, Callable, Dict, List, Optional
+from sqlalchemy import insert
+from app.core.config import settings
+from app.db.session import AsyncSessionLocal
+from app.db.models.journal import RequestJournalEntry
+from app.services.cancellation import ClientDisconnectedError
+from app.services.deadline import DeadlineExceededError
+
+class RequestJournal:
+    """
+    1 リクエスト分の記録。グラフのノード / LLM 呼び出し / DB アクセスから追記され、
+    完了時に JournalWriter のバッファへ積まれて後でまとめて INSERT される。
+    """
+    def __init__(self, endpoint: str, client_key: str | None = None):
+        self.request_id = "req-" + os.urandom(8).hex()
+        self.endpoint = endpoint
+        self.client_key = client_key
+        self.started_at = datetime.datetime.now(datetime.timezone.utc)
+        self._t0 = time.perf_counter()
+        self.queue_ms: float = 0.0
+        self.ttft_ms: float | None = None
+        self.total_ms: float | None = None
+        self.provider: str | None = None
+        self.model: str | None = None
+        self.status = "ok"
+        self.error: str | None = None
+        self.nodes: List[Dict[str, Any]] = []
+        self.llm_calls: List[Dict[str, Any]] = []
+        self.db_calls: List[Dict[str, Any]] = []
+        self.route: List[str] = []
+        self.retrieval: Dict[str, Any] = {}
+        self.memories_injected = 0
+        self._on_finish: List[Callable[[], None]] = []
+
+    def elapsed_ms(self) -> float:
+        return (time.perf_counter() - self._t0) * 1000
+
+    def record_node(self, name: str, ms: float) -> None:
+        self.nodes.append({"name": name, "ms": round(ms, 2)})
+
+    def record_llm_call(self, node: str | None, provider: str, model: str, ms: float, ttft_ms: float | None, usage: Dict[str, Any] | None) -> None:
+        call = {"node": node, "provider": provider, "model": model, "ms": round(ms, 2)}
+        if ttft_ms is not None:
+            call["ttft_ms"] = round(ttft_ms, 2)
+        call.update({k: v for k, v in (usage or {}).items() if v is not None})
+        self.llm_calls.append(call)
+
+    def record_db(self, label: str, ms: float) -> None:
+        self.db_calls.append({"label": label, "ms": round(ms, 2)})
+
+    def mark_first_token(self) -> None:
+        if self.ttft_ms is None:
+            self.ttft_ms = self.elapsed_ms()
+
+    def record_state(self, state: Dict[str, Any]) -> None:
+        """グラフの最終 state からメモリ検索の判断内容を拾う"""
+        self.provider = state.get("provider", self.provider)
+        self.model = state.get("model", self.model)
+        self.route = list(state.get("route", []))
+        word_meanings = state.get("word_meanings") or []
+        self.memories_injected = len(word_meanings)
+        self.retrieval = {
+            "wellknown_words": len(state.get("wellknown_words") or []),
+            "wellknown_memories": len(state.get("wellknown_memories") or []),
+            "looked_up_words": list(state.get("looked_up_words") or []),
+            "found_words": [m["title"] for m in word_meanings],
+            "memory_simplicity": state.get("memory_simplicity"),
+            "updated_words": [w.title for w in state.get("updated_words") or []],
+            "updated_memories": [w.title for w in state.get("updated_memories") or []],
+            "degraded": bool(state.get("degraded")),
+            "memory_pipeline": state.get("memory_pipeline"),
+            "aux_task": state.get("aux_task"),
+            "speculation": state.get("speculation_result"),
+            "semantic_cache": state.get("semantic_cache"),
+            "semantic_similarity": state.get("semantic_similarity"),
+        }
+
+    def final_call(self) -> Dict[str, Any]:
+        """最終回答 (call_llm_node) の LLM 呼び出し"""
+        for call in reversed(self.llm_calls):
+            if call.get("node") == "call_llm_node":
+                return call
+        return {}
+
+    def usage(self) -> Dict[str, int]:
+        """OpenAI 互換の usage (最終回答の呼び出し分)"""
+        call = self.final_call()
+        prompt_tokens = call.get("prompt_tokens") or 0
+        completion_tokens = call.get("completion_tokens") or 0
+        return {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+        }
+
+    def server_timing(self) -> str:
+        metrics = []
+        if self.queue_ms:
+            metrics.append(f"queue;dur={self.queue_ms:.1f}")
+        for node in self.nodes:
+            metrics.append(f"{node['name']};dur={node['ms']:.1f}")
+        db_ms = sum(c["ms"] for c in self.db_calls)
+        if db_ms:
+            metrics.append(f"db;dur={db_ms:.1f}")
+        if self.ttft_ms is not None:
+            metrics.append(f"ttft;dur={self.ttft_ms:.1f}")
+        metrics.append(f"total;dur={self.elapsed_ms():.1f}")
+        return ", ".join(metrics)
+
+    def on_finish(self, fn: Callable[[], None]) -> None:
+        """リクエストの終了時 (成功 / 失敗 / 切断を問わず) に呼ぶ後始末を登録する"""
+        self._on_finish.append(fn)
+
+    def finish(self, error: BaseException | None = None) -> None:
+        if self.total_ms is not None:
+            return
+        self.total_ms = self.elapsed_ms()
+        for fn in self._on_finish:
+            with contextlib.suppress(Exception):
+                fn()
+        if error is not None:
+            if isinstance(error, (asyncio.CancelledError, ClientDisconnectedError)):
+                self.status = "cancelled"
+            elif isinstance(error, DeadlineExceededError):
+                self.status = "timeout"
+            else:
+                self.status = "error"
+            self.error = repr(error)[:1000]
+        journal_writer.submit(self)
+
+    def to_row(self) -> Dict[str, Any]:
+        return {
+            "request_id": self.request_id,
+            "endpoint": self.endpoint,
+            "client_key": self.client_key,
+            "provider": self.provider,
+            "model": self.model,
+            "status": self.status,
+            "error": self.error,
+            "started_at": self.started_at,
+            "queue_ms": self.queue_ms,
+            "ttft_ms": self.ttft_ms,
+            "total_ms": self.total_ms,
+            "prompt_tokens": sum(c.get("prompt_tokens") or 0 for c in self.llm_calls),
+            "completion_tokens": sum(c.get("completion_tokens") or 0 for c in self.llm_calls),
+            "memories_injected": self.memories_injected,
+            "db_ms": sum(c["ms"] for c in self.db_calls),
+            "route": self.route,
+            "nodes": self.nodes,
+            "llm_calls": self.llm_calls,
+            "db_calls": self.db_calls,
+            "retrieval": self.retrieval,
+        }
+
+# ---- 現在のリクエスト / ノード (グラフ内の各タスクへ contextvars で引き継がれる) ----
+_current_journal: contextvars.ContextVar[Optional[RequestJournal]] = contextvars.ContextVar("request_journal", default=None)
+_current_node: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("graph_node", default=None)
+
+def start_journal(endpoint: str, client_key: str | None = None) -> RequestJournal:
+    journal = RequestJournal(endpoint, client_key)
+    _current_journal.set(journal)
+    return journal
+
+def use_journal(journal: RequestJournal | None) -> None:
+    # StreamingResponse のジェネレータなど、別タスクから続きを記録する場合に使う
+    _current_journal.set(journal)
+
+def current_journal() -> RequestJournal | None:
+    return _current_journal.get()
+
+def current_node() -> str | None:
+    return _current_node.get()
+
+def set_current_node(name: str | None) -> contextvars.Token:
+    return _current_node.set(name)
+
+@contextlib.contextmanager
+def timed_db(label: str):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        journal = current_journal()
+        if journal is not None:
+            journal.record_db(label, (time.perf_counter() - started) * 1000)
+
+class JournalWriter:
+    """
+    有界のメモリバッファ + バックグラウンドでのバッチ INSERT。
+    リクエスト処理側は put_nowait するだけで、バッファが溢れたら記録を捨てる (応答は待たせない)。
+    """
+    def __init__(self):
+        self._queue: asyncio.Queue | None = None
+        self._task: asyncio.Task | None = None
+        self.dropped = 0
+        self.written = 0
+
+    def submit(self, journal: RequestJournal) -> None:
+        if self._queue is None:
+            return
+        try:
+            self._queue.put_nowait(journal.to_row())
+        except asyncio.QueueFull:
+            self.dropped += 1
+
+    def start(self) -> None:
+        if not settings.JOURNAL_ENABLED or self._task is not None:
+            return
+        self._queue = asyncio.Queue(maxsize=settings.JOURNAL_BUFFER_SIZE)
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+        self._task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await self._task
+        self._task = None
+        # 残りを書き出す
+        rows = []
+        while self._queue is not None and not self._queue.empty():
+            rows.append(self._queue.get_nowait())
+        if rows:
+            await self._write(rows)
+        self._queue = None
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            rows = [await self._queue.get()]
+            deadline = loop.time() + settings.JOURNAL_FLUSH_INTERVAL
+            while len(rows) < settings.JOURNAL_BATCH_SIZE:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    rows.append(await asyncio.wait_for(self._queue.get(), timeout=remaining))
+                except asyncio.TimeoutError:
+                    break
+            await self._write(rows)
+
+    async def _write(self, rows: List[Dict[str, Any]]) -> None:
+        try:
+            async with AsyncSessionLocal() as session:
+                await session.execute(insert(RequestJournalEntry), rows)
+                await session.commit()
+            self.written += len(rows)
+        except Exception:
+            # 記録の失敗でリクエスト処理を止めない
+            self.dropped += len(rows)
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "enabled": settings.JOURNAL_ENABLED,
+            "buffered": self._queue.qsize() if self._queue is not None else 0,
+            "written": self.written,
+            "dropped": self.dropped,
+        }
+
+journal_writer = JournalWriter()
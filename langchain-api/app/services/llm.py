@@ -1,8 +1,11 @@
 from __future__ import annotations
+import asyncio
+import contextlib
 import json
+import time
 from langchain_ollama.chat_models import ChatOllama
 from app.core.config import settings
-from typing import List
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Tuple
 from langgraph.config import get_stream_writer
 from langchain_core.messages import BaseMessage
 from app.services.providers import (
@@ -10,7 +13,11 @@ from app.services.providers import (
     openai_stream,
     ollama_complete,
     ollama_stream,
+    resolve_provider,
 )
+from app.services.circuit_breaker import CircuitBreaker, CircuitOpenError
+from app.services.deadline import DeadlineExceededError, clamp as clamp_to_deadline, current_deadline, expired as deadline_expired
+from app.services.journal import current_journal, current_node
 from openai.types.chat import (
     ChatCompletionMessageParam,
     ChatCompletionDeveloperMessageParam,
@@ -21,100 +28,330 @@ from openai.types.chat import (
     ChatCompletionFunctionMessageParam
 )
 
-async def call_llm(provider: str, model: str, messages_lc: List[BaseMessage], temperature: float | None, stream: bool) -> str:
-    answer = ""
+class LLMUnavailableError(RuntimeError):
+    """全ての候補プロバイダで応答が得られなかった"""
+
+# ---- プロバイダ毎のサーキットブレーカー ----
+_breakers: Dict[str, CircuitBreaker] = {}
+
+def get_breaker(provider: str) -> CircuitBreaker:
+    breaker = _breakers.get(provider)
+    if breaker is None:
+        breaker = CircuitBreaker(
+            name=provider,
+            failure_threshold=settings.LLM_BREAKER_FAILURE_THRESHOLD,
+            reset_timeout=settings.LLM_BREAKER_RESET_TIMEOUT,
+        )
+        _breakers[provider] = breaker
+    return breaker
+
+def breaker_states() -> Dict[str, Dict[str, Any]]:
+    return {name: b.snapshot() for name, b in _breakers.items()}
+
+def _candidates(provider: str, model: str) -> List[Tuple[str, str]]:
+    """primary と (設定されていれば) フォールバックの (provider, model) を優先順に返す"""
+    candidates = [(provider, model)]
+    if settings.LLM_FALLBACK_MODEL:
+        fallback = resolve_provider(settings.LLM_FALLBACK_MODEL, None)
+        if fallback not in candidates:
+            candidates.append(fallback)
+    return candidates
+
+def _check_provider(provider: str) -> None:
+    if provider not in ("openai", "ollama"):
+        raise ValueError(f"Unsupported provider: {provider}")
+
+class _Attempt:
+    """1 候補への試行。task は最初の応答 (ストリームなら最初のトークン) を待つ"""
+    def __init__(self, provider: str, model: str, first: Awaitable[Any], iterator: AsyncIterator[str] | None = None, usage: Dict[str, Any] | None = None):
+        self.provider = provider
+        self.model = model
+        self.breaker = get_breaker(provider)
+        self.iterator = iterator
+        self.usage = usage if usage is not None else {}  # プロバイダが報告したトークン数等
+        self.started = time.perf_counter()
+        self.task = asyncio.ensure_future(first)
+
+    async def cancel(self) -> None:
+        self.task.cancel()
+        with contextlib.suppress(BaseException):
+            await self.task
+        await self.aclose()
+        self.breaker.record_cancel()
+
+    async def aclose(self) -> None:
+        if self.iterator is not None:
+            with contextlib.suppress(Exception):
+                await self.iterator.aclose()
+
+async def _race(candidates: List[Tuple[str, str]], launch: Callable[[str, str], _Attempt], first_timeout: float, hedge_delay: float = 0.0) -> Tuple[_Attempt, Any]:
+    """
+    候補を優先順に試し、最初に応答した試行とその結果を返す (負けた試行はキャンセル)。
+    - first_timeout 以内に応答が無ければ失敗扱いにして次の候補へフェイルオーバー
+    - hedge_delay (> 0) 経過しても応答が無ければ次の候補を並走させる (ヘッジ)。
+      非ストリームは応答全体を待つことになり負荷が倍になるので、ストリームの最初のトークン待ちだけで使う
+    - ブレーカーが open の候補は飛ばす
+    - リクエストの期限 (app/services/deadline.py) があれば first_timeout をその残り時間で切り詰める
+    """
+    loop = asyncio.get_running_loop()
+    queue = list(candidates)
+    running: List[_Attempt] = []
+    errors: List[BaseException] = []
+
+    def start_next() -> bool:
+        while queue:
+            provider, model = queue.pop(0)
+            if get_breaker(provider).allow():
+                running.append(launch(provider, model))
+                return True
+            errors.append(CircuitOpenError(provider))
+        return False
+
+    try:
+        start_next()
+        deadline = loop.time() + clamp_to_deadline(first_timeout)
+        hedged = False
+        while running:
+            remaining = deadline - loop.time()
+            wait = remaining
+            can_hedge = hedge_delay > 0 and not hedged and bool(queue)
+            if can_hedge:
+                wait = min(wait, hedge_delay)
+            done: set = set()
+            if wait > 0:
+                done, _ = await asyncio.wait([a.task for a in running], timeout=wait, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                if deadline_expired():
+                    # 遅いのはプロバイダではなくリクエストの持ち時間切れなので失敗には数えない
+                    raise DeadlineExceededError()
+                if can_hedge and remaining > hedge_delay:
+                    hedged = True
+                    start_next()
+                    continue
+                # 最初の応答待ちがタイムアウト: 走っているものは失敗扱いで次の候補へ
+                for a in running:
+                    await a.cancel()
+                    a.breaker.record_failure()
+                    errors.append(asyncio.TimeoutError(f"{a.provider}:{a.model} did not respond in {first_timeout}s"))
+                running.clear()
+                if start_next():
+                    deadline = loop.time() + clamp_to_deadline(first_timeout)
+                continue
+            for a in [a for a in running if a.task in done]:
+                running.remove(a)
+                exc = a.task.exception()
+                if exc is None or isinstance(exc, StopAsyncIteration):
+                    a.breaker.record_success()
+                    for loser in running:
+                        await loser.cancel()
+                    running.clear()
+                    return a, (None if exc else a.task.result())
+                a.breaker.record_failure()
+                errors.append(exc)
+                await a.aclose()
+            if not running:
+                start_next()
+    except BaseException:
+        # 呼び出し元のキャンセル等: 走っている試行を全て止める
+        for a in running:
+            await a.cancel()
+        raise
+    raise LLMUnavailableError(f"no provider responded: {[repr(e) for e in errors]}")
+
+async def _iter_deltas(provider: str, model: str, messages_lc: List[BaseMessage], temperature: float | None, max_tokens: int | None = None, top_p: float | None = None, usage: Dict[str, Any] | None = None) -> AsyncIterator[str]:
+    """プロバイダのストリームをテキスト差分だけの非同期イテレータにそろえる (usage は最終チャンクから埋める)"""
+    if usage is None:
+        usage = {}
     if provider == "openai":
-        converted_messages = convert_messages_to_chat_completion_param(messages_lc)
-        if stream:
-            answer = await _call_openai_async(model=model, messages_lc=converted_messages, temperature=temperature)
-        else:
-            answer = await _call_openai_sync(model=model, messages_lc=converted_messages, output_structure=None, temperature=temperature)
-    elif provider == "ollama":
-        if stream:
-            answer = await _call_ollama_async(model=model, messages_lc=messages_lc, temperature=temperature)
-        else:
-            out = await _call_ollama_sync(model=model, messages_lc=messages_lc, output_structure=None, temperature=temperature)
-            answer = getattr(out, "content", "")
+        res = await openai_stream(model=model, messages=convert_messages_to_chat_completion_param(messages_lc), temperature=temperature, max_tokens=max_tokens, top_p=top_p)
+        async for chunk in res:
+            if chunk.usage:
+                usage.update(_openai_usage(chunk.usage))
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content
+            if delta:
+                yield delta
     else:
-        raise ValueError(f"Unsupported provider: {provider}")
-    return answer
+        async for chunk in ollama_stream(
+            model=model,
+            messages_lc=messages_lc,
+            output_structure=None,
+            temperature=temperature,
+            max_tokens=max_tokens,
+            top_p=top_p,
+        ):
+            usage.update(_ollama_usage(chunk))
+            delta = getattr(chunk, "content", "")
+            if delta:
+                yield delta
 
-# output_type を指定した場合はstreamはFalse固定
-async def call_llm_with_output_type(provider: str, model: str, messages_lc: List[BaseMessage], output_structure: type, temperature: float | None):
+async def _complete(provider: str, model: str, messages_lc: List[BaseMessage], output_structure: type | None, temperature: float | None, max_tokens: int | None = None, top_p: float | None = None, usage: Dict[str, Any] | None = None):
     if provider == "openai":
         converted_messages = convert_messages_to_chat_completion_param(messages_lc)
-        answer = await _call_openai_sync(model=model, messages_lc=converted_messages, output_structure=output_structure, temperature=temperature)
-    elif provider == "ollama":
-        answer = await _call_ollama_sync(model=model, messages_lc=messages_lc, output_structure=output_structure, temperature=temperature)
+        out = await _call_openai_sync(model=model, messages_lc=converted_messages, output_structure=output_structure, temperature=temperature, max_tokens=max_tokens, top_p=top_p, usage=usage)
+        if output_structure is None:
+            out = out.get("content", "") if isinstance(out, dict) else out
     else:
-        raise ValueError(f"Unsupported provider: {provider}")
+        out = await _call_ollama_sync(model=model, messages_lc=messages_lc, output_structure=output_structure, temperature=temperature, max_tokens=max_tokens, top_p=top_p, usage=usage)
+        if output_structure is None:
+            out = getattr(out, "content", "")
+    return out
+
+def _launch_complete(messages_lc: List[BaseMessage], output_structure: type | None, temperature: float | None, max_tokens: int | None = None, top_p: float | None = None) -> Callable[[str, str], _Attempt]:
+    def launch(p: str, m: str) -> _Attempt:
+        usage: Dict[str, Any] = {}
+        return _Attempt(p, m, _complete(p, m, messages_lc, output_structure, temperature, max_tokens, top_p, usage=usage), usage=usage)
+    return launch
+
+def _ollama_usage(message: Any) -> Dict[str, Any]:
+    # 最終チャンク (done) の response_metadata に eval_count などが入る
+    meta = getattr(message, "response_metadata", None) or {}
+    usage = {
+        "prompt_tokens": meta.get("prompt_eval_count"),
+        "completion_tokens": meta.get("eval_count"),
+        "total_duration": meta.get("total_duration"),
+        "load_duration": meta.get("load_duration"),
+        "prompt_eval_duration": meta.get("prompt_eval_duration"),
+        "eval_duration": meta.get("eval_duration"),
+    }
+    return {k: v for k, v in usage.items() if v is not None}
+
+def _openai_usage(usage: Any) -> Dict[str, Any]:
+    if usage is None:
+        return {}
+    return {"prompt_tokens": usage.prompt_tokens, "completion_tokens": usage.completion_tokens}
+
+def _record_call(attempt: _Attempt, ttft: float | None = None) -> None:
+    journal = current_journal()
+    if journal is None:
+        return
+    ms = (time.perf_counter() - attempt.started) * 1000
+    ttft_ms = (ttft - attempt.started) * 1000 if ttft is not None else None
+    journal.record_llm_call(current_node(), attempt.provider, attempt.model, ms, ttft_ms, attempt.usage)
+
+async def call_llm(provider: str, model: str, messages_lc: List[BaseMessage], temperature: float | None, stream: bool, max_tokens: int | None = None, top_p: float | None = None, writer: Callable[[Dict[str, Any]], None] | None = None) -> str:
+    """
+    writer を渡すとトークンイベントをグラフのストリームではなく writer に送る (投機実行のバッファ用)。
+    その場合、最初のトークンの時刻 (TTFT) は呼び出し側が記録する。
+    """
+    _check_provider(provider)
+    candidates = _candidates(provider, model)
+    if not stream:
+        # 非ストリームは応答全体が「最初の応答」になるので LLM_TOTAL_TIMEOUT で打ち切る
+        winner, answer = await _race(
+            candidates,
+            _launch_complete(messages_lc, None, temperature, max_tokens, top_p),
+            settings.LLM_TOTAL_TIMEOUT,
+        )
+        _record_call(winner)
+        return answer or ""
+
+    def launch(p: str, m: str) -> _Attempt:
+        usage: Dict[str, Any] = {}
+        iterator = _iter_deltas(p, m, messages_lc, temperature, max_tokens, top_p, usage=usage)
+        return _Attempt(p, m, iterator.__anext__(), iterator=iterator, usage=usage)
+
+    buffered = writer is not None
+    if writer is None:
+        writer = get_stream_writer()
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    winner, delta = await _race(candidates, launch, min(settings.LLM_TTFT_TIMEOUT, settings.LLM_TOTAL_TIMEOUT), settings.LLM_HEDGE_DELAY)
+    ttft = time.perf_counter()
+    journal = current_journal()
+    if journal is not None and delta is not None and not buffered:
+        journal.mark_first_token()
+    partial = ""
+    until = started + settings.LLM_TOTAL_TIMEOUT
+    if current_deadline() is not None:
+        until = min(until, current_deadline())
+    try:
+        async with asyncio.timeout_at(until):
+            while delta is not None:
+                partial += delta
+                writer({
+                    "event_name": "token",
+                    "provider": winner.provider,
+                    "model": winner.model,
+                    "delta": delta,
+                    "partial": partial,
+                })
+                delta = await anext(winner.iterator, None)
+    except (asyncio.CancelledError, GeneratorExit):
+        await winner.aclose()
+        raise
+    except TimeoutError:
+        await winner.aclose()
+        if deadline_expired():
+            raise DeadlineExceededError() from None
+        winner.breaker.record_failure()
+        raise
+    except BaseException:
+        # 出力開始後の失敗はフェイルオーバーできないので失敗として記録して送出
+        winner.breaker.record_failure()
+        await winner.aclose()
+        raise
+    _record_call(winner, ttft)
+    return partial
+
+# output_type を指定した場合はstreamはFalse固定
+async def call_llm_with_output_type(provider: str, model: str, messages_lc: List[BaseMessage], output_structure: type, temperature: float | None, max_tokens: int | None = None):
+    _check_provider(provider)
+    winner, answer = await _race(
+        _candidates(provider, model),
+        _launch_complete(messages_lc, output_structure, temperature, max_tokens),
+        settings.LLM_TOTAL_TIMEOUT,
+    )
+    _record_call(winner)
     return answer
 
-async def _call_openai_sync(model: str, messages_lc: List[ChatCompletionMessageParam], output_structure: type = None, temperature: float | None = None) -> str:
+async def _call_openai_sync(model: str, messages_lc: List[ChatCompletionMessageParam], output_structure: type = None, temperature: float | None = None, max_tokens: int | None = None, top_p: float | None = None, usage: Dict[str, Any] | None = None) -> str:
     data = await openai_complete(
         model=model,
         messages=messages_lc,
         output_structure=output_structure,
         temperature=temperature,
+        max_tokens=max_tokens,
+        top_p=top_p,
     )
+    if usage is not None:
+        usage.update(_openai_usage(getattr(data, "usage", None)))
     answer = ""
     try:
-        answer = data.choices[0].message.content
+        message = data.choices[0].message
+        answer = message.content
         if output_structure:
-            answer = output_structure.model_validate_json(answer)
+            # parse() / stream() はパース済みの値を持っている
+            parsed = getattr(message, "parsed", None)
+            answer = parsed if parsed is not None else output_structure.model_validate_json(answer)
         else:
             answer = {"content": answer}
     except Exception:
         answer = ""
     return answer
 
-async def _call_openai_async(model: str, messages_lc: List[ChatCompletionMessageParam], temperature: float | None = None) -> str:
-    writer = get_stream_writer()
-    full = ""
-    res = await openai_stream(model=model, messages=messages_lc, temperature=temperature)
-    async for chunk in res:
-        delta = chunk.choices[0].delta.content
-        # full += delta
-        writer({
-            "event_name": "token",
-            "provider": "openai",
-            "model": model,
-            "delta": delta,
-            "partial": full,
-        })
-    return full
-
-async def _call_ollama_sync(model: str, messages_lc: List[BaseMessage], output_structure: type = None, temperature: float | None = None):
+async def _call_ollama_sync(model: str, messages_lc: List[BaseMessage], output_structure: type = None, temperature: float | None = None, max_tokens: int | None = None, top_p: float | None = None, usage: Dict[str, Any] | None = None):
     out = await ollama_complete(
         model=model,
         messages_lc=messages_lc,
         output_structure=output_structure,
         temperature=temperature,
+        max_tokens=max_tokens,
+        top_p=top_p,
+        include_raw=output_structure is not None,
     )
+    if output_structure is not None:
+        # include_raw=True: {"raw": AIMessage, "parsed": ..., "parsing_error": ...}
+        if usage is not None:
+            usage.update(_ollama_usage(out.get("raw")))
+        if out.get("parsing_error") is not None:
+            raise out["parsing_error"]
+        return out.get("parsed")
+    if usage is not None:
+        usage.update(_ollama_usage(out))
     return out
 
-async def _call_ollama_async(model: str, messages_lc: List[BaseMessage], temperature: float | None = None) -> str:
-    writer = get_stream_writer()
-    partial = ""
-    async for chunk in ollama_stream(
-        model=model,
-        messages_lc=messages_lc,
-        output_structure=None,
-        temperature=temperature,
-    ):
-        delta = getattr(chunk, "content", "")
-        if not delta:
-            continue
-        partial += delta
-        writer({
-            "event_name": "token",
-            "provider": "ollama",
-            "model": model,
-            "delta": delta,
-            "partial": partial,
-        })
-    return partial
-
 def convert_messages_to_chat_completion_param(src: List[BaseMessage]) -> List[ChatCompletionMessageParam]:
     ret: List[ChatCompletionMessageParam] = []
     # ChatCompletionDeveloperMessageParam,
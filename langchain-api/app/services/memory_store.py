@@ -0,0 +1,148 @@
+from __future__ import annotations
+import asyncio
+import collections
+import contextlib
+import logging
+import time
+from dataclasses import dataclass, field
+from typing import Any, AsyncIterator, Deque, Dict, List
+from sqlalchemy.exc import InterfaceError, OperationalError, TimeoutError as PoolTimeoutError
+from app.core.config import settings
+from app.db.session import AsyncSessionLocal
+from app.db.models.memory import mark_memory_as_deleted, upsert_memory
+from app.jobs.summarize_memories import summary_scheduler
+from app.services.circuit_breaker import CircuitBreaker
+from app.services.journal import timed_db
+
+logger = logging.getLogger(__name__)
+
+# 書き戻しは DB_MEMORY_TIMEOUT に収まる程度の件数ずつコミットする
+_FLUSH_CHUNK = 20
+
+class MemoryStoreUnavailable(RuntimeError):
+    """メモリ段階の DB アクセスを諦めた (ブレーカー open / タイムアウト / 接続失敗)"""
+
+# DB の不調とみなす例外。制約違反など DB が応答したものは含めない
+_UNHEALTHY = (OperationalError, InterfaceError, PoolTimeoutError, OSError, TimeoutError)
+
+memory_db_breaker = CircuitBreaker(
+    name="postgres",
+    failure_threshold=settings.DB_BREAKER_FAILURE_THRESHOLD,
+    reset_timeout=settings.DB_BREAKER_RESET_TIMEOUT,
+)
+
+def memory_store_available() -> bool:
+    """ブレーカーが open で再試行の時期でもなければ False (状態は変えない)"""
+    snap = memory_db_breaker.snapshot()
+    return snap["state"] != "open" or snap["retry_in"] <= 0
+
+@contextlib.asynccontextmanager
+async def guarded_db(label: str) -> AsyncIterator[None]:
+    """
+    メモリ段階の DB 操作を DB_MEMORY_TIMEOUT で打ち切り、結果をブレーカーに記録する。
+    不調なら MemoryStoreUnavailable を送出するので、ノード側はメモリ無しで先へ進める。
+    """
+    if not memory_db_breaker.allow():
+        raise MemoryStoreUnavailable("memory store circuit open")
+    try:
+        async with asyncio.timeout(settings.DB_MEMORY_TIMEOUT or None):
+            with timed_db(label):
+                yield
+    except _UNHEALTHY as e:
+        memory_db_breaker.record_failure()
+        raise MemoryStoreUnavailable(f"{label}: {e!r}") from e
+    except Exception:
+        memory_db_breaker.record_success()
+        raise
+    except BaseException:
+        memory_db_breaker.record_cancel()
+        raise
+    memory_db_breaker.record_success()
+
+@dataclass
+class PendingMemoryWrite:
+    tenant_id: str
+    title: str
+    content: str                        # 空なら論理削除
+    parent_titles: List[str] = field(default_factory=list)
+    memory_simplicity: int = 0
+    queued_at: float = field(default_factory=time.time)
+
+class MemoryWriteQueue:
+    """
+    DB が使えない間のメモリ書き込みを溜め、ブレーカーが閉じたら順に書き戻す。
+    プロセス内だけの有界バッファなので、溢れた分と再起動時に残っていた分は失われる。
+    """
+    def __init__(self):
+        self._items: Deque[PendingMemoryWrite] = collections.deque()
+        self._task: asyncio.Task | None = None
+        self._wakeup = asyncio.Event()
+        self.written = 0
+        self.dropped = 0
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+        self._task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await self._task
+        self._task = None
+        if self._items:
+            logger.warning("discarding %d queued memory writes", len(self._items))
+
+    def put(self, writes: List[PendingMemoryWrite]) -> None:
+        for w in writes:
+            if len(self._items) >= settings.DB_WRITE_QUEUE_SIZE:
+                self._items.popleft()
+                self.dropped += 1
+            self._items.append(w)
+        self._wakeup.set()
+
+    async def _run(self) -> None:
+        while True:
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self._wakeup.wait(), timeout=settings.DB_WRITE_RETRY_INTERVAL)
+            self._wakeup.clear()
+            if self._items and memory_store_available():
+                try:
+                    await self._flush()
+                except MemoryStoreUnavailable:
+                    pass
+
+    async def _flush(self) -> None:
+        while self._items:
+            batch = [self._items.popleft() for _ in range(min(_FLUSH_CHUNK, len(self._items)))]
+            try:
+                async with AsyncSessionLocal() as session:
+                    async with guarded_db("flush_memory_writes"):
+                        for w in batch:
+                            if w.content:
+                                await upsert_memory(session, w.tenant_id, title=w.title, content=w.content, parent_titles=w.parent_titles, memory_simplicity=w.memory_simplicity)
+                            else:
+                                await mark_memory_as_deleted(session, w.tenant_id, title=w.title)
+                        await session.commit()
+            except MemoryStoreUnavailable:
+                # 順序を保って先頭に戻し、次の周期で再試行する
+                self._items.extendleft(reversed(batch))
+                raise
+            except Exception:
+                # DB は応答したが書けないもの (制約違反など) は何度やっても同じなので捨てる
+                logger.exception("dropping %d queued memory writes", len(batch))
+                self.dropped += len(batch)
+                continue
+            self.written += len(batch)
+            summary_scheduler.notify()
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "queued": len(self._items),
+            "oldest_age": round(time.time() - self._items[0].queued_at, 1) if self._items else 0.0,
+            "written": self.written,
+            "dropped": self.dropped,
+        }
+
+memory_write_queue = MemoryWriteQueue()
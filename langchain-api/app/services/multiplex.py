@@ -0,0 +1,273 @@
+from __future__ import annotations
+import asyncio
+import contextlib
+import json
+import logging
+from typing import Any, Dict
+from fastapi import WebSocket, WebSocketDisconnect
+from langchain_core.runnables.config import RunnableConfig
+from pydantic import ValidationError
+from app.core.config import settings
+from app.db.session import AsyncSessionLocal
+from app.graph.chat_graph import stream_chat_graph
+from app.services.admission import PRIORITY_INTERACTIVE, PRIORITY_LOW, AdmissionError, admit_request, client_key
+from app.services.aux_tasks import detect_aux_task
+from app.services.completions import ChatRequest, run_completion
+from app.services.deadline import DeadlineExceededError, clamp as deadline_clamp, expired as deadline_expired, start_deadline, timeout_for
+from app.services.journal import start_journal
+from app.services.tenancy import memory_pipeline_for, tenant_id_for
+
+logger = logging.getLogger(__name__)
+
+# /v1/chat/ws のフレーム (いずれも JSON テキスト)
+#   クライアント -> サーバ
+#     {"type": "start", "id": "<任意の文字列>", "request": <ChatRequest>, "credits": 64, "timeout": 30}
+#     {"type": "credit", "id": ..., "n": 32}      chunk をあと n 件受け取れる (credits は正の整数。WS_CREDIT_TIMEOUT 秒来なければ打ち切る)
+#     {"type": "cancel", "id": ...}
+#   サーバ -> クライアント
+#     {"type": "started", "id": ..., "request_id": ...}
+#     {"type": "chunk", "id": ..., "data": <chat.completion.chunk>}   クレジットを 1 消費する
+#     {"type": "response", "id": ..., "data": <chat.completion>, "route": [...], "degraded": bool}   stream=false のとき
+#     終端は必ずどれか 1 つ: {"type": "done", "id": ...} / {"type": "cancelled", "id": ...} / {"type": "error", "id": ..., "error": {...}}
+
+class MultiplexStats:
+    def __init__(self):
+        self.connections = 0
+        self.streams = 0
+        self.started = 0
+        self.completed = 0
+        self.cancelled = 0
+        self.failed = 0
+        self.rejected = 0
+        self.credit_waits = 0           # クレジット切れで生成側を待たせた回数
+        self.credit_timeouts = 0        # クレジットを待ちきれずに打ち切った回数
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "connections": self.connections,
+            "streams": self.streams,
+            "started": self.started,
+            "completed": self.completed,
+            "cancelled": self.cancelled,
+            "failed": self.failed,
+            "rejected": self.rejected,
+            "credit_waits": self.credit_waits,
+            "credit_timeouts": self.credit_timeouts,
+        }
+
+multiplex_stats = MultiplexStats()
+
+class CreditTimeoutError(Exception):
+    """WS_CREDIT_TIMEOUT 秒待っても credit フレームが来なかった (受付枠と DB セッションを手放すため打ち切る)"""
+
+class MuxStream:
+    """1 本の会話。chunk はクレジットの範囲でだけ送り、尽きたら credit フレームを待つ"""
+    def __init__(self, stream_id: str, credits: int):
+        self.id = stream_id
+        self.credits = credits
+        self.task: asyncio.Task | None = None
+        self._granted = asyncio.Event()
+
+    def grant(self, n: int) -> None:
+        self.credits += n
+        self._granted.set()
+
+    async def acquire(self) -> None:
+        """クレジットを 1 つ使う。WS_CREDIT_TIMEOUT (期限が先ならそこ) まで待っても来なければ打ち切る"""
+        while self.credits <= 0:
+            multiplex_stats.credit_waits += 1
+            self._granted.clear()
+            try:
+                await asyncio.wait_for(self._granted.wait(), timeout=deadline_clamp(settings.WS_CREDIT_TIMEOUT))
+            except asyncio.TimeoutError:
+                if deadline_expired():
+                    raise DeadlineExceededError()
+                multiplex_stats.credit_timeouts += 1
+                raise CreditTimeoutError(f"no credit granted within {settings.WS_CREDIT_TIMEOUT:g}s")
+        self.credits -= 1
+
+class MuxConnection:
+    """
+    1 本の WebSocket に複数のチャットを多重化する。各ストリームは HTTP の 1 リクエストと同じく
+    ジャーナル・期限・受付枠・テナントを個別に持つ。送信は 1 タスクに集約し、キューが詰まれば全体に背圧がかかる。
+    """
+    def __init__(self, websocket: WebSocket):
+        self.ws = websocket
+        self.streams: Dict[str, MuxStream] = {}
+        self._outbox: asyncio.Queue = asyncio.Queue(maxsize=settings.WS_SEND_QUEUE_SIZE)
+
+    async def serve(self) -> None:
+        await self.ws.accept()
+        multiplex_stats.connections += 1
+        sender = asyncio.create_task(self._send_loop())
+        try:
+            while True:
+                try:
+                    text = await self.ws.receive_text()
+                except (WebSocketDisconnect, RuntimeError):
+                    return
+                await self._dispatch(text)
+                if sender.done():
+                    # 送れなくなった (切断) ので受信も止める
+                    return
+        finally:
+            multiplex_stats.connections -= 1
+            await self._cancel_all()
+            sender.cancel()
+            with contextlib.suppress(BaseException):
+                await sender
+
+    async def _dispatch(self, text: str) -> None:
+        try:
+            frame = json.loads(text)
+        except ValueError:
+            await self._error(None, "invalid JSON frame", "invalid_request_error")
+            return
+        if not isinstance(frame, dict):
+            await self._error(None, "frame must be an object", "invalid_request_error")
+            return
+        kind, stream_id = frame.get("type"), frame.get("id")
+        if kind == "start":
+            await self._start(frame)
+        elif kind == "credit":
+            stream = self.streams.get(stream_id)
+            n = frame.get("n")
+            if stream is not None and isinstance(n, int) and n > 0:
+                stream.grant(n)
+        elif kind == "cancel":
+            stream = self.streams.get(stream_id)
+            if stream is not None and stream.task is not None:
+                stream.task.cancel()
+        else:
+            await self._error(stream_id, f"unknown frame type: {kind!r}", "invalid_request_error")
+
+    async def _start(self, frame: Dict[str, Any]) -> None:
+        stream_id = frame.get("id")
+        if not isinstance(stream_id, str) or not stream_id:
+            await self._error(None, "start frame needs a string id", "invalid_request_error")
+            return
+        if stream_id in self.streams:
+            await self._error(stream_id, "stream id already in use", "invalid_request_error")
+            return
+        if len(self.streams) >= settings.WS_MAX_STREAMS_PER_CONNECTION:
+            multiplex_stats.rejected += 1
+            await self._error(stream_id, "too many concurrent streams on this connection", "server_overloaded")
+            return
+        try:
+            req = ChatRequest.model_validate(frame.get("request") or {})
+        except ValidationError as e:
+            await self._error(stream_id, str(e), "invalid_request_error")
+            return
+        credits = frame.get("credits", settings.WS_INITIAL_CREDITS)
+        if not isinstance(credits, int) or isinstance(credits, bool) or credits <= 0:
+            # 0 から始めると credit を送らないだけで受付枠を握り続けられる
+            await self._error(stream_id, "credits must be a positive integer", "invalid_request_error")
+            return
+        stream = MuxStream(stream_id, credits)
+        self.streams[stream_id] = stream
+        multiplex_stats.streams += 1
+        multiplex_stats.started += 1
+        stream.task = asyncio.create_task(self._run(stream, req, frame.get("timeout")))
+        stream.task.add_done_callback(lambda task: self._forget(stream_id, task))
+
+    def _forget(self, stream_id: str, task: asyncio.Task) -> None:
+        if self.streams.pop(stream_id, None) is not None:
+            multiplex_stats.streams -= 1
+        if task.cancelled():
+            # 走り始める前に cancel された。_run の終端フレームが出ていないのでここで送る
+            multiplex_stats.cancelled += 1
+            self._put_nowait({"type": "cancelled", "id": stream_id})
+
+    async def _run(self, stream: MuxStream, req: ChatRequest, timeout: Any) -> None:
+        # タスク毎にコンテキストが分かれるので、ジャーナル / 期限は他のストリームと混ざらない
+        messages = [m.model_dump() for m in req.messages]
+        aux_task = detect_aux_task(messages)
+        journal = start_journal("/v1/chat/ws", client_key(self.ws))
+        start_deadline(_stream_timeout(self.ws, timeout))
+        error: BaseException | None = None
+        lease = None
+        try:
+            async with AsyncSessionLocal() as session:
+                config = RunnableConfig(session=session, tenant_id=tenant_id_for(self.ws), aux_task=aux_task, memory_pipeline=memory_pipeline_for(self.ws))
+                lease = await admit_request(self.ws, messages, req.max_tokens, PRIORITY_LOW if aux_task else PRIORITY_INTERACTIVE)
+                journal.queue_ms = lease.queued_seconds * 1000
+                await self._put({"type": "started", "id": stream.id, "request_id": journal.request_id})
+                if not req.stream:
+                    out, body = await run_completion(req, config)
+                    await self._put({
+                        "type": "response", "id": stream.id, "data": body,
+                        "route": out.get("route", []), "degraded": bool(out.get("degraded")),
+                    })
+                else:
+                    last = None
+                    async for ev in stream_chat_graph(req.model, messages, req.temperature, req.top_p, req.max_tokens, config=config):
+                        if "choices" in ev:
+                            last = ev
+                            await stream.acquire()
+                            await self._put({"type": "chunk", "id": stream.id, "data": ev})
+                    if (req.stream_options or {}).get("include_usage") and last is not None:
+                        await stream.acquire()
+                        await self._put({"type": "chunk", "id": stream.id, "data": {**last, "choices": [], "usage": journal.usage()}})
+            await self._put({"type": "done", "id": stream.id})
+            multiplex_stats.completed += 1
+        except asyncio.CancelledError as e:
+            # cancel フレーム / 切断。切断なら送り先は無いが、送信キューが止まっていれば捨てられるだけ
+            error = e
+            multiplex_stats.cancelled += 1
+            self._put_nowait({"type": "cancelled", "id": stream.id})
+        except AdmissionError as e:
+            error = e
+            multiplex_stats.failed += 1
+            await self._error(stream.id, e.detail, "rate_limit_error" if e.status_code == 429 else "server_overloaded", retry_after=e.retry_after)
+        except DeadlineExceededError as e:
+            error = e
+            multiplex_stats.failed += 1
+            await self._error(stream.id, e.detail, "timeout")
+        except CreditTimeoutError as e:
+            error = e
+            multiplex_stats.failed += 1
+            await self._error(stream.id, str(e), "credit_timeout")
+        except Exception as e:
+            error = e
+            multiplex_stats.failed += 1
+            logger.exception("multiplexed stream %s failed", stream.id)
+            await self._error(stream.id, "internal error", "server_error")
+        finally:
+            if lease is not None:
+                lease.release()
+            journal.finish(error)
+
+    async def _error(self, stream_id: str | None, message: str, kind: str, **extra: Any) -> None:
+        await self._put({"type": "error", "id": stream_id, "error": {"message": message, "type": kind, **extra}})
+
+    async def _put(self, frame: Dict[str, Any]) -> None:
+        await self._outbox.put(frame)
+
+    def _put_nowait(self, frame: Dict[str, Any]) -> None:
+        with contextlib.suppress(asyncio.QueueFull):
+            self._outbox.put_nowait(frame)
+
+    async def _send_loop(self) -> None:
+        try:
+            while True:
+                frame = await self._outbox.get()
+                await self.ws.send_text(json.dumps(frame, ensure_ascii=False))
+        except (WebSocketDisconnect, RuntimeError, OSError):
+            return
+
+    async def _cancel_all(self) -> None:
+        tasks = [s.task for s in self.streams.values() if s.task is not None]
+        for task in tasks:
+            task.cancel()
+        for task in tasks:
+            with contextlib.suppress(BaseException):
+                await task
+
+def _stream_timeout(websocket: WebSocket, raw: Any) -> float | None:
+    """start フレームの timeout > 接続時のヘッダ / 既定値。上限は HTTP と同じく REQUEST_MAX_TIMEOUT"""
+    timeout = timeout_for(websocket)
+    if isinstance(raw, (int, float)) and raw > 0:
+        timeout = float(raw)
+        if settings.REQUEST_MAX_TIMEOUT > 0:
+            timeout = min(timeout, settings.REQUEST_MAX_TIMEOUT)
+    return timeout
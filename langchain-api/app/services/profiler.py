@@ -0,0 +1,103 @@
+from __future__ import annotations
+import os
+import sys
+import threading
+import time
+from collections import Counter, OrderedDict
+from typing import Dict
+
+class SamplingProfiler:
+    """
+    別スレッドから対象スレッドのスタックを一定間隔で覗くサンプリングプロファイラ。
+    出力は flamegraph.pl / speedscope / inferno がそのまま読める collapsed 形式
+    ("frame;frame;frame count" の行)。動いていない間はスレッドも存在しないのでコストは無い。
+    """
+    def __init__(self, thread_id: int | None = None, interval: float = 0.005, all_threads: bool = False):
+        self.thread_id = thread_id if thread_id is not None else threading.main_thread().ident
+        self.interval = interval
+        self.all_threads = all_threads
+        self.samples: Counter = Counter()
+        self.sample_count = 0
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+        self._self_ident: int | None = None
+
+    def start(self) -> "SamplingProfiler":
+        self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> "SamplingProfiler":
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        return self
+
+    def _run(self) -> None:
+        self._self_ident = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            frames = sys._current_frames()
+            if self.all_threads:
+                targets = [(ident, f) for ident, f in frames.items() if ident != self._self_ident]
+            else:
+                frame = frames.get(self.thread_id)
+                targets = [(self.thread_id, frame)] if frame is not None else []
+            for ident, frame in targets:
+                self.samples[self._collapse(frame, ident)] += 1
+                self.sample_count += 1
+
+    def _collapse(self, frame, ident: int) -> str:
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append(f"{code.co_name} ({_short_path(code.co_filename)}:{code.co_firstlineno})")
+            frame = frame.f_back
+        if self.all_threads:
+            stack.append(f"thread-{ident}")
+        stack.reverse()
+        return ";".join(frame_name.replace(";", ":") for frame_name in stack)
+
+    def collapsed(self) -> str:
+        return "".join(f"{stack} {count}\n" for stack, count in self.samples.most_common())
+
+def _short_path(path: str) -> str:
+    # site-packages 以下はパッケージ名から、それ以外はカレントからの相対で表示
+    marker = "site-packages" + os.sep
+    i = path.rfind(marker)
+    if i >= 0:
+        return path[i + len(marker):]
+    try:
+        return os.path.relpath(path)
+    except ValueError:
+        return path
+
+class ProfileStore:
+    """リクエスト単位のプロファイル結果を後から取得できるよう少数だけ保持する"""
+    def __init__(self, max_entries: int = 20):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, Dict[str, object]]" = OrderedDict()
+
+    def put(self, profile_id: str, profiler: SamplingProfiler, label: str) -> None:
+        self._entries[profile_id] = {
+            "label": label,
+            "created_at": time.time(),
+            "samples": profiler.sample_count,
+            "collapsed": profiler.collapsed(),
+        }
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def get(self, profile_id: str) -> Dict[str, object] | None:
+        return self._entries.get(profile_id)
+
+    def list(self) -> list[Dict[str, object]]:
+        return [
+            {"id": k, "label": v["label"], "created_at": v["created_at"], "samples": v["samples"]}
+            for k, v in reversed(self._entries.items())
+        ]
+
+profile_store = ProfileStore()
+
+# 同時に走らせるプロファイラは 1 つまで (サンプリングスレッドが増えると計測自体が重くなる)
+profiling_lock = threading.Lock()
@@ -5,7 +5,7 @@ from typing import AsyncGenerator, List, Dict, Any
 
 from langchain_ollama import ChatOllama
 from app.core.config import settings
-from openai import OpenAI, AsyncOpenAI
+from openai import AsyncOpenAI, BadRequestError
 from openai.types.chat import ChatCompletionMessageParam
 from openai.types.chat import ChatCompletionChunk
 
@@ -32,60 +32,153 @@ def resolve_provider(model: str | None, explicit: str | None) -> tuple[str, str]
         default_provider = settings.DEFAULT_MODEL.split(":", 1)[0]
     return default_provider, model
 
-# OpenAI 呼び出し（非ストリーム）
-async def openai_complete(model: str, messages: List[ChatCompletionMessageParam], output_structure: type = None, temperature: float | None = None):
-    client = OpenAI(
-        api_key=settings.OPENAI_API_KEY
-    )
+# OpenAI クライアントはプロセスで 1 つを共有する (接続プールを使い回す)
+_openai_client: AsyncOpenAI | None = None
+def openai_client() -> AsyncOpenAI:
+    global _openai_client
+    if _openai_client is None:
+        _openai_client = AsyncOpenAI(
+            api_key=settings.OPENAI_API_KEY,
+            base_url=settings.OPENAI_BASE_URL,
+            timeout=httpx.Timeout(settings.OPENAI_TIMEOUT, connect=settings.OPENAI_CONNECT_TIMEOUT),
+            max_retries=settings.OPENAI_MAX_RETRIES,
+        )
+    return _openai_client
+
+# モデル毎のパラメータ対応。reasoning 系は temperature / top_p が既定値 (1) しか受け付けない
+_sampling_unsupported: set[str] = set()
+
+def _supports_sampling(model: str) -> bool:
+    if model in _sampling_unsupported:
+        return False
+    prefixes = [p.strip() for p in settings.OPENAI_FIXED_SAMPLING_MODELS.split(",") if p.strip()]
+    return not any(model.startswith(p) for p in prefixes)
+
+def _openai_params(model: str, temperature: float | None, max_tokens: int | None, top_p: float | None) -> Dict[str, Any]:
+    kwargs: Dict[str, Any] = {}
+    if max_tokens:
+        kwargs["max_completion_tokens"] = max_tokens
+    if _supports_sampling(model):
+        if temperature is not None:
+            kwargs["temperature"] = temperature
+        # 既定値 (1.0) は送らない
+        if top_p is not None and top_p != 1.0:
+            kwargs["top_p"] = top_p
+    return kwargs
+
+def _is_sampling_rejection(e: BadRequestError) -> bool:
+    body = e.body if isinstance(e.body, dict) else {}
+    return body.get("param") in ("temperature", "top_p") or "temperature" in e.message or "top_p" in e.message
 
-    # FIXME: temperature はモデルに依存するのでその考慮を入れる
+async def _with_capabilities(model: str, temperature: float | None, max_tokens: int | None, top_p: float | None, call):
+    """未知のモデルが temperature / top_p を拒否したら覚えておき、外して 1 回だけやり直す"""
+    params = _openai_params(model, temperature, max_tokens, top_p)
+    try:
+        return await call(params)
+    except BadRequestError as e:
+        if ("temperature" not in params and "top_p" not in params) or not _is_sampling_rejection(e):
+            raise
+        _sampling_unsupported.add(model)
+        return await call(_openai_params(model, temperature, max_tokens, top_p))
+
+# OpenAI 呼び出し（非ストリーム）
+async def openai_complete(model: str, messages: List[ChatCompletionMessageParam], output_structure: type = None, temperature: float | None = None, max_tokens: int | None = None, top_p: float | None = None):
+    client = openai_client()
     if output_structure:
-        response = client.chat.completions.parse(
-            model=model,
-            messages=messages,
-            temperature=1, # The error sayed Only the default (1) value is supported.
-            response_format=output_structure
-        )
-    else:
-        response = client.chat.completions.create(
+        if settings.OPENAI_STRUCTURED_STREAM:
+            return await _with_capabilities(model, temperature, max_tokens, top_p, lambda params: _parse_streamed(client, model, messages, output_structure, params))
+        return await _with_capabilities(model, temperature, max_tokens, top_p, lambda params: client.chat.completions.parse(
             model=model,
             messages=messages,
-            temperature=1, # The error sayed Only the default (1) value is supported.
-            stream=False
-        )
-    return response
+            response_format=output_structure,
+            **params,
+        ))
+    return await _with_capabilities(model, temperature, max_tokens, top_p, lambda params: client.chat.completions.create(
+        model=model,
+        messages=messages,
+        stream=False,
+        **params,
+    ))
+
+async def _parse_streamed(client: AsyncOpenAI, model: str, messages: List[ChatCompletionMessageParam], output_structure: type, params: Dict[str, Any]):
+    """
+    構造化出力をストリームで受ける。戻りは parse() と同じ ParsedChatCompletion。
+    長い JSON でも接続が黙り込まないので、途中のプロキシのアイドルタイムアウトに掛からない。
+    """
+    async with client.chat.completions.stream(
+        model=model,
+        messages=messages,
+        response_format=output_structure,
+        stream_options={"include_usage": True},
+        **params,
+    ) as stream:
+        async for _ in stream:
+            pass
+        return await stream.get_final_completion()
 
 # OpenAI ストリーミング (SSE 風)
-def openai_stream(model: str, messages: List[ChatCompletionMessageParam], temperature: float | None):
-    client = AsyncOpenAI(
-        api_key=settings.OPENAI_API_KEY
-    )
-    # FIXME: temperature はモデルに依存するのでその考慮を入れる
-    return client.chat.completions.create(
+async def openai_stream(model: str, messages: List[ChatCompletionMessageParam], temperature: float | None, max_tokens: int | None = None, top_p: float | None = None):
+    client = openai_client()
+    return await _with_capabilities(model, temperature, max_tokens, top_p, lambda params: client.chat.completions.create(
         model=model,
         messages=messages,
-        temperature=1, # The error sayed Only the default (1) value is supported.
-        stream=True
-    )
+        stream=True,
+        stream_options={"include_usage": True},  # 最終チャンクで usage を受け取る
+        **params,
+    ))
 
 # Ollama 直接 (非ストリーム)
-async def ollama_complete(model: str, messages_lc, output_structure: type = None, temperature: float | None = None):
-    llm = get_llm(model=model, output_structure=output_structure, temperature=temperature)
+async def ollama_complete(model: str, messages_lc, output_structure: type = None, temperature: float | None = None, max_tokens: int | None = None, top_p: float | None = None, include_raw: bool = False):
+    llm = get_llm(model=model, output_structure=output_structure, include_raw=include_raw, temperature=temperature, num_predict=max_tokens, top_p=top_p)
     out = await llm.ainvoke(messages_lc)
     return out
 
 # Ollama ストリーム
-async def ollama_stream(model: str, messages_lc, output_structure: type = None, temperature: float | None = None):
-    llm = get_llm(model=model, output_structure=output_structure, temperature=temperature)
+async def ollama_stream(model: str, messages_lc, output_structure: type = None, temperature: float | None = None, max_tokens: int | None = None, top_p: float | None = None):
+    llm = get_llm(model=model, output_structure=output_structure, temperature=temperature, num_predict=max_tokens, top_p=top_p)
     async for chunk in llm.astream(messages_lc):
         yield chunk
 
-def get_llm(model: str | None = None, output_structure: type = None, **overrides):
+# Ollama 埋め込み (/api/embed は input に配列を渡すと 1 回でまとめて計算する)
+_ollama_http: httpx.AsyncClient | None = None
+def _ollama_client() -> httpx.AsyncClient:
+    global _ollama_http
+    if _ollama_http is None:
+        _ollama_http = httpx.AsyncClient(
+            base_url=settings.OLLAMA_BASE_URL,
+            timeout=httpx.Timeout(settings.EMBEDDING_TIMEOUT, connect=10.0),
+        )
+    return _ollama_http
+
+async def ollama_embed(model: str, texts: List[str]) -> tuple[List[List[float]], int]:
+    """戻り: (texts と同じ順の埋め込み, prompt_tokens)"""
+    r = await _ollama_client().post("/api/embed", json={"model": model, "input": texts})
+    r.raise_for_status()
+    data = r.json()
+    embeddings = data.get("embeddings") or []
+    if len(embeddings) != len(texts):
+        raise RuntimeError(f"ollama returned {len(embeddings)} embeddings for {len(texts)} inputs")
+    return embeddings, int(data.get("prompt_eval_count") or 0)
+
+def get_llm(model: str | None = None, output_structure: type = None, include_raw: bool = False, **overrides):
+    # None のオプションは Ollama 側の既定値に任せる
+    overrides = {k: v for k, v in overrides.items() if v is not None}
     llm = ChatOllama(
         model=model or settings.DEFAULT_MODEL,
         base_url=settings.OLLAMA_BASE_URL,
         **overrides
     )
     if output_structure:
-        llm = llm.with_structured_output(output_structure)
+        # json_schema: Ollama の format にスキーマを渡し、生成自体を JSON に制約する
+        llm = llm.with_structured_output(output_structure, method="json_schema", include_raw=include_raw)
     return llm
+
+async def aclose_clients() -> None:
+    """shutdown 時に共有クライアントの接続を閉じる"""
+    global _openai_client, _ollama_http
+    if _openai_client is not None:
+        await _openai_client.close()
+        _openai_client = None
+    if _ollama_http is not None:
+        await _ollama_http.aclose()
+        _ollama_http = None
@@ -0,0 +1,234 @@
+from __future__ import annotations
+import asyncio
+import collections
+import contextlib
+import logging
+import os
+import time
+from typing import Any, AsyncIterator, Callable, Deque, Dict, Tuple
+from fastapi import Request
+from fastapi.responses import StreamingResponse
+from app.core.config import settings
+from app.services.admission import client_key
+
+logger = logging.getLogger(__name__)
+
+STREAM_ID_HEADER = "X-Stream-Id"
+STREAM_OFFSET_HEADER = "X-Stream-Offset"
+
+class StreamBuffer:
+    """
+    1 本のストリームの出力を溜めるリングバッファ。生成 (producer) は読み手と切り離して走らせ、
+    読み手が切断しても STREAM_RESUME_GRACE 秒は生成を続ける。seq は先頭からのイベント番号。
+    """
+    def __init__(self, stream_id: str, owner: str, media_type: str, headers: Dict[str, str]):
+        self.stream_id = stream_id
+        self.owner = owner
+        self.media_type = media_type
+        self.headers = headers
+        self.sse = media_type == "text/event-stream"
+        self._events: Deque[Tuple[int, Any]] = collections.deque()
+        self.base_seq = 0            # リングに残っている最古の seq
+        self.next_seq = 0
+        self.bytes = 0
+        self.done = False
+        self.producer: asyncio.Task | None = None
+        self.readers = 0
+        self.reader_token = 0         # 新しい読み手が付いたら古い読み手は抜ける
+        self.detached_at = time.monotonic()
+        self._changed = asyncio.Event()
+
+    def append(self, chunk: Any) -> int:
+        """戻り: バッファの増分バイト数 (リングから押し出した分を差し引く)"""
+        before = self.bytes
+        self._events.append((self.next_seq, chunk))
+        self.next_seq += 1
+        self.bytes += len(chunk)
+        while self.bytes > settings.STREAM_BUFFER_MAX_BYTES and len(self._events) > 1:
+            _, old = self._events.popleft()
+            self.bytes -= len(old)
+            self.base_seq += 1
+        self._notify()
+        return self.bytes - before
+
+    def finish(self) -> None:
+        self.done = True
+        self._notify()
+
+    def _notify(self) -> None:
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def can_resume(self, offset: int) -> bool:
+        return self.base_seq <= offset <= self.next_seq
+
+    def _format(self, seq: int, chunk: Any) -> Any:
+        # SSE は id に stream_id:seq を載せ、Last-Event-ID だけで再開できるようにする
+        if self.sse:
+            return f"id: {self.stream_id}:{seq}\n{chunk}"
+        return chunk
+
+    async def read(self, offset: int) -> AsyncIterator[Any]:
+        self.reader_token += 1
+        token = self.reader_token
+        self.readers += 1
+        seq = offset
+        try:
+            while token == self.reader_token:
+                if seq < self.base_seq:
+                    # リングから溢れた分は返せないので打ち切る (再接続すれば再生成になる)
+                    return
+                changed = self._changed
+                for event_seq, chunk in list(self._events):
+                    if event_seq >= seq:
+                        yield self._format(event_seq, chunk)
+                        seq = event_seq + 1
+                if self.done and seq >= self.next_seq:
+                    return
+                if seq >= self.next_seq:
+                    await changed.wait()
+        finally:
+            self.readers -= 1
+            if self.readers == 0:
+                self.detached_at = time.monotonic()
+
+class StreamRegistry:
+    """
+    再開可能なストリームの置き場。読み手の居ないストリームは STREAM_RESUME_GRACE 秒で生成を止めて捨て、
+    全バッファの合計が STREAM_BUFFER_BUDGET_BYTES を超えたら読み手の居ないものから古い順に捨てる。
+    """
+    def __init__(self):
+        self._buffers: "collections.OrderedDict[str, StreamBuffer]" = collections.OrderedDict()
+        self._task: asyncio.Task | None = None
+        self.total_bytes = 0
+        self.resumed = 0
+        self.expired = 0
+        self.evicted = 0
+
+    @property
+    def enabled(self) -> bool:
+        return settings.STREAM_RESUME_GRACE > 0
+
+    def start(self) -> None:
+        if not self.enabled or self._task is not None:
+            return
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+        for stream_id in list(self._buffers):
+            await self._drop(stream_id)
+
+    def open(self, request: Request, source: AsyncIterator[Any], media_type: str, headers: Dict[str, str], on_done: Callable[[], None] | None = None) -> StreamingResponse:
+        """
+        source を切り離したタスクで回し、その出力を読む StreamingResponse を返す。
+        on_done は生成の終了時 (始まる前に捨てられた場合も) に呼ぶ。受付枠の返却など
+        """
+        stream_id = "strm-" + os.urandom(9).hex()
+        buffer = StreamBuffer(stream_id, client_key(request), media_type, headers)
+        buffer.producer = asyncio.create_task(self._pump(buffer, source))
+        buffer.producer.add_done_callback(lambda _: buffer.finish())
+        if on_done is not None:
+            buffer.producer.add_done_callback(lambda _: on_done())
+        self._buffers[stream_id] = buffer
+        return StreamingResponse(
+            buffer.read(0),
+            media_type=media_type,
+            headers={**headers, STREAM_ID_HEADER: stream_id},
+        )
+
+    def resume(self, request: Request) -> StreamingResponse | None:
+        """
+        Last-Event-ID ("<stream_id>:<seq>") または X-Stream-Id + X-Stream-Offset (受信済みイベント数) で再開する。
+        該当が無い / 溢れて再開できないときは None (呼び出し側で通常どおり生成する)。
+        """
+        if not self.enabled:
+            return None
+        stream_id, offset = _resume_point(request)
+        if stream_id is None:
+            return None
+        buffer = self._buffers.get(stream_id)
+        if buffer is None or buffer.owner != client_key(request) or not buffer.can_resume(offset):
+            return None
+        self._buffers.move_to_end(stream_id)
+        self.resumed += 1
+        return StreamingResponse(
+            buffer.read(offset),
+            media_type=buffer.media_type,
+            headers={**buffer.headers, STREAM_ID_HEADER: stream_id, "X-Stream-Resumed-From": str(offset)},
+        )
+
+    async def _pump(self, buffer: StreamBuffer, source: AsyncIterator[Any]) -> None:
+        try:
+            async for chunk in source:
+                self.total_bytes += buffer.append(chunk)
+                self._enforce_budget()
+        except asyncio.CancelledError:
+            pass
+        except Exception:
+            logger.exception("resumable stream %s failed", buffer.stream_id)
+
+    def _enforce_budget(self) -> None:
+        if self.total_bytes <= settings.STREAM_BUFFER_BUDGET_BYTES:
+            return
+        # 読み手の居ないもの: 完了済み -> 生成中 の順に、古いものから捨てる
+        idle = [b for b in self._buffers.values() if b.readers == 0]
+        for buffer in sorted(idle, key=lambda b: (not b.done, b.detached_at)):
+            if self.total_bytes <= settings.STREAM_BUFFER_BUDGET_BYTES:
+                break
+            self.total_bytes -= buffer.bytes
+            self.evicted += 1
+            self._discard(buffer.stream_id)
+
+    def _discard(self, stream_id: str) -> None:
+        buffer = self._buffers.pop(stream_id, None)
+        if buffer is not None and buffer.producer is not None and not buffer.producer.done():
+            buffer.producer.cancel()
+
+    async def _drop(self, stream_id: str) -> None:
+        buffer = self._buffers.get(stream_id)
+        self._discard(stream_id)
+        if buffer is not None and buffer.producer is not None:
+            with contextlib.suppress(BaseException):
+                await buffer.producer
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(1.0)
+            now = time.monotonic()
+            for stream_id, buffer in list(self._buffers.items()):
+                if buffer.readers == 0 and now - buffer.detached_at > settings.STREAM_RESUME_GRACE:
+                    # 猶予内に再接続が無ければ生成も止める (journal は cancelled になる)
+                    self.expired += 1
+                    self._discard(stream_id)
+            self.total_bytes = sum(b.bytes for b in self._buffers.values())
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "streams": len(self._buffers),
+            "generating": sum(1 for b in self._buffers.values() if not b.done),
+            "detached": sum(1 for b in self._buffers.values() if b.readers == 0),
+            "bytes": self.total_bytes,
+            "resumed": self.resumed,
+            "expired": self.expired,
+            "evicted": self.evicted,
+        }
+
+def _resume_point(request: Request) -> Tuple[str | None, int]:
+    last_event_id = request.headers.get("last-event-id")
+    if last_event_id and ":" in last_event_id:
+        stream_id, _, seq = last_event_id.rpartition(":")
+        if seq.isdigit():
+            return stream_id, int(seq) + 1
+    stream_id = request.headers.get(STREAM_ID_HEADER)
+    offset = request.headers.get(STREAM_OFFSET_HEADER, "0")
+    if stream_id and offset.isdigit():
+        return stream_id, int(offset)
+    return None, 0
+
+stream_registry = StreamRegistry()
@@ -0,0 +1,288 @@
+from __future__ import annotations
+import asyncio
+import functools
+import hashlib
+import logging
+import math
+import random
+import re
+import time
+import unicodedata
+from array import array
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Tuple
+from langchain_core.messages import BaseMessage, HumanMessage, SystemMessage
+from app.core.config import settings
+from app.services.embeddings import embedding_service
+
+logger = logging.getLogger(__name__)
+
+# LSH の超平面は次元数毎に固定の乱数で作る (プロセスを跨いでも同じ値)
+_LSH_SEED = 20240611
+
+def normalize_prompt(text: str) -> str:
+    """表記揺れ (全角半角 / 大文字小文字 / 空白) を寄せる"""
+    text = unicodedata.normalize("NFKC", text).lower()
+    return re.sub(r"\s+", " ", text).strip()
+
+def memory_fingerprint(word_meanings: List[Dict[str, Any]] | None) -> str:
+    """回答に差し込んだメモリの内容ハッシュ。メモリが書き換わると値が変わる"""
+    items = sorted((str(w.get("title")), str(w.get("content"))) for w in word_meanings or [])
+    return hashlib.sha256(repr(items).encode()).hexdigest()[:32]
+
+def _unit(vector: List[float]) -> array:
+    norm = math.sqrt(sum(x * x for x in vector)) or 1.0
+    return array("f", (x / norm for x in vector))
+
+def _dot(a: array, b: array) -> float:
+    return sum(x * y for x, y in zip(a, b))
+
+@functools.lru_cache(maxsize=8)
+def _hyperplanes(dims: int) -> List[List[array]]:
+    # 全スコープの索引で共有する
+    rng = random.Random(_LSH_SEED + dims)
+    return [
+        [array("f", (rng.gauss(0.0, 1.0) for _ in range(dims))) for _ in range(settings.SEMANTIC_CACHE_LSH_BITS)]
+        for _ in range(settings.SEMANTIC_CACHE_LSH_TABLES)
+    ]
+
+@dataclass
+class CacheEntry:
+    entry_id: int
+    scope: Tuple[str, str, str]
+    vector: array
+    answer: str
+    fingerprint: str
+    text_hash: str
+    expires_at: float
+    created_at: float = field(default_factory=time.monotonic)
+    hits: int = 0
+    buckets: List[int] = field(default_factory=list)
+
+class LSHIndex:
+    """
+    ランダム超平面による LSH (SimHash)。SEMANTIC_CACHE_LSH_TABLES 個の表それぞれで
+    SEMANTIC_CACHE_LSH_BITS ビットの署名を作り、どれかの表で同じバケツに入ったものを候補にする。
+    """
+    def __init__(self, dims: int):
+        self.tables = _hyperplanes(dims)
+        self._buckets: List[Dict[int, set[int]]] = [{} for _ in self.tables]
+        self.size = 0
+
+    def signatures(self, vector: array) -> List[int]:
+        out = []
+        for planes in self.tables:
+            sig = 0
+            for plane in planes:
+                sig = (sig << 1) | (_dot(plane, vector) >= 0)
+            out.append(sig)
+        return out
+
+    def add(self, entry: CacheEntry) -> None:
+        entry.buckets = self.signatures(entry.vector)
+        for table, sig in zip(self._buckets, entry.buckets):
+            table.setdefault(sig, set()).add(entry.entry_id)
+        self.size += 1
+
+    def remove(self, entry: CacheEntry) -> None:
+        for table, sig in zip(self._buckets, entry.buckets):
+            ids = table.get(sig)
+            if ids is not None:
+                ids.discard(entry.entry_id)
+                if not ids:
+                    del table[sig]
+        self.size -= 1
+
+    def candidates(self, vector: array) -> set[int]:
+        out: set[int] = set()
+        for table, sig in zip(self._buckets, self.signatures(vector)):
+            out |= table.get(sig, set())
+        return out
+
+@dataclass
+class CacheLookup:
+    """lookup の結果。store に渡すと同じ埋め込みを使い回す"""
+    scope: Tuple[str, str, str]
+    vector: array
+    fingerprint: str
+    text_hash: str
+    answer: str | None = None
+    similarity: float | None = None
+
+class SemanticCache:
+    """
+    最終回答の意味キャッシュ。最後のユーザ発言の埋め込みで近いものを引き、
+    (テナント, モデル, システムプロンプト) が同じで、差し込んだメモリも変わっていなければ前回の回答を返す。
+    プロセス内だけの索引なので、再起動やワーカー間では共有しない。
+    """
+    def __init__(self):
+        self._entries: "OrderedDict[int, CacheEntry]" = OrderedDict()
+        self._indexes: Dict[Tuple[Tuple[str, str, str], int], LSHIndex] = {}
+        # (スコープ, 依頼元, 質問) -> キャッシュから返した時刻。再生成の判定用
+        self._served: "OrderedDict[Tuple[Tuple[str, str, str], str, str], float]" = OrderedDict()
+        self._next_id = 0
+        self.lookups = 0
+        self.hits = 0
+        self.misses = 0
+        self.near_misses = 0             # 候補はあったがしきい値に届かなかった
+        self.stale = 0                   # 意味は一致したがメモリが変わっていた
+        self.regenerated = 0             # キャッシュから返した直後に同じ依頼元から同じ質問が来た (再生成 = 回答が不満だった可能性)
+        self.stores = 0
+        self.expired = 0
+        self.evicted = 0
+        self.errors = 0
+        self.similarity_sum = 0.0
+        self.near_miss_similarity_sum = 0.0
+        self.lookup_ms_sum = 0.0
+
+    @property
+    def enabled(self) -> bool:
+        return settings.SEMANTIC_CACHE
+
+    def eligible(self, messages: List[BaseMessage]) -> bool:
+        """直前の文脈に答えが左右されにくい、短い会話だけを対象にする"""
+        turns = sum(1 for m in messages if isinstance(m, HumanMessage))
+        return self.enabled and 0 < turns <= settings.SEMANTIC_CACHE_MAX_USER_TURNS and isinstance(messages[-1], HumanMessage)
+
+    def threshold(self, provider: str, model: str) -> float:
+        thresholds = settings.SEMANTIC_CACHE_THRESHOLDS
+        return float(thresholds.get(f"{provider}:{model}") or thresholds.get(model) or settings.SEMANTIC_CACHE_THRESHOLD)
+
+    async def lookup(self, tenant_id: str, provider: str, model: str, messages: List[BaseMessage], word_meanings: List[Dict[str, Any]] | None, requester: str | None = None) -> CacheLookup | None:
+        """
+        埋め込みが取れなければ None (キャッシュを使わずに生成する)。
+        requester (admission.client_key) は再生成の判定にだけ使う。別の利用者が同じ質問をしたのはキャッシュの本来の用途なので再生成とみなさない
+        """
+        started = time.perf_counter()
+        text = normalize_prompt(str(messages[-1].content or ""))
+        system = "\n".join(str(m.content) for m in messages if isinstance(m, SystemMessage))
+        scope = (tenant_id, f"{provider}:{model}", hashlib.sha256(system.encode()).hexdigest()[:16])
+        try:
+            vectors, _ = await asyncio.wait_for(
+                embedding_service.embed(settings.SEMANTIC_CACHE_EMBEDDING_MODEL or settings.EMBEDDING_DEFAULT_MODEL, [text]),
+                timeout=settings.SEMANTIC_CACHE_EMBED_TIMEOUT,
+            )
+        except Exception:
+            self.errors += 1
+            logger.warning("semantic cache embedding failed", exc_info=True)
+            return None
+        self.lookups += 1
+        result = CacheLookup(scope, _unit(vectors[0]), memory_fingerprint(word_meanings), hashlib.sha256(text.encode()).hexdigest())
+        now = time.monotonic()
+        served_at = self._served.pop((scope, requester, result.text_hash), None) if requester else None
+        if served_at is not None and now - served_at < settings.SEMANTIC_CACHE_REGENERATE_WINDOW:
+            # 同じ質問の再送は再生成とみなして作り直す (新しい回答で上書きされる)
+            self.regenerated += 1
+            self.misses += 1
+            self.lookup_ms_sum += (time.perf_counter() - started) * 1000
+            return result
+        best, best_sim, best_stale = None, -1.0, None
+        index = self._indexes.get((scope, len(result.vector)))
+        for entry_id in index.candidates(result.vector) if index is not None else ():
+            entry = self._entries.get(entry_id)
+            if entry is None:
+                continue
+            if entry.expires_at <= now:
+                self._remove(entry)
+                self.expired += 1
+                continue
+            sim = _dot(entry.vector, result.vector)
+            if entry.fingerprint != result.fingerprint:
+                if best_stale is None or sim > best_stale:
+                    best_stale = sim
+                continue
+            if sim > best_sim:
+                best, best_sim = entry, sim
+        self.lookup_ms_sum += (time.perf_counter() - started) * 1000
+        threshold = self.threshold(provider, model)
+        if best is not None and best_sim >= threshold:
+            best.hits += 1
+            self._entries.move_to_end(best.entry_id)
+            self.hits += 1
+            self.similarity_sum += best_sim
+            if requester:
+                self._remember_served((scope, requester, result.text_hash), now)
+            result.answer, result.similarity = best.answer, round(best_sim, 4)
+            return result
+        self.misses += 1
+        if best_stale is not None and best_stale >= threshold:
+            self.stale += 1
+        elif best is not None:
+            self.near_misses += 1
+            self.near_miss_similarity_sum += best_sim
+            result.similarity = round(best_sim, 4)
+        return result
+
+    def store(self, lookup: CacheLookup, answer: str) -> None:
+        if not answer.strip() or settings.SEMANTIC_CACHE_MAX_ENTRIES <= 0:
+            return
+        key = (lookup.scope, len(lookup.vector))
+        index = self._indexes.get(key)
+        for entry_id in index.candidates(lookup.vector) if index is not None else ():
+            # 同じ質問の古い回答は置き換える
+            entry = self._entries.get(entry_id)
+            if entry is not None and entry.text_hash == lookup.text_hash:
+                self._remove(entry)
+        now = time.monotonic()
+        while self._entries and next(iter(self._entries.values())).expires_at <= now:
+            self._remove(next(iter(self._entries.values())))
+            self.expired += 1
+        # 上で空になった索引は捨てられているので取り直す
+        index = self._indexes.get(key)
+        if index is None:
+            index = self._indexes[key] = LSHIndex(len(lookup.vector))
+        self._next_id += 1
+        entry = CacheEntry(
+            entry_id=self._next_id,
+            scope=lookup.scope,
+            vector=lookup.vector,
+            answer=answer,
+            fingerprint=lookup.fingerprint,
+            text_hash=lookup.text_hash,
+            expires_at=now + settings.SEMANTIC_CACHE_TTL,
+        )
+        index.add(entry)
+        self._entries[entry.entry_id] = entry
+        self.stores += 1
+        while len(self._entries) > settings.SEMANTIC_CACHE_MAX_ENTRIES:
+            self._remove(next(iter(self._entries.values())))
+            self.evicted += 1
+
+    def _remove(self, entry: CacheEntry) -> None:
+        self._entries.pop(entry.entry_id, None)
+        key = (entry.scope, len(entry.vector))
+        index = self._indexes.get(key)
+        if index is not None:
+            index.remove(entry)
+            if index.size <= 0:
+                del self._indexes[key]
+
+    def _remember_served(self, key: Tuple[Tuple[str, str, str], str, str], now: float) -> None:
+        self._served[key] = now
+        self._served.move_to_end(key)
+        while self._served and (len(self._served) > settings.SEMANTIC_CACHE_MAX_ENTRIES or now - next(iter(self._served.values())) > settings.SEMANTIC_CACHE_REGENERATE_WINDOW):
+            self._served.popitem(last=False)
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "entries": len(self._entries),
+            "scopes": len(self._indexes),
+            "lookups": self.lookups,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / self.lookups, 3) if self.lookups else None,
+            "avg_hit_similarity": round(self.similarity_sum / self.hits, 4) if self.hits else None,
+            "near_misses": self.near_misses,
+            "avg_near_miss_similarity": round(self.near_miss_similarity_sum / self.near_misses, 4) if self.near_misses else None,
+            "stale": self.stale,
+            "regenerated": self.regenerated,
+            "stores": self.stores,
+            "expired": self.expired,
+            "evicted": self.evicted,
+            "errors": self.errors,
+            "avg_lookup_ms": round(self.lookup_ms_sum / self.lookups, 2) if self.lookups else None,
+        }
+
+semantic_cache = SemanticCache()
@@ -0,0 +1,120 @@
+from __future__ import annotations
+import asyncio
+import contextlib
+import time
+from typing import Any, Callable, Dict, List
+from langchain_core.messages import BaseMessage
+from app.services.journal import current_journal, set_current_node
+from app.services.llm import call_llm
+
+class SpeculationStats:
+    def __init__(self):
+        self.started = 0
+        self.committed = 0
+        self.cancelled = 0
+        self.failed = 0                 # 投機側が失敗して通常の生成に戻った
+        self.wasted_tokens = 0          # 取り消した投機で生成済みだったトークン数 (概算)
+        self.saved_ms = 0.0             # 確定した投機がメモリ段階と重ねられた時間の合計
+
+    def snapshot(self) -> Dict[str, Any]:
+        decided = self.committed + self.cancelled
+        return {
+            "started": self.started,
+            "committed": self.committed,
+            "cancelled": self.cancelled,
+            "failed": self.failed,
+            "hit_rate": round(self.committed / decided, 3) if decided else None,
+            "wasted_tokens": self.wasted_tokens,
+            "saved_ms": round(self.saved_ms, 1),
+        }
+
+speculation_stats = SpeculationStats()
+
+class Speculation:
+    """
+    メモリ段階と並行して、素の会話だけで最終回答を先に生成しておく。
+    トークンは確定 (commit) までバッファし、確定したら溜めた分を流してから残りをそのまま流す。
+    メモリから差し込むものがあれば cancel して通常どおり生成し直す。
+    """
+    def __init__(self, route: Dict[str, Any], messages: List[BaseMessage], stream: bool):
+        self.started = time.perf_counter()
+        self.stream = stream
+        self._events: List[Dict[str, Any]] = []
+        self._forward: Callable[[Dict[str, Any]], None] | None = None
+        self._marked = False
+        self.task = asyncio.create_task(self._run(route, messages))
+        speculation_stats.started += 1
+        journal = current_journal()
+        if journal is not None:
+            # グラフが途中で失敗 / 切断しても投機を残さない
+            journal.on_finish(self._abandon)
+
+    async def _run(self, route: Dict[str, Any], messages: List[BaseMessage]) -> str:
+        # LLM 呼び出しの記録を最終回答ノードに紐付ける
+        set_current_node("call_llm_node")
+        return await call_llm(
+            provider=route["provider"],
+            model=route["model"],
+            messages_lc=messages,
+            temperature=route["temperature"],
+            stream=self.stream,
+            max_tokens=route["max_tokens"],
+            top_p=route["top_p"],
+            writer=self._write,
+        )
+
+    def _write(self, event: Dict[str, Any]) -> None:
+        if self._forward is None:
+            self._events.append(event)
+            return
+        self._mark_first_token()
+        self._forward(event)
+
+    async def commit(self, writer: Callable[[Dict[str, Any]], None] | None) -> str | None:
+        """投機の結果を採用する。投機側が何も流さずに失敗していたら None (呼び出し側で生成し直す)"""
+        events, self._events = self._events, []
+        if writer is not None:
+            if events:
+                self._mark_first_token()
+            for event in events:
+                writer(event)
+            self._forward = writer
+        try:
+            answer = await self.task
+        except Exception:
+            if self._marked:
+                # 途中まで流してしまったのでやり直せない
+                raise
+            speculation_stats.failed += 1
+            return None
+        speculation_stats.committed += 1
+        speculation_stats.saved_ms += (time.perf_counter() - self.started) * 1000
+        return answer
+
+    async def cancel(self) -> None:
+        speculation_stats.cancelled += 1
+        speculation_stats.wasted_tokens += self._generated_tokens()
+        self.task.cancel()
+        with contextlib.suppress(BaseException):
+            await self.task
+
+    def _generated_tokens(self) -> int:
+        if self.stream:
+            # ストリームのイベントは概ね 1 トークン 1 件
+            return len(self._events)
+        if self.task.done() and not self.task.cancelled() and self.task.exception() is None:
+            return len(self.task.result()) // 4 + 1
+        return 0
+
+    def _mark_first_token(self) -> None:
+        # クライアントに最初のトークンが渡った時点を TTFT とする
+        if self._marked:
+            return
+        self._marked = True
+        journal = current_journal()
+        if journal is not None:
+            journal.mark_first_token()
+
+    def _abandon(self) -> None:
+        if not self.task.done():
+            self.task.cancel()
@@ -0,0 +1,25 @@
+from __future__ import annotations
+import hashlib
+from fastapi import Request
+from langchain_core.runnables.config import RunnableConfig
+from app.core.config import settings
+
+TENANT_ID_MAX_LENGTH = 64
+
+def tenant_id_for(request: Request) -> str:
+    """メモリを引く単位となるテナント ID。長すぎる値は列に収まるようハッシュに置き換える"""
+    tenant = request.headers.get(settings.TENANT_HEADER, "").strip() if settings.TENANT_HEADER else ""
+    if not tenant:
+        return settings.DEFAULT_TENANT
+    if len(tenant) > TENANT_ID_MAX_LENGTH:
+        return "h:" + hashlib.sha256(tenant.encode()).hexdigest()[:TENANT_ID_MAX_LENGTH - 2]
+    return tenant
+
+def memory_pipeline_for(request: Request) -> str | None:
+    """ベンチマーク用にリクエスト毎にメモリ段階のモードを切り替える (MEMORY_PIPELINE_HEADER)"""
+    if not settings.MEMORY_PIPELINE_HEADER:
+        return None
+    return request.headers.get(settings.MEMORY_PIPELINE_HEADER)
+
+def config_tenant_id(config: RunnableConfig) -> str:
+    return config["configurable"].get("tenant_id") or settings.DEFAULT_TENANT
@@ -1,12 +1,31 @@
 from __future__ import annotations
-from fastapi import FastAPI
+from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, Response
 from app.core.config import settings
+from app.services.admission import AdmissionError
+from app.services.cancellation import ClientDisconnectedError
+from app.services.deadline import DeadlineExceededError
+from app.services.journal import journal_writer
+from app.services.capture import capture_writer
+from app.jobs.compact_memories import compaction_scheduler
+from app.jobs.summarize_memories import summary_scheduler
+from app.services.batches import batch_runner
+from app.services.providers import aclose_clients
+from app.services.history import history_compactor
+from app.services.memory_store import memory_write_queue
+from app.services.resumable import stream_registry
+from app.api.middlewares import CaptureMiddleware, ProfilingMiddleware
 from app.api.routers import (
     chat_router,
+    chat_ws_router,
     relay_router,
     health_router,
     models_router,
+    admin_router,
+    files_router,
+    batches_router,
+    embeddings_router,
 )
 
 app = FastAPI(title="OpenAI-compatible LangChain Gateway")
@@ -18,9 +37,55 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(ProfilingMiddleware)
+app.add_middleware(CaptureMiddleware)
+
+@app.on_event("startup")
+async def on_startup():
+    journal_writer.start()
+    capture_writer.start()
+    compaction_scheduler.start()
+    summary_scheduler.start()
+    batch_runner.start()
+    memory_write_queue.start()
+    stream_registry.start()
+
+@app.on_event("shutdown")
+async def on_shutdown():
+    await journal_writer.stop()
+    await capture_writer.stop()
+    await compaction_scheduler.stop()
+    await summary_scheduler.stop()
+    await batch_runner.stop()
+    await stream_registry.stop()
+    await memory_write_queue.stop()
+    await history_compactor.stop()
+    await aclose_clients()
+
+@app.exception_handler(AdmissionError)
+async def admission_error_handler(request: Request, exc: AdmissionError):
+    return JSONResponse(
+        {"error": {"message": exc.detail, "type": "rate_limit_error" if exc.status_code == 429 else "server_overloaded"}},
+        status_code=exc.status_code,
+        headers={"Retry-After": str(exc.retry_after)},
+    )
+
+@app.exception_handler(DeadlineExceededError)
+async def deadline_error_handler(request: Request, exc: DeadlineExceededError):
+    return JSONResponse({"error": {"message": exc.detail, "type": "timeout"}}, status_code=504)
+
+@app.exception_handler(ClientDisconnectedError)
+async def client_disconnected_handler(request: Request, exc: ClientDisconnectedError):
+    # 受け取る相手はもう居ない。ログ / アクセスログ用に nginx と同じ 499 を付けておく
+    return Response(status_code=499)
 
 # Routers
 app.include_router(health_router)
 app.include_router(models_router)
 app.include_router(chat_router)
+app.include_router(chat_ws_router)
+app.include_router(admin_router)
+app.include_router(files_router)
+app.include_router(batches_router)
+app.include_router(embeddings_router)
 app.include_router(relay_router)
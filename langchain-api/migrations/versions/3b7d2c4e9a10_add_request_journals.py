@@ -0,0 +1,56 @@
+"""add request journals
+
+Revision ID: 3b7d2c4e9a10
+Revises: e2319fdb98a1
+Create Date: 2026-10-19 10:12:31.482113
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '3b7d2c4e9a10'
+down_revision: Union[str, Sequence[str], None] = 'e2319fdb98a1'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table('request_journals',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('request_id', sa.String(length=64), nullable=False),
+    sa.Column('endpoint', sa.String(length=100), nullable=False),
+    sa.Column('client_key', sa.String(length=255), nullable=True),
+    sa.Column('provider', sa.String(length=20), nullable=True),
+    sa.Column('model', sa.String(length=255), nullable=True),
+    sa.Column('status', sa.String(length=20), nullable=False),
+    sa.Column('error', sa.String(), nullable=True),
+    sa.Column('started_at', sa.DateTime(timezone=True), nullable=False),
+    sa.Column('queue_ms', sa.Float(), server_default='0', nullable=False),
+    sa.Column('ttft_ms', sa.Float(), nullable=True),
+    sa.Column('total_ms', sa.Float(), nullable=True),
+    sa.Column('prompt_tokens', sa.Integer(), server_default='0', nullable=False),
+    sa.Column('completion_tokens', sa.Integer(), server_default='0', nullable=False),
+    sa.Column('memories_injected', sa.Integer(), server_default='0', nullable=False),
+    sa.Column('db_ms', sa.Float(), server_default='0', nullable=False),
+    sa.Column('route', sa.JSON(), nullable=False),
+    sa.Column('nodes', sa.JSON(), nullable=False),
+    sa.Column('llm_calls', sa.JSON(), nullable=False),
+    sa.Column('db_calls', sa.JSON(), nullable=False),
+    sa.Column('retrieval', sa.JSON(), nullable=False),
+    sa.Column('created_at', sa.DateTime(timezone=True), server_default=sa.text('now()'), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_request_journals_request_id'), 'request_journals', ['request_id'], unique=False)
+    op.create_index(op.f('ix_request_journals_started_at'), 'request_journals', ['started_at'], unique=False)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index(op.f('ix_request_journals_started_at'), table_name='request_journals')
+    op.drop_index(op.f('ix_request_journals_request_id'), table_name='request_journals')
+    op.drop_table('request_journals')
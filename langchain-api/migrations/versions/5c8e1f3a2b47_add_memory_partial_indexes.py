@@ -0,0 +1,53 @@
+"""add memory partial indexes
+
+Revision ID: 5c8e1f3a2b47
+Revises: 3b7d2c4e9a10
+Create Date: 2026-10-19 13:41:07.215904
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '5c8e1f3a2b47'
+down_revision: Union[str, Sequence[str], None] = '3b7d2c4e9a10'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # 行数が多いテーブルでも書き込みを止めないよう CONCURRENTLY で作る (トランザクション外で実行する必要がある)
+    with op.get_context().autocommit_block():
+        op.create_index(
+            'ix_memories_active_title', 'memories', ['title'],
+            unique=False,
+            postgresql_include=['memory_simplicity'],
+            postgresql_where=sa.text('deleted_at IS NULL'),
+            postgresql_concurrently=True,
+            if_not_exists=True,
+        )
+        op.create_index(
+            'ix_memories_active_simplicity_title', 'memories', ['memory_simplicity', 'title'],
+            unique=False,
+            postgresql_where=sa.text('deleted_at IS NULL'),
+            postgresql_concurrently=True,
+            if_not_exists=True,
+        )
+        op.create_index(
+            'ix_memory_relations_child_id', 'memory_relations', ['child_id'],
+            unique=False,
+            postgresql_concurrently=True,
+            if_not_exists=True,
+        )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    with op.get_context().autocommit_block():
+        op.drop_index('ix_memory_relations_child_id', table_name='memory_relations', postgresql_concurrently=True, if_exists=True)
+        op.drop_index('ix_memories_active_simplicity_title', table_name='memories', postgresql_concurrently=True, if_exists=True)
+        op.drop_index('ix_memories_active_title', table_name='memories', postgresql_concurrently=True, if_exists=True)
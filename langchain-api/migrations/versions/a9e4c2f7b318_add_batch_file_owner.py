@@ -0,0 +1,33 @@
+"""add batch file owner
+
+Revision ID: a9e4c2f7b318
+Revises: f5d1c8b7e246
+Create Date: 2026-10-19 21:05:12.408316
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'a9e4c2f7b318'
+down_revision: Union[str, Sequence[str], None] = 'f5d1c8b7e246'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # 既存のファイルは作成者が分からないので NULL (誰からも見えない)。出力はバッチの作成者を引き継ぐ
+    op.add_column('batch_files', sa.Column('client_key', sa.String(length=255), nullable=True))
+    op.execute(
+        "UPDATE batch_files f SET client_key = b.client_key FROM batches b "
+        "WHERE f.id IN (b.input_file_id, b.output_file_id, b.error_file_id)"
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_column('batch_files', 'client_key')
@@ -0,0 +1,28 @@
+"""add merge content before
+
+Revision ID: b3f8d6a2e914
+Revises: a9e4c2f7b318
+Create Date: 2026-10-19 21:32:47.190552
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'b3f8d6a2e914'
+down_revision: Union[str, Sequence[str], None] = 'a9e4c2f7b318'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column('memory_merges', sa.Column('canonical_content_before', sa.String(), nullable=True))
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_column('memory_merges', 'canonical_content_before')
@@ -0,0 +1,170 @@
+"""partition memories by tenant
+
+Revision ID: b6d3e9f0a7c2
+Revises: 8a4f6d2e1c93
+Create Date: 2026-10-19 14:48:26.930172
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'b6d3e9f0a7c2'
+down_revision: Union[str, Sequence[str], None] = '8a4f6d2e1c93'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# app/db/partitioning.py の MEMORY_PARTITIONS と揃える
+PARTITIONS = 16
+# 既存の行は全てこのテナントに入れる (settings.DEFAULT_TENANT の既定値)
+DEFAULT_TENANT = 'default'
+
+
+def _create_partitions(table: str) -> None:
+    for i in range(PARTITIONS):
+        op.execute(
+            f"CREATE TABLE {table}_p{i} PARTITION OF {table} "
+            f"FOR VALUES WITH (MODULUS {PARTITIONS}, REMAINDER {i})"
+        )
+
+
+def _timestamps() -> list:
+    return [
+        sa.Column('created_at', sa.DateTime(timezone=True), server_default=sa.text('now()'), nullable=False),
+        sa.Column('updated_at', sa.DateTime(timezone=True), server_default=sa.text('now()'), nullable=False),
+    ]
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # 旧テーブルを退かす (主キーのインデックス名はスキーマ内で一意なので合わせて改名)
+    op.execute("ALTER TABLE memory_relations RENAME TO memory_relations_old")
+    op.execute("ALTER INDEX memory_relations_pkey RENAME TO memory_relations_old_pkey")
+    op.execute("ALTER TABLE memories RENAME TO memories_old")
+    op.execute("ALTER INDEX memories_pkey RENAME TO memories_old_pkey")
+    # id のシーケンスは新テーブルに引き継ぐ
+    op.execute("ALTER SEQUENCE memories_id_seq OWNED BY NONE")
+
+    op.create_table('memories',
+    sa.Column('tenant_id', sa.String(length=64), server_default=DEFAULT_TENANT, nullable=False),
+    sa.Column('id', sa.Integer(), server_default=sa.text("nextval('memories_id_seq')"), nullable=False),
+    sa.Column('title', sa.String(length=255), nullable=False),
+    sa.Column('content', sa.String(), nullable=False),
+    sa.Column('source_url', sa.String(length=500), nullable=True),
+    sa.Column('memory_simplicity', sa.Integer(), server_default='0', nullable=False),
+    *_timestamps(),
+    sa.Column('deleted_at', sa.DateTime(timezone=True), nullable=True),
+    sa.PrimaryKeyConstraint('tenant_id', 'id'),
+    sa.UniqueConstraint('tenant_id', 'title', name='uq_memories_tenant_title'),
+    postgresql_partition_by='HASH (tenant_id)',
+    )
+    _create_partitions('memories')
+    op.execute(
+        f"""
+        INSERT INTO memories (tenant_id, id, title, content, source_url, memory_simplicity, created_at, updated_at, deleted_at)
+        SELECT '{DEFAULT_TENANT}', id, title, content, source_url, memory_simplicity, created_at, updated_at, deleted_at
+        FROM memories_old
+        """
+    )
+
+    op.create_table('memory_relations',
+    sa.Column('tenant_id', sa.String(length=64), server_default=DEFAULT_TENANT, nullable=False),
+    sa.Column('parent_id', sa.Integer(), nullable=False),
+    sa.Column('child_id', sa.Integer(), nullable=False),
+    sa.Column('relation', sa.String(length=50), nullable=False),
+    *_timestamps(),
+    sa.ForeignKeyConstraint(['tenant_id', 'parent_id'], ['memories.tenant_id', 'memories.id'], ),
+    sa.ForeignKeyConstraint(['tenant_id', 'child_id'], ['memories.tenant_id', 'memories.id'], ),
+    sa.PrimaryKeyConstraint('tenant_id', 'parent_id', 'child_id'),
+    postgresql_partition_by='HASH (tenant_id)',
+    )
+    _create_partitions('memory_relations')
+    op.execute(
+        f"""
+        INSERT INTO memory_relations (tenant_id, parent_id, child_id, relation, created_at, updated_at)
+        SELECT '{DEFAULT_TENANT}', parent_id, child_id, relation, created_at, updated_at
+        FROM memory_relations_old
+        """
+    )
+
+    op.drop_table('memory_relations_old')
+    op.drop_table('memories_old')
+    op.execute("ALTER SEQUENCE memories_id_seq OWNED BY memories.id")
+
+    # パーティションテーブルの親には CONCURRENTLY が使えない (この時点ではまだ誰も参照していない)
+    op.create_index('ix_memories_active_title', 'memories', ['tenant_id', 'title'], unique=False,
+                    postgresql_include=['memory_simplicity'], postgresql_where=sa.text('deleted_at IS NULL'))
+    op.create_index('ix_memories_active_simplicity_title', 'memories', ['tenant_id', 'memory_simplicity', 'title'], unique=False,
+                    postgresql_where=sa.text('deleted_at IS NULL'))
+    op.create_index('ix_memories_deleted_at', 'memories', ['deleted_at'], unique=False,
+                    postgresql_where=sa.text('deleted_at IS NOT NULL'))
+    op.create_index('ix_memory_relations_child_id', 'memory_relations', ['tenant_id', 'child_id'], unique=False)
+    op.execute("ANALYZE memories")
+    op.execute("ANALYZE memory_relations")
+
+    op.add_column('memories_archive', sa.Column('tenant_id', sa.String(length=64), server_default=DEFAULT_TENANT, nullable=False))
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    # 単一テーブルでは title が全体で一意なので、戻せるのは既定テナントの行だけ
+    op.drop_column('memories_archive', 'tenant_id')
+
+    op.execute("ALTER TABLE memory_relations RENAME TO memory_relations_part")
+    op.execute("ALTER INDEX memory_relations_pkey RENAME TO memory_relations_part_pkey")
+    op.execute("ALTER TABLE memories RENAME TO memories_part")
+    op.execute("ALTER INDEX memories_pkey RENAME TO memories_part_pkey")
+    op.execute("ALTER INDEX ix_memories_active_title RENAME TO ix_memories_part_active_title")
+    op.execute("ALTER INDEX ix_memories_active_simplicity_title RENAME TO ix_memories_part_active_simplicity_title")
+    op.execute("ALTER INDEX ix_memories_deleted_at RENAME TO ix_memories_part_deleted_at")
+    op.execute("ALTER INDEX ix_memory_relations_child_id RENAME TO ix_memory_relations_part_child_id")
+    op.execute("ALTER SEQUENCE memories_id_seq OWNED BY NONE")
+
+    op.create_table('memories',
+    sa.Column('id', sa.Integer(), server_default=sa.text("nextval('memories_id_seq')"), nullable=False),
+    sa.Column('title', sa.String(length=255), nullable=False),
+    sa.Column('content', sa.String(), nullable=False),
+    sa.Column('source_url', sa.String(length=500), nullable=True),
+    sa.Column('memory_simplicity', sa.Integer(), server_default='0', nullable=False),
+    *_timestamps(),
+    sa.Column('deleted_at', sa.DateTime(timezone=True), nullable=True),
+    sa.PrimaryKeyConstraint('id'),
+    )
+    op.execute(
+        f"""
+        INSERT INTO memories (id, title, content, source_url, memory_simplicity, created_at, updated_at, deleted_at)
+        SELECT id, title, content, source_url, memory_simplicity, created_at, updated_at, deleted_at
+        FROM memories_part WHERE tenant_id = '{DEFAULT_TENANT}'
+        """
+    )
+    op.create_table('memory_relations',
+    sa.Column('parent_id', sa.Integer(), nullable=False),
+    sa.Column('child_id', sa.Integer(), nullable=False),
+    sa.Column('relation', sa.String(length=50), nullable=False),
+    *_timestamps(),
+    sa.ForeignKeyConstraint(['child_id'], ['memories.id'], ),
+    sa.ForeignKeyConstraint(['parent_id'], ['memories.id'], ),
+    sa.PrimaryKeyConstraint('parent_id', 'child_id'),
+    )
+    op.execute(
+        f"""
+        INSERT INTO memory_relations (parent_id, child_id, relation, created_at, updated_at)
+        SELECT parent_id, child_id, relation, created_at, updated_at
+        FROM memory_relations_part WHERE tenant_id = '{DEFAULT_TENANT}'
+        """
+    )
+    op.drop_table('memory_relations_part')
+    op.drop_table('memories_part')
+    op.execute("ALTER SEQUENCE memories_id_seq OWNED BY memories.id")
+
+    op.create_index(op.f('ix_memories_title'), 'memories', ['title'], unique=True)
+    op.create_index('ix_memories_memory_simplicity', 'memories', ['memory_simplicity'], unique=False)
+    op.create_index('ix_memories_deleted_at', 'memories', ['deleted_at'], unique=False)
+    op.create_index('ix_memories_active_title', 'memories', ['title'], unique=False,
+                    postgresql_include=['memory_simplicity'], postgresql_where=sa.text('deleted_at IS NULL'))
+    op.create_index('ix_memories_active_simplicity_title', 'memories', ['memory_simplicity', 'title'], unique=False,
+                    postgresql_where=sa.text('deleted_at IS NULL'))
+    op.create_index('ix_memory_relations_child_id', 'memory_relations', ['child_id'], unique=False)
@@ -0,0 +1,45 @@
+"""add memory merges
+
+Revision ID: c1e7a5b3d924
+Revises: b6d3e9f0a7c2
+Create Date: 2026-10-19 15:32:44.118306
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'c1e7a5b3d924'
+down_revision: Union[str, Sequence[str], None] = 'b6d3e9f0a7c2'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table('memory_merges',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('merge_id', sa.String(length=64), nullable=False),
+    sa.Column('tenant_id', sa.String(length=64), nullable=False),
+    sa.Column('canonical_id', sa.Integer(), nullable=False),
+    sa.Column('canonical_title', sa.String(length=255), nullable=False),
+    sa.Column('canonical_simplicity_before', sa.Integer(), nullable=False),
+    sa.Column('merged_id', sa.Integer(), nullable=False),
+    sa.Column('merged_title', sa.String(length=255), nullable=False),
+    sa.Column('similarity', sa.Float(), nullable=False),
+    sa.Column('relations_removed', sa.JSON(), nullable=False),
+    sa.Column('relations_added', sa.JSON(), nullable=False),
+    sa.Column('created_at', sa.DateTime(timezone=True), server_default=sa.text('now()'), nullable=False),
+    sa.Column('reverted_at', sa.DateTime(timezone=True), nullable=True),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_memory_merges_merge_id'), 'memory_merges', ['merge_id'], unique=False)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index(op.f('ix_memory_merges_merge_id'), table_name='memory_merges')
+    op.drop_table('memory_merges')
@@ -0,0 +1,46 @@
+"""add memory summaries
+
+Revision ID: d4b8e2f6a153
+Revises: c1e7a5b3d924
+Create Date: 2026-10-19 17:05:12.440918
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'd4b8e2f6a153'
+down_revision: Union[str, Sequence[str], None] = 'c1e7a5b3d924'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # パーティション親への ADD COLUMN は各パーティションにも伝播する
+    op.add_column('memories', sa.Column('summary', sa.String(), nullable=True))
+    op.add_column('memories', sa.Column('summary_stale', sa.Boolean(), server_default='false', nullable=False))
+    op.add_column('memories', sa.Column('summary_updated_at', sa.DateTime(timezone=True), nullable=True))
+    op.create_index(
+        'ix_memories_summary_stale',
+        'memories',
+        ['tenant_id', 'id'],
+        unique=False,
+        postgresql_where=sa.text('summary_stale'),
+    )
+    # 既に子を持つメモリは最初の要約待ちにしておく
+    op.execute(
+        "UPDATE memories SET summary_stale = true "
+        "WHERE (tenant_id, id) IN (SELECT DISTINCT tenant_id, parent_id FROM memory_relations)"
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('ix_memories_summary_stale', table_name='memories')
+    op.drop_column('memories', 'summary_updated_at')
+    op.drop_column('memories', 'summary_stale')
+    op.drop_column('memories', 'summary')
@@ -0,0 +1,86 @@
+"""add batches
+
+Revision ID: e7c3a9d1f5b2
+Revises: d4b8e2f6a153
+Create Date: 2026-10-19 18:22:37.905114
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'e7c3a9d1f5b2'
+down_revision: Union[str, Sequence[str], None] = 'd4b8e2f6a153'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table('batch_files',
+    sa.Column('id', sa.String(length=64), nullable=False),
+    sa.Column('tenant_id', sa.String(length=64), server_default='default', nullable=False),
+    sa.Column('purpose', sa.String(length=32), nullable=False),
+    sa.Column('filename', sa.String(length=255), nullable=False),
+    sa.Column('bytes', sa.Integer(), nullable=False),
+    sa.Column('content', sa.String(), nullable=False),
+    sa.Column('created_at', sa.DateTime(timezone=True), server_default=sa.text('now()'), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_batch_files_tenant_id'), 'batch_files', ['tenant_id'], unique=False)
+    op.create_table('batches',
+    sa.Column('id', sa.String(length=64), nullable=False),
+    sa.Column('tenant_id', sa.String(length=64), server_default='default', nullable=False),
+    sa.Column('client_key', sa.String(length=255), nullable=True),
+    sa.Column('endpoint', sa.String(length=100), nullable=False),
+    sa.Column('input_file_id', sa.String(length=64), nullable=False),
+    sa.Column('output_file_id', sa.String(length=64), nullable=True),
+    sa.Column('error_file_id', sa.String(length=64), nullable=True),
+    sa.Column('completion_window', sa.String(length=16), server_default='24h', nullable=False),
+    sa.Column('status', sa.String(length=20), nullable=False),
+    sa.Column('errors', sa.JSON(), nullable=True),
+    sa.Column('total', sa.Integer(), server_default='0', nullable=False),
+    sa.Column('completed', sa.Integer(), server_default='0', nullable=False),
+    sa.Column('failed', sa.Integer(), server_default='0', nullable=False),
+    sa.Column('metadata', sa.JSON(), nullable=True),
+    sa.Column('created_at', sa.DateTime(timezone=True), server_default=sa.text('now()'), nullable=False),
+    sa.Column('in_progress_at', sa.DateTime(timezone=True), nullable=True),
+    sa.Column('expires_at', sa.DateTime(timezone=True), nullable=True),
+    sa.Column('finalizing_at', sa.DateTime(timezone=True), nullable=True),
+    sa.Column('completed_at', sa.DateTime(timezone=True), nullable=True),
+    sa.Column('failed_at', sa.DateTime(timezone=True), nullable=True),
+    sa.Column('expired_at', sa.DateTime(timezone=True), nullable=True),
+    sa.Column('cancelling_at', sa.DateTime(timezone=True), nullable=True),
+    sa.Column('cancelled_at', sa.DateTime(timezone=True), nullable=True),
+    sa.ForeignKeyConstraint(['input_file_id'], ['batch_files.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_batches_status'), 'batches', ['status'], unique=False)
+    op.create_index(op.f('ix_batches_tenant_id'), 'batches', ['tenant_id'], unique=False)
+    op.create_table('batch_results',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('batch_id', sa.String(length=64), nullable=False),
+    sa.Column('line_index', sa.Integer(), nullable=False),
+    sa.Column('custom_id', sa.String(length=255), nullable=False),
+    sa.Column('request_id', sa.String(length=64), nullable=False),
+    sa.Column('status_code', sa.Integer(), nullable=False),
+    sa.Column('body', sa.JSON(), nullable=True),
+    sa.Column('error', sa.JSON(), nullable=True),
+    sa.Column('created_at', sa.DateTime(timezone=True), server_default=sa.text('now()'), nullable=False),
+    sa.ForeignKeyConstraint(['batch_id'], ['batches.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('batch_id', 'line_index', name='uq_batch_results_batch_line')
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_table('batch_results')
+    op.drop_index(op.f('ix_batches_tenant_id'), table_name='batches')
+    op.drop_index(op.f('ix_batches_status'), table_name='batches')
+    op.drop_table('batches')
+    op.drop_index(op.f('ix_batch_files_tenant_id'), table_name='batch_files')
+    op.drop_table('batch_files')
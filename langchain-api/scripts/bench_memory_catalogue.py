@@ -0,0 +1,158 @@
+"""
+メモリカタログ系クエリの EXPLAIN ベンチマーク。
+
+使い捨てのスキーマにダミーの memories / memory_relations (テナント毎のハッシュパーティション) を作り、行数毎に
+「部分カバリングインデックスなし (移行前)」と「あり (移行後)」の実行計画と実行時間を比べる。
+
+    cd langchain-api
+    python scripts/bench_memory_catalogue.py --rows 10000 100000 1000000
+    python scripts/bench_memory_catalogue.py --rows 100000 --keep   # スキーマを残して手で調べる
+
+DATABASE_URL は app/db/session.py と同じものを使う (asyncpg は psycopg に読み替える)。
+"""
+from __future__ import annotations
+import argparse
+import json
+import os
+import sys
+from typing import Any, Dict, List
+
+from sqlalchemy import create_engine, text
+from sqlalchemy.dialects import postgresql
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.db.session import DATABASE_URL  # noqa: E402
+from app.db.models.memory import Memory, MemoryRelation, active_catalogue_stmt  # noqa: E402
+
+NEW_INDEXES = ("ix_memories_active_title", "ix_memories_active_simplicity_title", "ix_memory_relations_child_id")
+
+def _sql(stmt) -> str:
+    return str(stmt.compile(dialect=postgresql.dialect(), compile_kwargs={"literal_binds": True}))
+
+def queries(rows: int, tenants: int) -> Dict[str, str]:
+    # テナント t0 の行 (i % tenants == 0) を対象にする
+    own = list(range(0, rows, tenants))
+    probe = [f"'word-{i:08d}'" for i in own[::max(1, len(own) // 20)]][:20]
+    middle = f"word-{own[len(own) // 2]:08d}"
+    return {
+        # 変更前のクエリ (DISTINCT 付き) も比較用に残す
+        "catalogue_distinct_old": (
+            "SELECT DISTINCT title, memory_simplicity FROM memories "
+            "WHERE tenant_id = 't0' AND memory_simplicity <= 500 AND deleted_at IS NULL ORDER BY title"
+        ),
+        "catalogue": _sql(active_catalogue_stmt("t0", 500)),
+        "catalogue_simplicity_0": _sql(active_catalogue_stmt("t0", 0)),
+        "catalogue_first_page": _sql(active_catalogue_stmt("t0", 500, limit=1000)),
+        "catalogue_keyset_page": _sql(active_catalogue_stmt("t0", 500, after_title=middle, limit=1000)),
+        "meanings_by_titles": (
+            "SELECT title, content FROM memories "
+            f"WHERE tenant_id = 't0' AND title IN ({', '.join(probe)}) AND memory_simplicity <= 1000 AND deleted_at IS NULL"
+        ),
+        "relations_by_child": f"SELECT parent_id FROM memory_relations WHERE tenant_id = 't0' AND child_id = {own[len(own) // 3] + 1}",
+    }
+
+def populate(conn, rows: int, tenants: int, deleted_ratio: float) -> None:
+    Memory.metadata.create_all(conn, tables=[Memory.__table__, MemoryRelation.__table__])
+    conn.execute(text(
+        """
+        INSERT INTO memories (tenant_id, id, title, content, memory_simplicity, deleted_at)
+        SELECT
+            't' || (i % :tenants),
+            i + 1,
+            'word-' || lpad(i::text, 8, '0'),
+            repeat('meaning ', 20),
+            (ARRAY[0, 500, 1000])[1 + (i % 3)],
+            CASE WHEN random() < :deleted_ratio THEN now() END
+        FROM generate_series(0, :rows - 1) AS i
+        """
+    ), {"rows": rows, "tenants": tenants, "deleted_ratio": deleted_ratio})
+    # 1 件あたり平均 2 本程度の関係 (同じテナント内の id = i + 1 同士)
+    conn.execute(text(
+        """
+        INSERT INTO memory_relations (tenant_id, parent_id, child_id, relation)
+        SELECT DISTINCT 't' || (p % :tenants), p + 1, c + 1, 'related' FROM (
+            SELECT p, p % :tenants + :tenants * (random() * ((:rows - 1) / :tenants))::int AS c
+            FROM (SELECT (random() * (:rows - 1))::int AS p FROM generate_series(1, :rows * 2)) r
+        ) s WHERE p <> c AND c < :rows
+        """
+    ), {"rows": rows, "tenants": tenants})
+
+def explain(conn, sql: str) -> Dict[str, Any]:
+    plan = conn.execute(text("EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) " + sql)).scalar_one()
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    root = plan[0]
+    nodes: List[str] = []
+
+    def walk(node: Dict[str, Any]) -> None:
+        label = node["Node Type"]
+        if node.get("Index Name"):
+            label += f"({node['Index Name']})"
+        nodes.append(label)
+        for child in node.get("Plans", []):
+            walk(child)
+
+    walk(root["Plan"])
+    return {
+        "ms": round(root["Execution Time"], 2),
+        "rows": root["Plan"].get("Actual Rows"),
+        "shared_hit": root["Plan"].get("Shared Hit Blocks", 0),
+        "shared_read": root["Plan"].get("Shared Read Blocks", 0),
+        "plan": " > ".join(nodes),
+    }
+
+def run(engine, rows: int, tenants: int, deleted_ratio: float, keep: bool) -> Dict[str, Any]:
+    schema = f"bench_memory_catalogue_{rows}"
+    results: Dict[str, Any] = {}
+    with engine.connect() as conn:
+        conn = conn.execution_options(isolation_level="AUTOCOMMIT")
+        conn.execute(text(f"DROP SCHEMA IF EXISTS {schema} CASCADE"))
+        conn.execute(text(f"CREATE SCHEMA {schema}"))
+        conn.execute(text(f"SET search_path TO {schema}"))
+        try:
+            populate(conn, rows, tenants, deleted_ratio)
+            for name in NEW_INDEXES:
+                conn.execute(text(f"DROP INDEX IF EXISTS {name}"))
+            conn.execute(text("VACUUM ANALYZE memories"))
+            conn.execute(text("VACUUM ANALYZE memory_relations"))
+            for label in ("before", "after"):
+                if label == "after":
+                    for index in list(Memory.__table__.indexes) + list(MemoryRelation.__table__.indexes):
+                        if index.name in NEW_INDEXES:
+                            index.create(conn)
+                    # index only scan には visibility map が要る
+                    conn.execute(text("VACUUM ANALYZE memories"))
+                    conn.execute(text("VACUUM ANALYZE memory_relations"))
+                for name, sql in queries(rows, tenants).items():
+                    explain(conn, sql)  # キャッシュを温める
+                    results.setdefault(name, {})[label] = explain(conn, sql)
+        finally:
+            if not keep:
+                conn.execute(text(f"DROP SCHEMA IF EXISTS {schema} CASCADE"))
+    return results
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, nargs="+", default=[10_000, 100_000, 1_000_000])
+    parser.add_argument("--tenants", type=int, default=100, help="行を振り分けるテナント数 (クエリは t0 を対象にする)")
+    parser.add_argument("--deleted-ratio", type=float, default=0.1, help="論理削除済みにする行の割合")
+    parser.add_argument("--keep", action="store_true", help="スキーマを削除せずに残す")
+    parser.add_argument("--json", action="store_true")
+    args = parser.parse_args()
+
+    engine = create_engine(DATABASE_URL.replace("+asyncpg", "+psycopg"))
+    report = {rows: run(engine, rows, args.tenants, args.deleted_ratio, args.keep) for rows in args.rows}
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+    for rows, results in report.items():
+        print(f"== {rows:,} rows ==")
+        for name, r in results.items():
+            before, after = r["before"], r["after"]
+            print(f"{name:24s} {before['ms']:>10.2f}ms -> {after['ms']:>10.2f}ms  rows={after['rows']}")
+            print(f"    before: {before['plan']}")
+            print(f"    after:  {after['plan']}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,219 @@
+"""
+CaptureMiddleware が書き出した NDJSON をゲートウェイに再生する負荷試験ツール。
+
+    # 記録時と同じ到着間隔 (1x) で再生
+    python scripts/replay_capture.py replay capture.ndjson --target http://localhost:8000
+    # 4 倍速、最初の 200 件だけ
+    python scripts/replay_capture.py replay capture.ndjson --speed 4 --limit 200
+    # 生のキャプチャを匿名化して共有用に書き出す
+    python scripts/replay_capture.py anonymize capture.ndjson capture.anon.ndjson
+
+到着はオープンループ (前のリクエストの完了を待たずに offset / speed の時刻に送る) なので、
+サーバが詰まると待ち行列がそのまま伸びて実運用と同じ形で遅延に現れる。
+"""
+from __future__ import annotations
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+from collections import Counter
+from dataclasses import dataclass, field
+from typing import Any, Dict, List
+
+import httpx
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+@dataclass
+class Result:
+    path: str
+    status: int | None = None
+    error: str | None = None
+    latency: float | None = None
+    ttft: float | None = None
+    lateness: float = 0.0  # 予定時刻からの送信遅れ (クライアント側が追いつけていない目安)
+
+@dataclass
+class Report:
+    results: List[Result] = field(default_factory=list)
+    wall: float = 0.0
+
+def load_capture(path: str, limit: int | None) -> List[Dict[str, Any]]:
+    records = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            records.append(json.loads(line))
+            if limit and len(records) >= limit:
+                break
+    records.sort(key=lambda r: r["offset"])
+    if records:
+        base = records[0]["offset"]
+        for r in records:
+            r["offset"] -= base
+    return records
+
+def _is_first_token(path: str, line: str) -> bool:
+    """ストリームの 1 行が本文を含むか (役割だけのチャンクや [DONE] は数えない)"""
+    if path == "/v1/chat/completions":
+        if not line.startswith("data:"):
+            return False
+        data = line[5:].strip()
+        if not data or data == "[DONE]":
+            return False
+        try:
+            chunk = json.loads(data)
+        except ValueError:
+            return False
+        return any((c.get("delta") or {}).get("content") for c in chunk.get("choices") or [])
+    try:
+        chunk = json.loads(line)
+    except ValueError:
+        return False
+    return bool((chunk.get("message") or {}).get("content"))
+
+async def send_one(client: httpx.AsyncClient, record: Dict[str, Any], args, scheduled: float) -> Result:
+    path = record["path"]
+    body = record["body"]
+    if args.stream != "keep" and isinstance(body, dict):
+        body = {**body, "stream": args.stream == "on"}
+    if args.model and isinstance(body, dict):
+        body = {**body, "model": args.model}
+    headers = {}
+    if args.client_header and record.get("client"):
+        headers[args.client_header] = record["client"]
+
+    # stream 省略時は /api/chat (Ollama) も /v1/chat/completions (ChatRequest.stream の既定) もストリーム
+    streaming = isinstance(body, dict) and bool(body.get("stream", True))
+
+    result = Result(path=path, lateness=max(0.0, time.perf_counter() - scheduled))
+    started = time.perf_counter()
+    try:
+        async with client.stream("POST", path, json=body, headers=headers) as res:
+            result.status = res.status_code
+            async for line in res.aiter_lines():
+                if streaming and result.ttft is None and _is_first_token(path, line):
+                    result.ttft = time.perf_counter() - started
+        result.latency = time.perf_counter() - started
+    except httpx.HTTPError as e:
+        result.error = type(e).__name__
+        result.latency = time.perf_counter() - started
+    return result
+
+async def replay(args) -> Report:
+    records = load_capture(args.capture, args.limit)
+    report = Report()
+    if not records:
+        return report
+    limits = httpx.Limits(max_connections=args.max_connections, max_keepalive_connections=args.max_connections)
+    timeout = httpx.Timeout(args.timeout, connect=10.0)
+    async with httpx.AsyncClient(base_url=args.target, timeout=timeout, limits=limits) as client:
+        t0 = time.perf_counter()
+        tasks = []
+        for record in records:
+            scheduled = t0 + record["offset"] / args.speed
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            tasks.append(asyncio.create_task(send_one(client, record, args, scheduled)))
+        report.results = await asyncio.gather(*tasks)
+        report.wall = time.perf_counter() - t0
+    return report
+
+def percentile(values: List[float], p: float) -> float | None:
+    if not values:
+        return None
+    values = sorted(values)
+    k = (len(values) - 1) * p / 100
+    lo, hi = int(k), min(int(k) + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo]) * (k - lo)
+
+def summarize(report: Report) -> Dict[str, Any]:
+    results = report.results
+    ok = [r for r in results if r.error is None and r.status is not None and r.status < 400]
+
+    def dist(values: List[float]) -> Dict[str, float | None]:
+        return {
+            "count": len(values),
+            **{f"p{p}": _round(percentile(values, p)) for p in (50, 90, 95, 99)},
+            "max": _round(max(values) if values else None),
+        }
+
+    statuses = Counter(str(r.status) for r in results if r.status is not None)
+    errors = Counter(r.error for r in results if r.error is not None)
+    return {
+        "requests": len(results),
+        "wall_seconds": _round(report.wall),
+        "throughput_rps": _round(len(results) / report.wall) if report.wall else None,
+        "error_rate": _round(1 - len(ok) / len(results)) if results else None,
+        "statuses": dict(statuses),
+        "errors": dict(errors),
+        "latency": dist([r.latency for r in ok if r.latency is not None]),
+        "ttft": dist([r.ttft for r in ok if r.ttft is not None]),
+        "max_send_lateness": _round(max((r.lateness for r in results), default=0.0)),
+        "by_path": {
+            path: dist([r.latency for r in ok if r.path == path and r.latency is not None])
+            for path in sorted({r.path for r in results})
+        },
+    }
+
+def _round(v: float | None) -> float | None:
+    return None if v is None else round(v, 4)
+
+def print_summary(summary: Dict[str, Any]) -> None:
+    print(f"requests: {summary['requests']}  wall: {summary['wall_seconds']}s  rps: {summary['throughput_rps']}")
+    print(f"error rate: {summary['error_rate']}  statuses: {summary['statuses']}  errors: {summary['errors']}")
+    for name in ("latency", "ttft"):
+        d = summary[name]
+        print(f"{name:8s} n={d['count']:<5d} p50={d['p50']} p90={d['p90']} p95={d['p95']} p99={d['p99']} max={d['max']}")
+    for path, d in summary["by_path"].items():
+        print(f"  {path}: n={d['count']} p50={d['p50']} p99={d['p99']}")
+    if summary["max_send_lateness"] > 0.5:
+        print(f"warning: sends lagged schedule by up to {summary['max_send_lateness']}s (client-side bottleneck)")
+
+def anonymize(args) -> None:
+    from app.services.capture import anonymize_record
+    salt = os.urandom(16)
+    with open(args.capture, encoding="utf-8") as src, open(args.output, "w", encoding="utf-8") as dst:
+        for line in src:
+            if line.strip():
+                dst.write(json.dumps(anonymize_record(json.loads(line), salt), ensure_ascii=False) + "\n")
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("replay", help="キャプチャをゲートウェイへ再生する")
+    p.add_argument("capture")
+    p.add_argument("--target", default="http://localhost:8000")
+    p.add_argument("--speed", type=float, default=1.0, help="到着間隔を 1/speed に縮める")
+    p.add_argument("--limit", type=int, default=None)
+    p.add_argument("--stream", choices=("keep", "on", "off"), default="keep", help="stream フラグを上書きする (TTFT はストリーム時のみ)")
+    p.add_argument("--model", default=None, help="model を上書きする")
+    p.add_argument("--client-header", default="X-OpenWebUI-User-Id", help="キャプチャの client をこのヘッダで送る (空で送らない)")
+    p.add_argument("--timeout", type=float, default=600.0)
+    p.add_argument("--max-connections", type=int, default=1000)
+    p.add_argument("--json", action="store_true", help="結果を JSON で出力する")
+
+    p = sub.add_parser("anonymize", help="キャプチャを匿名化して書き出す")
+    p.add_argument("capture")
+    p.add_argument("output")
+
+    args = parser.parse_args()
+    if args.command == "anonymize":
+        anonymize(args)
+        return
+    if args.speed <= 0:
+        parser.error("--speed must be positive")
+    summary = summarize(asyncio.run(replay(args)))
+    if args.json:
+        print(json.dumps(summary, indent=2))
+    else:
+        print_summary(summary)
+
+if __name__ == "__main__":
+    main()
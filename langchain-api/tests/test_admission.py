@@ -0,0 +1,27 @@
+import pytest
+from app.services import admission
+from app.services.admission import TokenBucket
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(admission.time, "monotonic", lambda: now[0])
+    return now
+
+def test_token_bucket_drains_and_reports_wait(clock):
+    bucket = TokenBucket(capacity=100, refill_per_sec=10)
+    assert bucket.try_take(80) == 0.0
+    assert bucket.try_take(50) == pytest.approx(3.0)
+    clock[0] += 3.0
+    assert bucket.try_take(50) == 0.0
+
+def test_token_bucket_lets_oversized_request_through_when_full(clock):
+    bucket = TokenBucket(capacity=100, refill_per_sec=10)
+    assert bucket.try_take(500) == 0.0
+    assert bucket.try_take(1) > 0
+
+def test_token_bucket_refund_is_capped_at_capacity(clock):
+    bucket = TokenBucket(capacity=100, refill_per_sec=10)
+    bucket.try_take(30)
+    bucket.refund(1000)
+    assert bucket.tokens == 100
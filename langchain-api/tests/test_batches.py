@@ -0,0 +1,34 @@
+import json
+from app.services.batches import parse_batch_input
+
+ENDPOINT = "/v1/chat/completions"
+
+def _line(custom_id, **overrides):
+    obj = {"custom_id": custom_id, "method": "POST", "url": ENDPOINT, "body": {"messages": [{"role": "user", "content": "hi"}]}}
+    obj.update(overrides)
+    return json.dumps(obj)
+
+def test_valid_lines_are_parsed_as_non_streaming():
+    lines, errors = parse_batch_input("\n".join([_line("a"), "", _line("b")]), ENDPOINT)
+    assert errors == []
+    assert [(l.index, l.custom_id) for l in lines] == [(0, "a"), (2, "b")]
+    assert all(l.body.stream is False for l in lines)
+
+def test_errors_carry_one_based_line_numbers():
+    content = "\n".join([_line("a"), _line("a"), "{not json", _line("c", url="/v1/embeddings"), _line("d", method="GET"), json.dumps({"url": ENDPOINT})])
+    lines, errors = parse_batch_input(content, ENDPOINT)
+    assert [l.custom_id for l in lines] == ["a"]
+    assert [(e["code"], e["line"]) for e in errors] == [
+        ("duplicate_custom_id", 2),
+        ("invalid_json_line", 3),
+        ("mismatched_endpoint", 4),
+        ("invalid_method", 5),
+        ("missing_custom_id", 6),
+    ]
+
+def test_invalid_body_is_reported():
+    _, errors = parse_batch_input(_line("a", body={"messages": "nope"}), ENDPOINT)
+    assert [e["code"] for e in errors] == ["invalid_request"]
+
+def test_empty_file_is_an_error():
+    assert [e["code"] for e in parse_batch_input("\n\n", ENDPOINT)[1]] == ["empty_file"]
@@ -0,0 +1,43 @@
+from types import SimpleNamespace
+from app.jobs.consolidate_memories import find_clusters, fold_contents, lsh_candidates, normalize_title
+
+LANGGRAPH = "LangGraph is a library for building stateful, multi-actor applications with LLMs, built on LangChain."
+
+def _row(id, title, content, memory_simplicity=0):
+    return SimpleNamespace(id=id, title=title, content=content, memory_simplicity=memory_simplicity)
+
+def test_normalize_title_ignores_case_width_and_spacing():
+    assert normalize_title("Lang Graph") == normalize_title("ｌａｎｇｇｒａｐｈ") == "langgraph"
+
+def test_langgraph_variants_merge_into_one_cluster():
+    rows = [
+        _row(1, "LangGraph", LANGGRAPH),
+        _row(2, "Lang Graph", LANGGRAPH),
+        _row(3, "langgraph library", LANGGRAPH + " It supports cycles."),
+    ]
+    clusters, _ = find_clusters(rows, {})
+    assert len(clusters) == 1
+    members = {clusters[0].canonical_id} | {m["id"] for m in clusters[0].members}
+    assert members == {1, 2, 3}
+
+def test_version_numbers_do_not_merge_even_with_same_content():
+    content = "A large language model released by OpenAI."
+    clusters, _ = find_clusters([_row(1, "GPT-4", content), _row(2, "GPT-5", content)], {})
+    assert clusters == []
+
+def test_unrelated_memories_do_not_merge():
+    rows = [_row(1, "LangGraph", LANGGRAPH), _row(2, "Ollama", "Runs open-weight models locally behind an HTTP API.")]
+    assert find_clusters(rows, {})[0] == []
+
+def test_canonical_prefers_memory_with_most_relations():
+    rows = [_row(1, "LangGraph", LANGGRAPH), _row(2, "Lang Graph", LANGGRAPH)]
+    clusters, _ = find_clusters(rows, {2: 3})
+    assert clusters[0].canonical_id == 2
+
+def test_lsh_candidates_pair_only_matching_bands():
+    signatures = {1: (1, 2, 3, 4), 2: (1, 2, 9, 9), 3: (7, 7, 7, 7)}
+    assert lsh_candidates(signatures, bands=2) == {(1, 2)}
+
+def test_fold_contents_appends_only_missing_lines():
+    folded = fold_contents("LangGraph is a graph library.\nBuilt on LangChain.", ["langgraph is a graph library", "Supports cycles."])
+    assert folded == "LangGraph is a graph library.\nBuilt on LangChain.\nSupports cycles."
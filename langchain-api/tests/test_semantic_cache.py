@@ -0,0 +1,26 @@
+from app.services.semantic_cache import CacheEntry, LSHIndex, _unit, memory_fingerprint, normalize_prompt
+
+def _entry(entry_id, vector):
+    return CacheEntry(entry_id=entry_id, scope=("t", "ollama:m", "s"), vector=_unit(vector), answer="a", fingerprint="f", text_hash=str(entry_id), expires_at=0.0)
+
+def test_lsh_index_finds_same_direction_and_skips_opposite():
+    index = LSHIndex(4)
+    index.add(_entry(1, [1.0, 0.2, 0.3, 0.4]))
+    assert 1 in index.candidates(_unit([2.0, 0.4, 0.6, 0.8]))
+    assert 1 not in index.candidates(_unit([-1.0, -0.2, -0.3, -0.4]))
+
+def test_lsh_index_remove_drops_candidates():
+    index = LSHIndex(4)
+    entry = _entry(1, [1.0, 0.2, 0.3, 0.4])
+    index.add(entry)
+    index.remove(entry)
+    assert index.size == 0
+    assert index.candidates(entry.vector) == set()
+
+def test_normalize_prompt_folds_width_case_and_spaces():
+    assert normalize_prompt("  ＬａｎｇＧｒａｐｈ   とは? ") == "langgraph とは?"
+
+def test_memory_fingerprint_ignores_order_but_not_content():
+    a = [{"title": "A", "content": "1"}, {"title": "B", "content": "2"}]
+    assert memory_fingerprint(a) == memory_fingerprint(list(reversed(a)))
+    assert memory_fingerprint(a) != memory_fingerprint([{"title": "A", "content": "1"}, {"title": "B", "content": "3"}])